@@ -0,0 +1,424 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Benchmarks for the parser, the reader, the filter, the aggregators and the output thread.
+
+The benchmarks run against synthetic log files in each of the three supported column layouts, with single-line
+entries, with stack traces, and gzip-compressed. Every benchmark reports its throughput in entries (or seeks) per
+second and in bytes per second. The results can be written to a JSON file and compared with the results of another
+commit:
+
+    ./benchmarks.py --json before.json
+    ./benchmarks.py --compare before.json
+"""
+
+import gzip
+import io
+import json
+import logging
+import mmap
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+
+from common import LogLevel, LogFilter
+from logfire import Log4jParser, MergingLogAggregator, NonOrderedLogAggregator, OrderedLogAggregator, OutputThread
+from logfire import ProcessReceiver, ReaderProcess, RingReaderThread
+from logreader import LogReader
+
+LAYOUTS = {
+    3: '{timestamp} {level} {location}: {message}\n',
+    4: '{timestamp} {level} {thread} {location}: {message}\n',
+    5: '{timestamp} {flow_id} {level} {thread} {location}: {message}\n',
+}
+
+SCENARIOS = ('single-line', 'stack-traces', 'gzip')
+
+STACK_TRACE_INTERVAL = 10  # entries
+STACK_TRACE_LENGTH = 20  # lines
+TAIL_LENGTH = 1000  # entries
+SEEK_COUNT = 100
+BATCH_SIZE = 1024  # entries
+
+
+### LOG FILES ###
+
+def generate_log(path, column_count, entry_count, stack_traces=False, compress=False):
+    """
+    Writes a synthetic log file with entry_count entries in the layout with the given number of columns (not counting
+    the date column). Most entries are DEBUG entries. If stack_traces is set, every STACK_TRACE_INTERVALth entry is an
+    ERROR entry followed by a stack trace of STACK_TRACE_LENGTH lines. Returns the size of the uncompressed contents.
+    """
+
+    layout = LAYOUTS[column_count]
+    stack_trace = ''.join('\tat com.example.service.Handler{0}.handle(Handler{0}.java:{1})\n'.format(i, 10 + i)
+                          for i in range(STACK_TRACE_LENGTH))
+    levels = ('DEBUG',) * 7 + ('INFO', 'INFO', 'WARN')
+
+    size = 0
+    logfile = gzip.open(path, 'wb') if compress else io.open(path, 'wb')
+    with logfile:
+        lines = []
+        for entry_index in range(entry_count):
+            has_stack_trace = stack_traces and entry_index % STACK_TRACE_INTERVAL == 0
+            line = layout.format(
+                timestamp=make_timestamp(entry_index * 10),
+                flow_id='F{0:08X}'.format(entry_index // 20),
+                level='ERROR' if has_stack_trace else levels[entry_index % len(levels)],
+                thread='pool-1-thread-{0}'.format(entry_index % 16),
+                location='com.example.service.Worker{0}.process(Worker{0}.java:{1})'.format(entry_index % 50,
+                                                                                           entry_index % 400),
+                message='Processed request {0} for customer {1} in {2} ms'.format(entry_index, entry_index % 997,
+                                                                                  entry_index % 300),
+            )
+            if has_stack_trace:
+                line += stack_trace
+            lines.append(line)
+            if len(lines) == 1000:
+                chunk = ''.join(lines)
+                logfile.write(chunk)
+                size += len(chunk)
+                lines = []
+        chunk = ''.join(lines)
+        logfile.write(chunk)
+        size += len(chunk)
+    return size
+
+
+def make_timestamp(milliseconds):
+    seconds, milliseconds = divmod(milliseconds, 1000)
+    minutes, seconds = divmod(seconds, 60)
+    hours, minutes = divmod(minutes, 60)
+    days, hours = divmod(hours, 24)
+    return '2000-01-{0:02d} {1:02d}:{2:02d}:{3:02d},{4:03d}'.format(days + 1, hours, minutes, seconds, milliseconds)
+
+
+def open_log(path):
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    else:
+        return io.open(path, 'rb')
+
+
+def read_entries(path, lazy=False):
+    """Parses the whole file and returns its entries as a list."""
+
+    parser = Log4jParser(block_size=Log4jParser.DEFAULT_BLOCK_SIZE, lazy=lazy)
+    with open_log(path) as logfile:
+        parser.autoconfigure(logfile)
+        return list(parser.read(0, logfile))
+
+
+def read_batches(path):
+    parser = Log4jParser(block_size=Log4jParser.DEFAULT_BLOCK_SIZE)
+    with open_log(path) as logfile:
+        parser.autoconfigure(logfile)
+        return list(parser.read_batches(0, logfile, BATCH_SIZE))
+
+
+### BENCHMARKS ###
+
+def benchmark_read(path, block_size=None, lazy=False, use_mmap=False):
+    """Parses the whole file. Returns the number of entries."""
+
+    parser = Log4jParser(block_size=block_size, lazy=lazy)
+    with open_log(path) as logfile:
+        parser.autoconfigure(logfile)
+        if use_mmap:
+            logfile = mmap.mmap(logfile.fileno(), 0, access=mmap.ACCESS_READ)
+        entry_count = 0
+        for entry in parser.read(0, logfile):
+            entry_count += 1
+        if use_mmap:
+            logfile.close()
+    return entry_count
+
+
+def benchmark_read_batches(path):
+    """Parses the whole file into batches of BATCH_SIZE entries. Returns the number of entries."""
+
+    parser = Log4jParser(block_size=Log4jParser.DEFAULT_BLOCK_SIZE)
+    with open_log(path) as logfile:
+        parser.autoconfigure(logfile)
+        entry_count = 0
+        for batch in parser.read_batches(0, logfile, BATCH_SIZE):
+            entry_count += len(batch)
+    return entry_count
+
+
+def benchmark_seek_tail(path, use_mmap=False):
+    """Seeks to the TAIL_LENGTHth entry from the end. Returns the number of entries."""
+
+    reader = make_reader(path, use_mmap, tail_length=TAIL_LENGTH)
+    try:
+        reader._seek_tail()
+    finally:
+        reader._close_file()
+    return TAIL_LENGTH
+
+
+def benchmark_seek_time(path, use_mmap=False, entry_count=None):
+    """Seeks to SEEK_COUNT timestamps spread evenly over the file. Returns the number of seeks."""
+
+    reader = make_reader(path, use_mmap)
+    try:
+        for seek_index in range(SEEK_COUNT):
+            reader._seek_time(make_timestamp(seek_index * entry_count * 10 // SEEK_COUNT))
+    finally:
+        reader._close_file()
+    return SEEK_COUNT
+
+
+def make_reader(path, use_mmap, tail_length=None):
+    reader = LogReader(0, path, Log4jParser(), None, tail_length=tail_length, use_mmap=use_mmap,
+                       index_file_path_prefix=path + '.')
+    reader._open_file()
+    return reader
+
+
+def benchmark_filter(entries, entry_filter):
+    """Applies the filter to every entry. Returns the number of entries."""
+
+    matches = entry_filter.matches
+    for entry in entries:
+        matches(entry)
+    return len(entries)
+
+
+def benchmark_select(batches, entry_filter):
+    """Selects the matching entries of every batch. Returns the number of entries."""
+
+    select = entry_filter.select
+    entry_count = 0
+    for batch in batches:
+        select(batch)
+        entry_count += len(batch)
+    return entry_count
+
+
+def benchmark_aggregator(entries, aggregator_class, batch_size=None):
+    """
+    Adds the entries to a new aggregator as if they had been read from two files, one by one or in batches of
+    batch_size entries, then takes all of them out again. Returns the number of entries.
+    """
+
+    aggregator = aggregator_class(['A', 'B'])
+    other_entries = [entry._replace(reader_id=1) for entry in entries]
+    if batch_size:
+        for start in xrange(0, len(entries), batch_size):
+            aggregator.add_batch(entries[start:start + batch_size])
+            aggregator.add_batch(other_entries[start:start + batch_size])
+    else:
+        add = aggregator.add
+        for entry in entries:
+            add(entry)
+        for entry in other_entries:
+            add(entry)
+    aggregator.eof(0)
+    aggregator.eof(1)
+    entry_count = 0
+    for entry in aggregator.get():
+        entry_count += 1
+    return entry_count
+
+
+def benchmark_ring(path, entries):
+    """
+    Passes lazy entries through the ring of a ReaderProcess in batches of BATCH_SIZE entries, encoding and decoding
+    them as a reader process and the main process do. Returns the number of entries.
+    """
+
+    parser = Log4jParser(lazy=True)
+    with open_log(path) as logfile:
+        parser.autoconfigure(logfile)
+    process = ReaderProcess([0], None)
+    receiver = ProcessReceiver(process.ring, process.queue_length, process.passing_on)
+    receiver.add_parser(0, parser)
+    ring_reader = RingReaderThread(process, NonOrderedLogAggregator(['A']))
+    for start in xrange(0, len(entries), BATCH_SIZE):
+        receiver.add_batch(entries[start:start + BATCH_SIZE])
+        while len(process.ring):
+            ring_reader.handle(process.ring.read())
+    return len(entries)
+
+
+def benchmark_output(entries, devnull):
+    """Writes the entries with an OutputThread. Returns the number of entries."""
+
+    aggregator = NonOrderedLogAggregator(['A'])
+    for entry in entries:
+        aggregator.add(entry)
+    aggregator.eof(0)
+    OutputThread(aggregator, fd=devnull, collapse=True, truncate=200).run()
+    return len(entries)
+
+
+def make_benchmarks(directory, entry_count, column_counts, scenarios):
+    """
+    Generates the log files and yields (name, column_count, scenario, unit, size, function) tuples, where function
+    runs the benchmark and returns the number of processed entries or seeks, and size is the number of processed bytes
+    per run.
+    """
+
+    devnull = open(os.devnull, 'wb')
+    for column_count in column_counts:
+        for scenario in scenarios:
+            compress = scenario == 'gzip'
+            path = os.path.join(directory, '{0}-{1}.log{2}'.format(column_count, scenario, '.gz' if compress else ''))
+            size = generate_log(path, column_count, entry_count, stack_traces=scenario == 'stack-traces',
+                                compress=compress)
+
+            def benchmark(name, unit, function, benchmark_size=size):
+                return name, column_count, scenario, unit, benchmark_size, function
+
+            yield benchmark('read-lines', 'entries', lambda: benchmark_read(path))
+            yield benchmark('read-blocks', 'entries',
+                            lambda: benchmark_read(path, block_size=Log4jParser.DEFAULT_BLOCK_SIZE))
+            yield benchmark('read-blocks-lazy', 'entries',
+                            lambda: benchmark_read(path, block_size=Log4jParser.DEFAULT_BLOCK_SIZE, lazy=True))
+            if not compress:
+                yield benchmark('read-mmap-lazy', 'entries', lambda: benchmark_read(path, lazy=True, use_mmap=True))
+            yield benchmark('read-batches', 'entries', lambda: benchmark_read_batches(path))
+
+            # The first run of a seek benchmark on a gzip file builds its index, later runs use the stored index.
+            tail_size = size * TAIL_LENGTH // entry_count
+            yield benchmark('seek-tail', 'entries', lambda: benchmark_seek_tail(path), tail_size)
+            yield benchmark('seek-time', 'seeks', lambda: benchmark_seek_time(path, entry_count=entry_count), 0)
+            if not compress:
+                yield benchmark('seek-tail-mmap', 'entries', lambda: benchmark_seek_tail(path, use_mmap=True),
+                                tail_size)
+                yield benchmark('seek-time-mmap', 'seeks',
+                                lambda: benchmark_seek_time(path, use_mmap=True, entry_count=entry_count), 0)
+
+            if scenario == 'gzip':
+                continue
+
+            entries = read_entries(path)
+            yield benchmark('filter-level', 'entries',
+                            lambda: benchmark_filter(entries, LogFilter(levels=[LogLevel.ERROR])))
+            yield benchmark('filter-grep', 'entries', lambda: benchmark_filter(entries, LogFilter(grep='customer 42 ')))
+            yield benchmark('filter-time', 'entries', lambda: benchmark_filter(
+                entries, LogFilter(time_from=make_timestamp(0), time_to=make_timestamp(entry_count * 5))))
+            batches = read_batches(path)
+            yield benchmark('select-level', 'entries',
+                            lambda: benchmark_select(batches, LogFilter(levels=[LogLevel.ERROR])))
+            yield benchmark('select-grep', 'entries', lambda: benchmark_select(batches, LogFilter(grep='customer 42 ')))
+            yield benchmark('select-time', 'entries', lambda: benchmark_select(
+                batches, LogFilter(time_from=make_timestamp(0), time_to=make_timestamp(entry_count * 5))))
+            yield benchmark('aggregator-ordered', 'entries',
+                            lambda: benchmark_aggregator(entries, OrderedLogAggregator), 2 * size)
+            yield benchmark('aggregator-non-ordered', 'entries',
+                            lambda: benchmark_aggregator(entries, NonOrderedLogAggregator), 2 * size)
+            yield benchmark('aggregator-ordered-batches', 'entries',
+                            lambda: benchmark_aggregator(entries, OrderedLogAggregator, 1024), 2 * size)
+            # The buffers are large enough to hold all entries, as they are only taken out after all have been added.
+            yield benchmark('aggregator-merging-batches', 'entries', lambda: benchmark_aggregator(
+                entries, lambda file_names: MergingLogAggregator(file_names, len(entries)), 1024), 2 * size)
+            lazy_entries = read_entries(path, lazy=True)
+            yield benchmark('ring-lazy-batches', 'entries', lambda: benchmark_ring(path, lazy_entries))
+            yield benchmark('output', 'entries', lambda: benchmark_output(entries, devnull))
+
+
+def measure(function, repeat):
+    """Runs the function repeat times. Returns the result and the shortest run time in seconds."""
+
+    best_seconds = None
+    for _ in range(repeat):
+        start = time.time()
+        result = function()
+        seconds = time.time() - start
+        if best_seconds is None or seconds < best_seconds:
+            best_seconds = seconds
+    return result, max(best_seconds, 1e-9)
+
+
+### RESULTS ###
+
+def get_environment():
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=open(os.devnull, 'wb')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'commit': commit,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+    }
+
+
+def get_key(result):
+    return result['name'], result['columns'], result['scenario']
+
+
+def format_result(result, previous_result=None):
+    line = '{name:<24} {columns} {scenario:<13} {per_second:>12,.0f} {unit:<7}/s {megabytes_per_second:>8.1f} MB/s'.format(
+        megabytes_per_second=result['bytes_per_second'] / 1e6, **result)
+    if previous_result:
+        line += ' {0:>+7.1%}'.format(result['per_second'] / previous_result['per_second'] - 1)
+    return line
+
+
+def main():
+    parser = ArgumentParser(description='Benchmarks the parser, the reader, the filter, the aggregators and the output.')
+    parser.add_argument('-n', '--entries', type=int, default=100000, metavar='N',
+                        help='number of entries per log file (default 100000)')
+    parser.add_argument('-r', '--repeat', type=int, default=3, metavar='N',
+                        help='run every benchmark N times and report the fastest run (default 3)')
+    parser.add_argument('--columns', default='3,4,5', help='column layouts to benchmark (default 3,4,5)')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS),
+                        help='log file scenarios to benchmark (default {0})'.format(','.join(SCENARIOS)))
+    parser.add_argument('-b', '--benchmark', metavar='PATTERN', help='only run benchmarks whose name contains PATTERN')
+    parser.add_argument('--json', metavar='FILE', help='write the results to FILE as JSON')
+    parser.add_argument('--compare', metavar='FILE', help='compare the results with the results in FILE')
+    args = parser.parse_args()
+
+    # The parser warns about every line it cannot parse; none are expected here.
+    logging.basicConfig(level=logging.ERROR)
+
+    previous_results = {}
+    if args.compare:
+        with open(args.compare, 'rb') as previous_file:
+            previous_results = dict((get_key(r), r) for r in json.load(previous_file)['results'])
+
+    column_counts = [int(c) for c in args.columns.split(',')]
+    scenarios = args.scenarios.split(',')
+
+    results = []
+    directory = tempfile.mkdtemp(prefix='logfire-benchmarks-')
+    try:
+        for name, column_count, scenario, unit, size, function in make_benchmarks(directory, args.entries,
+                                                                                  column_counts, scenarios):
+            if args.benchmark and args.benchmark not in name:
+                continue
+            count, seconds = measure(function, args.repeat)
+            result = {
+                'name': name,
+                'columns': column_count,
+                'scenario': scenario,
+                'unit': unit,
+                'count': count,
+                'bytes': size,
+                'seconds': seconds,
+                'per_second': count / seconds,
+                'bytes_per_second': size / seconds,
+            }
+            results.append(result)
+            print format_result(result, previous_results.get(get_key(result)))
+            sys.stdout.flush()
+    finally:
+        shutil.rmtree(directory)
+
+    if args.json:
+        with open(args.json, 'wb') as json_file:
+            json.dump({'environment': get_environment(), 'results': results}, json_file, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':  #pragma: nocover
+    main()
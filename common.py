@@ -1,15 +1,32 @@
+import calendar
+import os
+import re
+import time
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
 class LogLevel(object):
 
     FROM_FIRST_LETTER = {}
+    BY_PRIORITY = {}
 
     def __init__(self, priority, name):
         self.priority = priority
         self.name = name
         LogLevel.FROM_FIRST_LETTER[name[0]] = self
+        LogLevel.BY_PRIORITY[priority] = self
 
     def __repr__(self):
         return self.name
 
+    def __reduce__(self):
+        # Log levels are compared by identity, so unpickling has to yield the existing instances.
+        return getattr, (LogLevel, self.name)
+
 
 LogLevel.TRACE = LogLevel(0, 'TRACE')
 LogLevel.DEBUG = LogLevel(1, 'DEBUG')
@@ -19,25 +36,223 @@ LogLevel.ERROR = LogLevel(4, 'ERROR')
 LogLevel.FATAL = LogLevel(5, 'FATAL')
 
 
+# Parsing the milliseconds of a timestamp with int() takes longer than looking them up.
+MILLISECONDS = dict(('%03d' % milliseconds, milliseconds) for milliseconds in range(1000))
+
+
+class TimeConverter(object):
+
+    """
+    Converts the "YYYY-MM-DD HH:MM:SS,mmm" timestamps of log entries into milliseconds since the epoch. The timezone of
+    the timestamps is given as an offset from UTC ("+02:00", "-0500", "UTC"), or as "local" for the local timezone of
+    this machine, including its daylight saving time. By default, timestamps are taken to be UTC.
+
+    The conversion of the seconds part is cached, so that usually only the milliseconds are converted for each entry.
+    """
+
+    CACHE_SIZE = 100000  # seconds
+    TIME_STRING_TEMPLATE = '0000-01-01 00:00:00,000'
+    UTC_OFFSET_PATTERN = re.compile(r'^(?:UTC|GMT)?([+-])(\d\d?)(?::?(\d\d))?$')
+
+    def __init__(self, timezone=None):
+        """Raises ValueError if the timezone is not supported."""
+
+        self.timezone = timezone
+        self.local = timezone == 'local'
+        self.utc_offset = 0 if self.local else self._parse_utc_offset(timezone)
+        self.cache = {}
+
+    def _parse_utc_offset(self, timezone):
+        if timezone in (None, '', 'UTC', 'GMT', 'Z'):
+            return 0
+        match = self.UTC_OFFSET_PATTERN.match(timezone)
+        if not match:
+            raise ValueError('The timezone "{0}" is neither "local" nor an offset like "+02:00".'.format(timezone))
+        sign, hours, minutes = match.groups()
+        offset = int(hours) * 3600 + int(minutes or 0) * 60
+        return -offset if sign == '-' else offset
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['cache'] = {}
+        return state
+
+    def to_millis(self, time_string):
+        """
+        Converts the timestamp at the start of the given string into milliseconds since the epoch. Raises ValueError if
+        the string does not start with a timestamp.
+        """
+
+        try:
+            return self.cache[time_string[:19]] + MILLISECONDS[time_string[20:23]]
+        except KeyError:
+            return self._to_seconds(time_string[:19]) * 1000 + int(time_string[20:23])
+
+    def parse(self, time_string):
+        """
+        Like to_millis(), but also accepts incomplete timestamps such as "2011-09-18 15:00", which are completed with
+        the earliest possible values.
+        """
+
+        return self.to_millis(time_string + self.TIME_STRING_TEMPLATE[len(time_string):])
+
+    def _to_seconds(self, string):
+        fields = (int(string[0:4]), int(string[5:7]), int(string[8:10]),
+                  int(string[11:13]), int(string[14:16]), int(string[17:19]), 0, 0, -1)
+        if self.local:
+            seconds = int(time.mktime(fields))
+        else:
+            seconds = calendar.timegm(fields) - self.utc_offset
+        if len(self.cache) >= self.CACHE_SIZE:
+            self.cache.clear()
+        self.cache[string] = seconds * 1000
+        return seconds
+
+
 class LogFilter(object):
 
-    def __init__(self, levels=(), grep=None, time_from=None, time_to=None):
+    def __init__(self, levels=(), grep=None, time_from=None, time_to=None, time_converter=None):
+        """
+        time_from and time_to are (possibly incomplete) timestamps, which are converted with time_converter. Entries are
+        compared by their time in milliseconds since the epoch.
+        """
+
         self.levels = set(levels)
         self.grep = grep
+        self.time_converter = time_converter or TimeConverter()
         self.time_from = time_from
         self.time_to = time_to
 
+    @property
+    def time_from(self):
+        return self._time_from
+
+    @time_from.setter
+    def time_from(self, time_string):
+        self._time_from = time_string
+        self.from_time = self.time_converter.parse(time_string) if time_string else None
+
+    @property
+    def time_to(self):
+        return self._time_to
+
+    @time_to.setter
+    def time_to(self, time_string):
+        self._time_to = time_string
+        self.to_time = self.time_converter.parse(time_string) if time_string else None
+
     def matches(self, entry):
         ok = not self.levels or entry.level in self.levels
         if ok and self.grep:
             ok = self.grep in entry.message or self.grep in entry.class_
-        if ok and self.time_from:
-            ok = entry.timestamp >= self.time_from
-        if ok and self.time_to:
-            ok = entry.timestamp < self.time_to
+        if ok and self.from_time is not None:
+            ok = entry.time >= self.from_time
+        if ok and self.to_time is not None:
+            ok = entry.time < self.to_time
 
         return ok
 
+    def select(self, batch, min_priority=-1):
+        """
+        Returns the entries of the LogEntryBatch that match the filter and have a log level above min_priority. The
+        levels and times of the whole batch are compared at once (with NumPy if it is installed), and the shared text
+        of the batch is searched for the grep string, so that only the entries which can match are created.
+        """
+
+        priorities = set(level.priority for level in self.levels) if self.levels else None
+        if numpy is not None:
+            indexes = self._select_with_numpy(batch, priorities, min_priority)
+        else:
+            indexes = self._select(batch, priorities, min_priority)
+
+        if not self.grep:
+            return batch.get_entries(indexes)
+
+        # The raw text of an entry contains its message and class, so entries without a match in the text are skipped.
+        candidates = set()
+        text = batch.text
+        offset = text.find(self.grep)
+        while offset != -1:
+            candidates.add(batch.find_entry(offset))
+            offset = text.find(self.grep, offset + 1)
+        return [entry for entry in batch.get_entries([index for index in indexes if index in candidates])
+                if self.grep in entry.message or self.grep in entry.class_]
+
+    def _select(self, batch, priorities, min_priority):
+        indexes = xrange(len(batch))
+        if priorities is not None or min_priority >= 0:
+            allowed = [(priorities is None or priority in priorities) and priority > min_priority
+                       for priority in range(256)]
+            levels = batch.levels
+            indexes = [index for index in indexes if allowed[levels[index]]]
+        times = batch.times
+        if self.from_time is not None:
+            from_time = self.from_time
+            indexes = [index for index in indexes if times[index] >= from_time]
+        if self.to_time is not None:
+            to_time = self.to_time
+            indexes = [index for index in indexes if times[index] < to_time]
+        return indexes
+
+    def _select_with_numpy(self, batch, priorities, min_priority):
+        levels = numpy.frombuffer(batch.levels, dtype=numpy.uint8)
+        times = numpy.frombuffer(batch.times, dtype=batch.times.typecode)
+        mask = levels > min_priority
+        if priorities is not None:
+            mask &= numpy.in1d(levels, sorted(priorities))
+        if self.from_time is not None:
+            mask &= times >= self.from_time
+        if self.to_time is not None:
+            mask &= times < self.to_time
+        return numpy.flatnonzero(mask).tolist()
+
+
+class SymbolTable(object):
+
+    """
+    Interns strings, so that equal strings read from many log entries share a single instance. The table keeps two
+    generations of at most capacity symbols each. When the current generation is full, it replaces the old generation,
+    whose symbols are dropped unless they are used again. Frequently used symbols therefore stay in the table, while
+    the symbols of high-cardinality fields are evicted instead of piling up.
+    """
+
+    DEFAULT_CAPACITY = 1024  # symbols per generation
+
+    def __init__(self, capacity=DEFAULT_CAPACITY):
+        self.capacity = capacity
+        self.current = {}
+        self.old = {}
+
+    def __len__(self):
+        return len(self.current) + len(self.old)
+
+    def intern(self, string):
+        symbol = self.current.get(string)
+        if symbol is None:
+            symbol = self.old.get(string, string)
+            if len(self.current) >= self.capacity:
+                self.old = self.current
+                self.current = {}
+            self.current[symbol] = symbol
+        return symbol
+
+
+def get_short_name(path):
+    """Returns the name shown for the entries of a file: the last four characters of its name, in upper case."""
+
+    name, _ = os.path.splitext(os.path.basename(path))
+    return name[-4:].upper()
+
+
+def make_unique_name(name, used_names):
+    """Appends digits to name until it is not in used_names."""
+
+    i = 1
+    while name in used_names:
+        name = name + str(i)
+        i += 1
+    return name
+
 
 def get_device_and_inode_string(st):
     return '%xg%x' % (st.st_dev, st.st_ino)
@@ -0,0 +1,215 @@
+"""
+Notifies readers that follow files about changes of the files, so that they neither have to poll the files nor wait
+for the next poll after new entries have been written. The notifications are based on Linux inotify, which is accessed
+through ctypes. Where inotify is not available, is_supported() returns False and readers fall back to polling.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import select
+import struct
+import threading
+import time
+
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_CLOEXEC = 0x00080000
+
+FILE_EVENTS = IN_MODIFY | IN_ATTRIB | IN_MOVE_SELF | IN_DELETE_SELF
+DIRECTORY_EVENTS = IN_CREATE | IN_MOVED_TO
+
+# Events after which the file at the watched path may not be the file that is being read anymore.
+ROTATION_EVENTS = IN_MOVE_SELF | IN_DELETE_SELF | IN_CREATE | IN_MOVED_TO
+
+EVENT_HEADER = struct.Struct('iIII')  # watch descriptor, mask, cookie, length of the name
+EVENT_BUFFER_SIZE = 64 * 1024  # bytes
+
+
+def _load_libc():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        for function_name in 'inotify_init1', 'inotify_add_watch', 'inotify_rm_watch':
+            getattr(libc, function_name)
+    except (OSError, AttributeError):
+        return None
+    libc.inotify_init1.argtypes = [ctypes.c_int]
+    libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+    libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+    return libc
+
+libc = _load_libc()
+
+
+def is_supported():
+    return libc is not None
+
+
+class FileWatch(object):
+
+    """
+    The watch of a single file. The reader of the file waits on the watch until the file has changed, the file at the
+    watched path may have been replaced (rotated), or the watcher's tick has passed. The event can be shared by the
+    watches of several files, which are then told apart by their changed flags.
+    """
+
+    def __init__(self, path, event=None):
+        self.path = path
+        self.changed = False
+        self.rotated = False
+        self.event = event or threading.Event()
+
+    def notify(self, rotated=False):
+        self.changed = True
+        if rotated:
+            self.rotated = True
+        self.event.set()
+
+    def pop_changes(self):
+        """Returns whether the file has changed and whether it may have been rotated since the last call."""
+
+        changed, self.changed = self.changed, False
+        rotated, self.rotated = self.rotated, False
+        return changed, rotated
+
+    def wait(self):
+        """Waits for the next notification. Returns whether the file may have been rotated since the last call."""
+
+        # Event.wait() with a timeout polls in Python 2, so the watcher sets the events of all watches every tick
+        # instead.
+        self.event.wait()
+        self.event.clear()
+        return self.pop_changes()[1]
+
+
+class FileWatcher(threading.Thread):
+
+    """
+    Watches the files of all readers with a single inotify instance. Each file is watched for modifications and for
+    being moved or deleted, and the directory of each file is watched for new files, which may replace the watched
+    file. Every tick seconds, all watches are notified regardless of events, so that readers can do their
+    housekeeping.
+    """
+
+    def __init__(self, tick=2):
+        threading.Thread.__init__(self, name='FileWatcher')
+        self.daemon = True
+        self.tick = tick
+        self.lock = threading.Lock()
+        self.fd = libc.inotify_init1(IN_CLOEXEC)
+        if self.fd == -1:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.file_watches = {}  # watch descriptor -> list of FileWatch objects
+        self.directory_watches = {}  # watch descriptor -> {name: list of FileWatch objects}
+        self.watch_descriptors = {}  # FileWatch object -> (file watch descriptor, directory watch descriptor)
+        self.closed = False
+        self.wakeup_fd, self.close_fd = os.pipe()
+
+    def watch(self, path, event=None):
+        """Starts watching the file at path. Returns a FileWatch, which sets the given event, if any."""
+
+        file_watch = FileWatch(path, event)
+        directory, name = os.path.split(os.path.abspath(path))
+        with self.lock:
+            directory_wd = self._add_watch(directory, DIRECTORY_EVENTS | IN_ONLYDIR)
+            self.directory_watches.setdefault(directory_wd, {}).setdefault(name, []).append(file_watch)
+            try:
+                file_wd = self._add_watch(path, FILE_EVENTS)
+            except OSError as e:
+                # The file has been removed in the meantime. Its replacement is reported by the directory watch.
+                logging.info('Failed to watch %s: %s', path, e)
+                file_wd = None
+            else:
+                self.file_watches.setdefault(file_wd, []).append(file_watch)
+            self.watch_descriptors[file_watch] = file_wd, directory_wd
+        return file_watch
+
+    def unwatch(self, file_watch):
+        """Stops watching the file of the given FileWatch."""
+
+        directory_name = os.path.basename(os.path.abspath(file_watch.path))
+        with self.lock:
+            file_wd, directory_wd = self.watch_descriptors.pop(file_watch)
+            if file_wd is not None:
+                self._remove_watch(self.file_watches, file_wd, file_watch)
+            names = self.directory_watches.get(directory_wd, {})
+            if file_watch in names.get(directory_name, ()):
+                names[directory_name].remove(file_watch)
+                if not names[directory_name]:
+                    del names[directory_name]
+            if not names and directory_wd in self.directory_watches:
+                del self.directory_watches[directory_wd]
+                libc.inotify_rm_watch(self.fd, directory_wd)
+
+    def close(self):
+        """Stops the thread and releases the inotify instance."""
+
+        self.closed = True
+        os.write(self.close_fd, 'x')
+        if self.is_alive():
+            self.join()
+        for fd in self.fd, self.wakeup_fd, self.close_fd:
+            os.close(fd)
+
+    def run(self):
+        last_tick_timestamp = time.time()
+        while not self.closed:
+            try:
+                readable, _, _ = select.select([self.fd, self.wakeup_fd], [], [], self.tick)
+            except select.error as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            if self.fd in readable:
+                self._handle_events(os.read(self.fd, EVENT_BUFFER_SIZE))
+            current_timestamp = time.time()
+            if current_timestamp - last_tick_timestamp >= self.tick:
+                last_tick_timestamp = current_timestamp
+                with self.lock:
+                    file_watches = list(self.watch_descriptors)
+                for file_watch in file_watches:
+                    file_watch.event.set()
+
+    def _handle_events(self, data):
+        offset = 0
+        with self.lock:
+            while offset < len(data):
+                wd, mask, _, name_length = EVENT_HEADER.unpack_from(data, offset)
+                offset += EVENT_HEADER.size
+                name = data[offset:offset + name_length].rstrip('\0')
+                offset += name_length
+
+                if wd in self.directory_watches:
+                    for file_watch in self.directory_watches[wd].get(name, ()):
+                        file_watch.notify(rotated=True)
+                    continue
+                for file_watch in self.file_watches.get(wd, ()):
+                    file_watch.notify(rotated=bool(mask & ROTATION_EVENTS))
+                if mask & IN_IGNORED:
+                    # The kernel has removed the watch, because the file has been deleted.
+                    for file_watch in self.file_watches.pop(wd, ()):
+                        self.watch_descriptors[file_watch] = None, self.watch_descriptors[file_watch][1]
+
+    def _add_watch(self, path, mask):
+        wd = libc.inotify_add_watch(self.fd, path, mask)
+        if wd == -1:
+            error_number = ctypes.get_errno()
+            raise OSError(error_number, os.strerror(error_number), path)
+        return wd
+
+    def _remove_watch(self, watches, wd, file_watch):
+        file_watches = watches.get(wd, [])
+        if file_watch in file_watches:
+            file_watches.remove(file_watch)
+        if not file_watches and wd in watches:
+            del watches[wd]
+            libc.inotify_rm_watch(self.fd, wd)
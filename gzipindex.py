@@ -0,0 +1,416 @@
+"""
+Random access to gzip files.
+
+While a gzip file is decompressed, a checkpoint is recorded about every SPAN bytes of uncompressed data at a deflate
+block boundary. A checkpoint holds the compressed and uncompressed offsets of the boundary and the 32 KB of
+uncompressed data preceding it, which is all that is needed to resume decompression there (the technique of zran.c in
+the zlib distribution). Seeking then only decompresses from the closest checkpoint instead of from the start of the
+file. Once a file has been decompressed completely, its index can be stored and reused for later runs.
+
+Python's zlib module cannot resume decompression at a bit offset, so libz is used through ctypes. If libz cannot be
+loaded, is_supported() returns False and gzip files have to be read with the gzip module instead.
+"""
+
+import bisect
+import ctypes
+import ctypes.util
+import io
+import logging
+import os
+import pickle
+import zlib
+
+SPAN = 1024 * 1024  # bytes of uncompressed data between checkpoints
+WINDOW_SIZE = 32 * 1024  # bytes
+INPUT_SIZE = 64 * 1024  # bytes
+OUTPUT_SIZE = 64 * 1024  # bytes
+KEEP_BEHIND_SIZE = 1024 * 1024  # bytes of decompressed data kept before the target of a seek
+
+INDEX_VERSION = 1
+
+GZIP_MAGIC = '\x1f\x8b'
+GZIP_WINDOW_BITS = 16 + 15
+RAW_WINDOW_BITS = -15
+
+Z_OK = 0
+Z_STREAM_END = 1
+Z_BUF_ERROR = -5
+Z_BLOCK = 5
+
+
+class ZStream(ctypes.Structure):
+    _fields_ = [
+        ('next_in', ctypes.c_void_p),
+        ('avail_in', ctypes.c_uint),
+        ('total_in', ctypes.c_ulong),
+        ('next_out', ctypes.c_void_p),
+        ('avail_out', ctypes.c_uint),
+        ('total_out', ctypes.c_ulong),
+        ('msg', ctypes.c_char_p),
+        ('state', ctypes.c_void_p),
+        ('zalloc', ctypes.c_void_p),
+        ('zfree', ctypes.c_void_p),
+        ('opaque', ctypes.c_void_p),
+        ('data_type', ctypes.c_int),
+        ('adler', ctypes.c_ulong),
+        ('reserved', ctypes.c_ulong),
+    ]
+
+
+def _load_libz():
+    try:
+        libz = ctypes.CDLL(ctypes.util.find_library('z') or 'libz.so.1')
+        for function_name in 'inflateInit2_', 'inflateReset2', 'inflatePrime', 'inflateSetDictionary':
+            getattr(libz, function_name)
+    except (OSError, AttributeError):
+        return None
+    libz.zlibVersion.restype = ctypes.c_char_p
+    libz.inflateInit2_.argtypes = [ctypes.POINTER(ZStream), ctypes.c_int, ctypes.c_char_p, ctypes.c_int]
+    libz.inflateReset2.argtypes = [ctypes.POINTER(ZStream), ctypes.c_int]
+    libz.inflatePrime.argtypes = [ctypes.POINTER(ZStream), ctypes.c_int, ctypes.c_int]
+    libz.inflateSetDictionary.argtypes = [ctypes.POINTER(ZStream), ctypes.c_char_p, ctypes.c_uint]
+    libz.inflate.argtypes = [ctypes.POINTER(ZStream), ctypes.c_int]
+    libz.inflateEnd.argtypes = [ctypes.POINTER(ZStream)]
+    return libz
+
+libz = _load_libz()
+
+
+def is_supported():
+    return libz is not None
+
+
+class GzipIndex(object):
+
+    """
+    The checkpoints of a gzip file. checkpoints is a list of (uncompressed offset, compressed offset, bit count,
+    window) tuples, where the bit count is the number of bits of the byte before the compressed offset that belong to
+    the next block. covered is the uncompressed offset up to which checkpoints have been recorded, and size is the
+    uncompressed size of the file, or None if the file has not been decompressed completely yet.
+    """
+
+    def __init__(self, file_id=None, span=None):
+        self.file_id = file_id
+        self.span = span or SPAN
+        self.checkpoints = []
+        self.offsets = []
+        self.covered = 0
+        self.size = None
+
+    def add(self, uncompressed_offset, compressed_offset, bit_count, window):
+        self.checkpoints.append((uncompressed_offset, compressed_offset, bit_count, window))
+        self.offsets.append(uncompressed_offset)
+
+    def find(self, uncompressed_offset):
+        """Returns the last checkpoint at or before the given uncompressed offset, or None."""
+
+        index = bisect.bisect_right(self.offsets, uncompressed_offset)
+        return self.checkpoints[index - 1] if index else None
+
+    def save(self, path):
+        """Stores the index in the given file."""
+
+        data = pickle.dumps((INDEX_VERSION, self.file_id, self.span, self.size, self.checkpoints), 2)
+        with open(path, 'wb') as index_file:
+            index_file.write(zlib.compress(data))
+
+    @classmethod
+    def load(cls, path, file_id):
+        """Loads the index stored in the given file. Returns None if it does not exist or belongs to another file."""
+
+        try:
+            with open(path, 'rb') as index_file:
+                version, stored_file_id, span, size, checkpoints = pickle.loads(zlib.decompress(index_file.read()))
+        except IOError:
+            return None
+        except Exception:
+            logging.warning('Failed to read the gzip index "%s".', path)
+            return None
+        if version != INDEX_VERSION or stored_file_id != file_id:
+            return None
+        index = cls(file_id, span)
+        for checkpoint in checkpoints:
+            index.add(*checkpoint)
+        index.covered = index.size = size
+        return index
+
+
+def get_file_id(stat_results):
+    """Identifies a version of a compressed file. An index is only valid for the version it was recorded for."""
+
+    return '%xg%x %d %d' % (stat_results.st_dev, stat_results.st_ino, stat_results.st_size, stat_results.st_mtime)
+
+
+class IndexedGzipFile(object):
+
+    """
+    A read-only, seekable file object for a gzip file, including files with several members. Checkpoints are recorded
+    while the file is decompressed. If index_path is given, a complete index is loaded from and saved to that file.
+    """
+
+    mode = 'rb'
+
+    def __init__(self, name, index_path=None):
+        self.name = name
+        self.index_path = index_path
+        self._file = io.open(name, 'rb')
+        self.index = None
+        try:
+            file_id = get_file_id(os.fstat(self._file.fileno()))
+            if index_path:
+                self.index = GzipIndex.load(index_path, file_id)
+            if self.index is None:
+                self.index = GzipIndex(file_id)
+            self._stream = ZStream()
+            self._output = ctypes.create_string_buffer(OUTPUT_SIZE)
+            self._check(libz.inflateInit2_(self._stream, GZIP_WINDOW_BITS, libz.zlibVersion(), ctypes.sizeof(ZStream)))
+        except Exception:
+            self._file.close()
+            raise
+        self._restart(None)
+
+    def fileno(self):
+        return self._file.fileno()
+
+    def close(self):
+        if self._file:
+            libz.inflateEnd(self._stream)
+            self._file.close()
+            self._file = None
+
+    @property
+    def closed(self):
+        return self._file is None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @property
+    def size(self):
+        """The uncompressed size of the file. Decompresses the rest of the file if it has not been indexed yet."""
+
+        if self.index.size is None:
+            position = self.tell()
+            self._skip_to(None)
+            self.seek(position)
+        return self.index.size
+
+    def tell(self):
+        return self._buffer_offset + self._position
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.tell()
+        elif whence == os.SEEK_END:
+            offset += self.size
+        offset = max(offset, 0)
+
+        if self._buffer_offset <= offset <= self._buffer_offset + len(self._buffer):
+            self._position = offset - self._buffer_offset
+            return
+
+        checkpoint = self.index.find(offset)
+        if offset < self._buffer_offset or (checkpoint and checkpoint[0] > self._output_offset):
+            self._restart(checkpoint)
+        self._skip_to(offset)
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            chunks = [self._buffer[self._position:]]
+            self._position = len(self._buffer)
+            data = self._inflate()
+            while data:
+                chunks.append(data)
+                data = self._inflate()
+            self._buffer_offset = self._output_offset
+            self._buffer = ''
+            self._position = 0
+            return ''.join(chunks)
+
+        while len(self._buffer) - self._position < size:
+            if not self._fill():
+                break
+        data = self._buffer[self._position:self._position + size]
+        self._position += len(data)
+        return data
+
+    def readline(self):
+        end = self._buffer.find('\n', self._position)
+        while end == -1:
+            searched = len(self._buffer) - self._position
+            if not self._fill():
+                end = len(self._buffer) - 1
+                break
+            end = self._buffer.find('\n', self._position + searched)
+        line = self._buffer[self._position:end + 1]
+        self._position = end + 1
+        return line
+
+    def __iter__(self):
+        return iter(self.readline, '')
+
+    ### BUFFER ###
+
+    def _fill(self):
+        """Appends the next decompressed data to the buffer, dropping what has been read. Returns False at the end."""
+
+        data = self._inflate()
+        if not data:
+            return False
+        self._buffer_offset += self._position
+        self._buffer = self._buffer[self._position:] + data
+        self._position = 0
+        return True
+
+    def _skip_to(self, offset):
+        """
+        Decompresses data up to the given offset (or to the end of the file if offset is None) and positions the
+        buffer there. Up to KEEP_BEHIND_SIZE bytes before the offset are kept, so that seeking back a little does not
+        require decompressing again.
+        """
+
+        chunks = [self._buffer]
+        chunk_offset = self._buffer_offset
+        while offset is None or self._output_offset < offset:
+            data = self._inflate()
+            if not data:
+                break
+            chunks.append(data)
+            keep_from = (self._output_offset if offset is None else offset) - KEEP_BEHIND_SIZE
+            while len(chunks) > 1 and chunk_offset + len(chunks[0]) <= keep_from:
+                chunk_offset += len(chunks.pop(0))
+
+        self._buffer = ''.join(chunks)
+        self._buffer_offset = chunk_offset
+        if offset is None:
+            offset = self._output_offset
+        self._position = min(offset, self._output_offset) - chunk_offset
+
+    ### DECOMPRESSION ###
+
+    def _restart(self, checkpoint):
+        """Restarts decompression at the given checkpoint, or at the start of the file if checkpoint is None."""
+
+        stream = self._stream
+        if checkpoint is None:
+            self._check(libz.inflateReset2(stream, GZIP_WINDOW_BITS))
+            self._file.seek(0)
+            self._raw = False
+            self._output_offset = 0
+            self._input_offset = 0
+            self._history = ''
+        else:
+            uncompressed_offset, compressed_offset, bit_count, window = checkpoint
+            self._check(libz.inflateReset2(stream, RAW_WINDOW_BITS))
+            self._file.seek(compressed_offset - (1 if bit_count else 0))
+            if bit_count:
+                byte = ord(self._file.read(1))
+                self._check(libz.inflatePrime(stream, bit_count, byte >> (8 - bit_count)))
+            self._check(libz.inflateSetDictionary(stream, window, len(window)))
+            self._raw = True
+            self._output_offset = uncompressed_offset
+            self._input_offset = compressed_offset
+            self._history = window
+
+        self._set_input('')
+        self._end_of_file = False
+        self._buffer = ''
+        self._buffer_offset = self._output_offset
+        self._position = 0
+
+    def _inflate(self):
+        """Decompresses and returns the next piece of data, or returns '' at the end of the file."""
+
+        stream = self._stream
+        output_address = ctypes.addressof(self._output)
+        while not self._end_of_file:
+            if stream.avail_in == 0:
+                data = self._file.read(INPUT_SIZE)
+                if not data:
+                    logging.warning('The gzip file %s ends unexpectedly.', self.name)
+                    self._finish()
+                    break
+                self._input_offset += len(data)
+                self._set_input(data)
+
+            stream.next_out = output_address
+            stream.avail_out = OUTPUT_SIZE
+            result = libz.inflate(stream, Z_BLOCK)
+            if result not in (Z_OK, Z_STREAM_END) and not (result == Z_BUF_ERROR and stream.avail_in == 0):
+                raise IOError('Failed to decompress {0}: {1}'.format(self.name, stream.msg))
+
+            produced = OUTPUT_SIZE - stream.avail_out
+            data = ctypes.string_at(output_address, produced) if produced else ''
+            if data:
+                self._output_offset += produced
+                self._history = (self._history + data)[-WINDOW_SIZE:]
+
+            if result == Z_STREAM_END:
+                self._start_next_member()
+            elif stream.data_type & 128 and not stream.data_type & 64:
+                # Decompression stopped at a block boundary that is not the end of the member.
+                self._maybe_add_checkpoint()
+
+            if data:
+                return data
+        return ''
+
+    def _maybe_add_checkpoint(self):
+        index = self.index
+        if self._output_offset <= index.covered:
+            return
+        if self._output_offset - (index.offsets[-1] if index.offsets else 0) >= index.span:
+            compressed_offset = self._input_offset - self._stream.avail_in
+            index.add(self._output_offset, compressed_offset, self._stream.data_type & 7, self._history)
+        index.covered = self._output_offset
+
+    def _start_next_member(self):
+        """Called at the end of a gzip member. Starts decompressing the next member, if there is one."""
+
+        pending = self._get_pending_input()
+        while len(pending) < 10:
+            data = self._file.read(INPUT_SIZE)
+            if not data:
+                break
+            self._input_offset += len(data)
+            pending += data
+
+        if self._raw:
+            # Raw decompression does not consume the member's trailer.
+            pending = pending[8:]
+        self._set_input(pending)
+
+        if pending.startswith(GZIP_MAGIC):
+            self._check(libz.inflateReset2(self._stream, GZIP_WINDOW_BITS))
+            self._raw = False
+            self.index.covered = max(self.index.covered, self._output_offset)
+        else:
+            # Anything after the last member (usually nothing, sometimes zero padding) is ignored.
+            self._finish()
+
+    def _finish(self):
+        self._end_of_file = True
+        index = self.index
+        if index.size is None and self._output_offset >= index.covered:
+            index.covered = index.size = self._output_offset
+            if self.index_path:
+                try:
+                    index.save(self.index_path)
+                    logging.info('Saved the gzip index of %s.', self.name)
+                except Exception:
+                    logging.exception('Failed to save the gzip index of %s.', self.name)
+
+    def _set_input(self, data):
+        self._input = data
+        self._stream.next_in = ctypes.cast(ctypes.c_char_p(data), ctypes.c_void_p)
+        self._stream.avail_in = len(data)
+
+    def _get_pending_input(self):
+        return self._input[len(self._input) - self._stream.avail_in:]
+
+    def _check(self, result):
+        if result != Z_OK:
+            raise IOError('Failed to decompress {0}: zlib error {1}.'.format(self.name, result))
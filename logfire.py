@@ -1,29 +1,64 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import array
+import atexit
+import bisect
 import collections
 import heapq
 import itertools
 import json
 import logging
+import marshal
+import mmap
+import multiprocessing
 import os
+import re
 import signal
+import struct
 import sys
 import time
-from threading import Thread
-from argparse import ArgumentParser
+from threading import Condition, Lock, Thread
+from argparse import ArgumentParser, ArgumentTypeError
 
-from common import LogLevel, LogFilter
-from logreader import LogReader
+import filewatch
+from sharedring import SharedRing
+from sincedb import ProgressStore
+from spillqueue import SpillStore
+from common import LogLevel, LogFilter, SymbolTable, TimeConverter, get_short_name, make_unique_name
+from logreader import HousekeepingScheduler, LogFileDiscoverer, LogReader, MultiplexedLogReader, find_log_files, \
+    is_file_pattern
 
 try:
     import redis
 except ImportError:  #pragma: nocover
     pass  # The module might not actually be required.
 
+try:
+    import cPickle as pickle
+except ImportError:  #pragma: nocover
+    import pickle
+
 LOG_FORMAT = '%(asctime)s %(levelname)s: %(message)s'
 
-LOG_ENTRY_FIELDS = 'timestamp reader_id entry_number flow_id level thread class_ method source_file line message'
+try:
+    array.array('q')
+    TIME_TYPECODE = 'q'
+except ValueError:
+    # Python 2 has no arrays of long longs. Where longs have less than 64 bits, doubles still represent times in
+    # milliseconds exactly.
+    TIME_TYPECODE = 'l' if array.array('l').itemsize >= 8 else 'd'
+
+ENTRY_SIZE = 600  # bytes of memory taken up by an entry apart from its message
+
+# The records a ReaderProcess writes to its ring start with their type and a reader ID.
+RING_RECORD_HEADER = struct.Struct('<cl')
+ENTRIES_RECORD, WATERMARK_RECORD, EOF_RECORD, PARSER_RECORD = 'E', 'W', 'F', 'P'
+ENTRY_COUNT = struct.Struct('<l')
+WATERMARK = struct.Struct('<d')
+RAW_ENTRY, DECODED_ENTRY = 0, 1
+
+LOG_ENTRY_FIELDS = 'time reader_id entry_number timestamp flow_id level thread class_ method source_file line message'
 
 class LogEntry(collections.namedtuple('LogEntry', LOG_ENTRY_FIELDS)):
 
@@ -43,10 +78,186 @@ class LogEntry(collections.namedtuple('LogEntry', LOG_ENTRY_FIELDS)):
             'logfile': logfile_name
         }
 
+    def _key(self):
+        # Lazy entries are compared with plain entries, such as those read back from a spill queue, by this key.
+        return self[:3]
+
+
+def _decoded_field(index):
+    return property(lambda self: self._decode()[index])
+
+
+class LazyLogEntry(object):
+
+    """
+    A log entry that keeps the raw text of the entry and only decodes its fields when they are first read. The time,
+    reader ID, entry number, timestamp and log level are known up front. Lazy entries are ordered like LogEntry
+    tuples and are pickled as LogEntry tuples.
+    """
+
+    __slots__ = ('time', 'reader_id', 'entry_number', 'timestamp', 'level', '_raw', '_extract', '_fields')
+
+    def __init__(self, time, reader_id, entry_number, timestamp, level, raw, extract):
+        self.time = time
+        self.reader_id = reader_id
+        self.entry_number = entry_number
+        self.timestamp = timestamp
+        self.level = level
+        self._raw = raw
+        self._extract = extract
+        self._fields = None
+
+    def _decode(self):
+        """Decodes the fields (flow_id, thread, class_, method, source_file, line, message) from the raw text."""
+
+        fields = self._fields
+        if fields is None:
+            head, _, rest = self._raw.partition('\n')
+            flow_id, _, thread, class_, method, source_file, line_number, message = self._extract(head)
+            if rest:
+                message = message + '\n' + rest
+            fields = flow_id, thread, class_, method, source_file, line_number, message.rstrip()
+            self._fields = fields
+            self._raw = None
+        return fields
+
+    flow_id = _decoded_field(0)
+    thread = _decoded_field(1)
+    class_ = _decoded_field(2)
+    method = _decoded_field(3)
+    source_file = _decoded_field(4)
+    line = _decoded_field(5)
+    message = _decoded_field(6)
+
+    as_logstash = LogEntry.__dict__['as_logstash']
+
+    def to_entry(self):
+        """Returns the equivalent LogEntry."""
+
+        flow_id, thread, class_, method, source_file, line_number, message = self._decode()
+        return LogEntry(self.time, self.reader_id, self.entry_number, self.timestamp, flow_id, self.level, thread, class_,
+                        method, source_file, line_number, message)
+
+    def __reduce__(self):
+        return LogEntry, tuple(self.to_entry())
+
+    def __repr__(self):
+        return 'Lazy' + repr(self.to_entry())
+
+    def _key(self):
+        return self.time, self.reader_id, self.entry_number
+
+    def __eq__(self, other):
+        return self._key() == other._key()
+
+    def __ne__(self, other):
+        return self._key() != other._key()
+
+    def __lt__(self, other):
+        return self._key() < other._key()
+
+    def __le__(self, other):
+        return self._key() <= other._key()
+
+    def __gt__(self, other):
+        return self._key() > other._key()
+
+    def __ge__(self, other):
+        return self._key() >= other._key()
+
+    def __hash__(self):
+        return hash(self._key())
+
+
+class LogEntryBatch(object):
+
+    """
+    The entries read by one reader, stored column by column: the times and entry numbers in arrays, the priorities of
+    the log levels in a bytearray, and the raw text of all entries in a single string with an array of offsets into
+    it. Entry objects (LazyLogEntry) are only created for the entries that are taken from the batch.
+
+    Entries are appended to a batch while it is read. finish() has to be called before entries are taken.
+    """
+
+    def __init__(self, reader_id, extract):
+        self.reader_id = reader_id
+        self.times = array.array(TIME_TYPECODE)
+        self.entry_numbers = array.array('l')
+        self.levels = bytearray()
+        self.offsets = array.array('l', [0])
+        self.text = None
+        self._extract = extract
+        self._raw_texts = []
+
+    def __len__(self):
+        return len(self.times)
+
+    def append(self, time, entry_number, level, raw):
+        self.times.append(time)
+        self.entry_numbers.append(entry_number)
+        self.levels.append(level.priority)
+        self.offsets.append(self.offsets[-1] + len(raw))
+        self._raw_texts.append(raw)
+
+    def finish(self):
+        """Joins the raw text of the entries. Returns the batch."""
+
+        self.text = ''.join(self._raw_texts)
+        self._raw_texts = None
+        return self
+
+    def find_entry(self, offset):
+        """Returns the index of the entry whose raw text contains the given offset into text."""
+
+        return bisect.bisect_right(self.offsets, offset) - 1
+
+    def get_entry(self, index):
+        start = self.offsets[index]
+        raw = self.text[start:self.offsets[index + 1]]
+        return LazyLogEntry(self.times[index], self.reader_id, self.entry_numbers[index], raw[:23],
+                            LogLevel.BY_PRIORITY[self.levels[index]], raw, self._extract)
+
+    def get_entries(self, indexes=None):
+        """Returns a list of the entries with the given indexes, or of all entries."""
+
+        # Performance!
+        times, entry_numbers, levels = self.times, self.entry_numbers, self.levels
+        offsets, text = self.offsets, self.text
+        reader_id, extract, by_priority = self.reader_id, self._extract, LogLevel.BY_PRIORITY
+
+        entries = []
+        for index in (xrange(len(self)) if indexes is None else indexes):
+            raw = text[offsets[index]:offsets[index + 1]]
+            entries.append(LazyLogEntry(times[index], reader_id, entry_numbers[index], raw[:23],
+                                        by_priority[levels[index]], raw, extract))
+        return entries
+
 
 class Log4jParser(object):
 
-    def __init__(self):
+    DEFAULT_BLOCK_SIZE = 256 * 1024  # bytes
+
+    def __init__(self, block_size=None, lazy=False, timezone=None):
+        """
+        If block_size is given, the parser reads the log file in blocks of that many bytes instead of line by line.
+        Both modes yield the same entries. If lazy is set, the parser yields LazyLogEntry objects, which only decode
+        the fields other than the timestamp and the log level when they are read.
+
+        Thread names, class names, method names and source file names are interned in per-parser symbol tables, so
+        that queued entries share them instead of each holding a copy.
+
+        The timestamps of the file are in the given timezone (see TimeConverter). Entries are ordered by their time in
+        milliseconds since the epoch, so files from different timezones are merged correctly.
+        """
+
+        self.block_size = block_size
+        self.lazy = lazy
+        self.time_converter = TimeConverter(timezone)
+        self.thread_symbols = SymbolTable()
+        self.class_symbols = SymbolTable()
+        self.method_symbols = SymbolTable()
+        self.source_file_symbols = SymbolTable()
+        self.entry_end_position = 0
         # default pattern: %d %x %p %t %l: %m%n
         self.delimiter = ' '
         self.column_count = 5
@@ -112,55 +323,264 @@ class Log4jParser(object):
         return
 
     def read(self, reader_id, logfile):
-        """read log4j formatted log file"""
+        """
+        read log4j formatted log file
 
-        assert 'b' in getattr(logfile, 'mode', 'rb'), 'The file has not been opened in binary mode.'
+        While the entries are read, entry_end_position is the position in logfile right after the last entry that has
+        been yielded. The position of logfile itself may be further ahead, as lines are read ahead of the entries.
+        """
+
+        return self._read(reader_id, logfile, self._get_entry_factory())
+
+    def read_batches(self, reader_id, logfile, batch_size):
+        """
+        Reads the same entries as read(), but yields them in LogEntryBatch objects of up to batch_size entries instead
+        of creating an object for each entry.
+        """
+
+        extract = self._compile_extractor()
+        batch = [LogEntryBatch(reader_id, extract)]
+
+        def add_to_batch(reader_id, entry_number, extracted, lines, line_separator):
+            entry_time, level = extracted
+            raw = lines[0] if len(lines) == 1 else line_separator.join(lines)
+            batch[0].append(entry_time, entry_number, level, raw)
+
+        for _ in self._read(reader_id, logfile, (self._compile_level_extractor(), add_to_batch)):
+            if len(batch[0]) >= batch_size:
+                yield batch[0].finish()
+                batch[0] = LogEntryBatch(reader_id, extract)
+        if len(batch[0]):
+            yield batch[0].finish()
+
+    def _read(self, reader_id, logfile, entry_factory):
+        # GzipFile objects report an integer mode and are always binary.
+        mode = getattr(logfile, 'mode', 'rb')
+        assert not isinstance(mode, basestring) or 'b' in mode, 'The file has not been opened in binary mode.'
+
+        self.entry_end_position = logfile.tell()
+        if isinstance(logfile, mmap.mmap):
+            return self._read_mapped_entries(reader_id, logfile, entry_factory)
+        elif self.block_size:
+            return self._read_entries(reader_id, self._read_lines_in_blocks(logfile), '\n', entry_factory, logfile)
+        else:
+            return self._read_entries(reader_id, iter(logfile.readline, ''), '', entry_factory, logfile)
+
+    def _read_lines_in_blocks(self, logfile):
+        """
+        Reads the file in blocks of block_size bytes and yields its lines without line terminators. The incomplete
+        line at the end of a block is carried over to the next block, so the file is never seeked.
+        """
+
+        block_size = self.block_size
+        remainder = ''
+        while True:
+            block = logfile.read(block_size)
+            if not block:
+                break
+            lines = (remainder + block if remainder else block).split('\n')
+            remainder = lines.pop()
+            for line in lines:
+                yield line
+        if remainder:
+            yield remainder
+
+    def _read_mapped_entries(self, reader_id, mapped, entry_factory):
+        """
+        Reads entries from a memory-mapped file, starting at its current position. Entry boundaries are found by
+        scanning the map, so every entry is copied out of the map exactly once instead of line by line. The position
+        of the map is advanced past each entry before it is yielded.
+        """
+
+        extract, make_entry = entry_factory
+        find_entry_start = self.find_entry_start
+
+        start = mapped.tell()
+        end = len(mapped)
+        entry_number = 0
+        while start < end:
+            stop = find_entry_start(mapped, start + 1)
+            if stop == -1:
+                stop = end
+            chunk = mapped[start:stop]
+            mapped.seek(stop)
+            start = stop
+
+            head, newline, rest = chunk.partition('\n')
+            extracted = self._extract_fields(reader_id, extract, head)
+            if extracted is not None:
+                self.entry_end_position = stop
+                yield make_entry(reader_id, entry_number, extracted, [head, rest] if rest else [head], '\n')
+                entry_number += 1
+
+    def _read_entries(self, reader_id, lines, line_separator, entry_factory, logfile):
+        """
+        Groups the given lines of logfile into log entries. Continuation lines are appended to the message of the
+        preceding entry. line_separator is used to join the lines of multi-line messages; it is what has been stripped
+        from the end of each line, so the lines are counted with it to keep track of entry_end_position. entry_factory
+        is a pair of functions as returned by _get_entry_factory().
+        """
+
+        extract, make_entry = entry_factory
+        separator_length = len(line_separator)
+
+        entry_number = 0
+        entry_lines = None
+        position = self.entry_end_position  # of the start of the line
+        for line in lines:
+            if entry_lines is not None:
+                if not (line.startswith('20') and line[23:24] == ' '):
+                    entry_lines.append(line)
+                    position += len(line) + separator_length
+                    continue
+                self.entry_end_position = position
+                yield make_entry(reader_id, entry_number, extracted, entry_lines, line_separator)
+                entry_number += 1
+                entry_lines = None
+            position += len(line) + separator_length
+
+            extracted = self._extract_fields(reader_id, extract, line)
+            if extracted is not None:
+                entry_lines = [line]
+
+        # All lines have been read, so nothing is read ahead any more. The last line may lack its terminator.
+        self.entry_end_position = logfile.tell()
+        if entry_lines is not None:
+            yield make_entry(reader_id, entry_number, extracted, entry_lines, line_separator)
+
+    def _get_entry_factory(self):
+        """
+        Returns the extraction function that is applied to the first line of each entry, and the function that makes
+        an entry from the extraction result and the lines of the entry.
+        """
+
+        if not self.lazy:
+            return self._compile_extractor(), self._make_entry
+
+        extract = self._compile_extractor()
+
+        def make_lazy_entry(reader_id, entry_number, extracted, lines, line_separator):
+            entry_time, level = extracted
+            raw = lines[0] if len(lines) == 1 else line_separator.join(lines)
+            return LazyLogEntry(entry_time, reader_id, entry_number, raw[:23], level, raw, extract)
+
+        return self._compile_level_extractor(), make_lazy_entry
+
+    def _extract_fields(self, reader_id, extract, line):
+        """
+        Converts the timestamp of the first line of an entry and applies the extraction function to the line. Returns
+        the time and the extracted fields, or returns None and logs a warning if the line cannot be parsed.
+        """
+
+        if not line.startswith('20'):
+            logging.warn('Skipped a line because it does not appear to start with a date: "%s".', line)
+            return None
+        try:
+            entry_time = self.time_converter.to_millis(line)
+        except ValueError:
+            logging.warn('Skipped a line because it does not start with a valid date: "%s".', line)
+            return None
+        try:
+            fields = extract(line)
+        except Exception:  #pragma: nocover
+            # This shouldn't actually be possible.
+            logging.exception('Failed to parse line "%s" of %s', line, reader_id)
+            return None
+        if fields is None:
+            logging.warn('Skipped a line because it does not match the log layout: "%s".', line)
+            return None
+        return entry_time, fields
+
+    def _make_entry(self, reader_id, entry_number, extracted, lines, line_separator):
+        entry_time, (flow_id, level, thread, class_, method, source_file, line_number, message) = extracted
+        timestamp = lines[0][:23]
+        lines[0] = message
+        return LogEntry(
+            time=entry_time,
+            reader_id=reader_id,
+            timestamp=timestamp,
+            entry_number=entry_number,
+            flow_id=flow_id,
+            level=level,
+            thread=thread,
+            class_=class_,
+            method=method,
+            source_file=source_file,
+            line=line_number,
+            message=line_separator.join(lines).rstrip(),
+        )
+
+    def _compile_extractor(self):
+        """
+        Returns a function that extracts the fields (flow_id, level, thread, class_, method, source_file, line,
+        message) from the first line of an entry, or returns None if the line does not have enough columns.
+        """
 
-        maxsplit = self.column_count - 1
         delimiter = self.delimiter
+        maxsplit = self.column_count - 1
+        column_count = self.column_count
         flow_id_column_index = self.flow_id_column_index
         level_column_index = self.level_column_index
         thread_column_index = self.thread_column_index
         location_column_index = self.location_column_index
         message_column_index = self.message_column_index
+        read_log_level = self._read_log_level
+        read_flow_id = self._read_flow_id
+        read_thread = self._read_thread
+        read_code_position = self._read_code_position
+        intern_thread = self.thread_symbols.intern
+        intern_class = self.class_symbols.intern
+        intern_method = self.method_symbols.intern
+        intern_source_file = self.source_file_symbols.intern
+
+        def extract(line):
+            columns = line[24:].split(delimiter, maxsplit)
+            if len(columns) < column_count:
+                return None
+            class_, method, source_file, line_number = read_code_position(columns, location_column_index)
+            return (
+                read_flow_id(columns, flow_id_column_index),
+                read_log_level(columns, level_column_index),
+                intern_thread(read_thread(columns, thread_column_index)),
+                intern_class(class_),
+                intern_method(method),
+                intern_source_file(source_file),
+                line_number,
+                columns[message_column_index],
+            )
+
+        return extract
+
+    def _compile_level_extractor(self):
+        """
+        Returns a function that extracts only the log level from the first line of an entry, or returns None if the
+        line does not have enough columns.
+        """
 
-        entry_number = 0
-        while True:
-            line = logfile.readline()
-            if not line:
-                break
-            try:
-                timestamp = line[:23]
-                if not timestamp.startswith('20'):
-                    logging.warn('Skipped a line because it does not appear to start with a date: "%s".', line)
-                    continue
-                columns = line[24:].split(delimiter, maxsplit)
-                if len(columns) < self.column_count:
-                    logging.warn('Skipped a line because it does not have a sufficient number of columns: "%s".', line)
-                    continue
-                level = self._read_log_level(columns, level_column_index)
-                flow_id = self._read_flow_id(columns, flow_id_column_index)
-                thread = self._read_thread(columns, thread_column_index)
-                class_, method, source_file, line_number = self._read_code_position(columns, location_column_index)
-                message = self._read_message(columns, message_column_index, logfile)
-            except Exception:  #pragma: nocover
-                # This shouldn't actually be possible.
-                logging.exception('Failed to parse line "%s" of %s', line, reader_id)
-            else:
-                yield LogEntry(
-                    reader_id=reader_id,
-                    timestamp=timestamp,
-                    entry_number=entry_number,
-                    flow_id=flow_id,
-                    level=level,
-                    thread=thread,
-                    class_=class_,
-                    method=method,
-                    source_file=source_file,
-                    line=line_number,
-                    message=message,
-                )
-            entry_number += 1
+        delimiter = self.delimiter
+        maxsplit = self.column_count - 1
+        level_column_index = self.level_column_index
+        read_log_level = self._read_log_level
+
+        def extract_level(line):
+            if line.count(delimiter, 24) < maxsplit:
+                return None
+            return read_log_level(line[24:].split(delimiter, level_column_index + 1), level_column_index)
+
+        return extract_level
+
+    def intern_entry(self, entry):
+        """
+        Returns the given LogEntry with its fields interned in the parser's symbol tables. Used for entries that were
+        parsed by another parser, for example in a worker process.
+        """
+
+        return entry._replace(
+            thread=self.thread_symbols.intern(entry.thread),
+            class_=self.class_symbols.intern(entry.class_),
+            method=self.method_symbols.intern(entry.method),
+            source_file=self.source_file_symbols.intern(entry.source_file),
+        )
 
     def get_time_string(self, line):
         if self.is_continuation_line(line):
@@ -168,6 +588,17 @@ class Log4jParser(object):
         else:
             return line[:23]
 
+    def get_time(self, line):
+        """
+        Returns the time of the given first line of an entry in milliseconds since the epoch, or None if the line does
+        not start with a valid timestamp.
+        """
+
+        try:
+            return self.time_converter.to_millis(self.get_time_string(line))
+        except ValueError:
+            return None
+
     def _read_log_level(self, columns, index):
         return LogLevel.FROM_FIRST_LETTER.get(columns[index].lstrip('[')[:1], LogLevel.FATAL)
 
@@ -196,19 +627,205 @@ class Log4jParser(object):
         source_file, _, line_number = file_and_line_number.partition(':')
         return class_, method, source_file, try_parsing_int(line_number, default=-1)
 
-    def _read_message(self, columns, index, logfile):
-        lines = [columns[index]]
-        while True:
-            l = logfile.readline()
-            if self.is_continuation_line(l):
-                lines.append(l)
-            else:
-                logfile.seek(-len(l), os.SEEK_CUR)
-                return ''.join(lines).rstrip()
-
     def is_continuation_line(self, line):
         return line and not (line.startswith('20') and line[23:24] == ' ')
 
+    def is_entry_start(self, buffer, offset):
+        """Checks whether the line starting at the given offset of buffer is the first line of an entry."""
+
+        return (buffer[offset:offset + 2] == '20' and buffer[offset + 23:offset + 24] == ' '
+                and buffer.find('\n', offset, offset + 23) == -1)
+
+    def find_entry_start(self, buffer, offset):
+        """Returns the offset of the first line at or after the given offset of buffer that starts an entry, or -1."""
+
+        if offset == 0 and self.is_entry_start(buffer, 0):
+            return 0
+        position = buffer.find('\n20', max(offset - 1, 0))
+        while position != -1 and not self.is_entry_start(buffer, position + 1):
+            position = buffer.find('\n20', position + 1)
+        return -1 if position == -1 else position + 1
+
+
+class PatternLayoutParser(Log4jParser):
+
+    """
+    Parses log files whose layout is given by an explicit log4j or logback conversion pattern, for example
+    "%d %x %p %t %l: %m%n" or "%d [%t] %-5p %c - %m%n". The pattern is compiled into a regular expression and a
+    function that extracts exactly the fields the layout contains, so no autoconfiguration is necessary.
+
+    The pattern has to start with an ISO8601 date (%d) followed by a space.
+    """
+
+    CONVERSION_PATTERN = re.compile(r'%(-?)(\d*)(?:\.\d+)?([a-zA-Z]+|%)(?:\{([^}]*)\})?')
+    DATE_FORMATS = (None, 'ISO8601', 'yyyy-MM-dd HH:mm:ss,SSS', 'yyyy-MM-dd HH:mm:ss.SSS')
+
+    FIELD_BY_CONVERSION = {
+        'x': 'flow_id', 'X': 'flow_id', 'mdc': 'flow_id',
+        'p': 'level', 'le': 'level', 'level': 'level',
+        't': 'thread', 'thread': 'thread',
+        'c': 'class_', 'lo': 'class_', 'logger': 'class_', 'C': 'class_', 'class': 'class_',
+        'M': 'method', 'method': 'method',
+        'F': 'source_file', 'file': 'source_file',
+        'L': 'line', 'line': 'line',
+        'l': 'location',
+        'm': 'message', 'msg': 'message', 'message': 'message',
+    }
+
+    FIELD_REGEX = {
+        'thread': r'.*?',
+        'level': r'\S+?',
+        'class_': r'\S*',
+        'message': r'.*',
+    }
+
+    def __init__(self, pattern, block_size=None, lazy=False, timezone=None):
+        Log4jParser.__init__(self, block_size=block_size, lazy=lazy, timezone=timezone)
+        self.pattern = pattern
+        self._extractor = self._compile_pattern(pattern)
+
+    def __getstate__(self):
+        # The generated extraction function cannot be pickled, so it is compiled again when the parser is unpickled.
+        state = self.__dict__.copy()
+        del state['_extractor']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._extractor = self._compile_pattern(self.pattern)
+
+    def autoconfigure(self, logfile):
+        """The layout is given by the pattern, so there is nothing to configure."""
+
+    def _compile_extractor(self):
+        return self._extractor
+
+    def _compile_level_extractor(self):
+        # The line has to be matched against the whole layout anyway, so only the conversion of the other fields is
+        # deferred.
+        extract = self._extractor
+
+        def extract_level(line):
+            fields = extract(line)
+            return None if fields is None else fields[1]
+
+        return extract_level
+
+    def _compile_pattern(self, pattern):
+        """Compiles the conversion pattern into an extraction function. Raises ValueError for unsupported patterns."""
+
+        date_match = self.CONVERSION_PATTERN.match(pattern)
+        if not date_match or date_match.group(3) not in ('d', 'date') or date_match.group(4) not in self.DATE_FORMATS:
+            raise ValueError('The pattern "{0}" does not start with an ISO8601 date (%d).'.format(pattern))
+        if not pattern.startswith(' ', date_match.end()):
+            raise ValueError('The date in the pattern "{0}" is not followed by a space.'.format(pattern))
+
+        # The regular expression is matched against the line from the end of the date onwards.
+        regex_parts = []
+        group_by_field = {}
+        group_count = 0
+        position = date_match.end()
+        for match in self.CONVERSION_PATTERN.finditer(pattern, position):
+            regex_parts.append(self._literal_regex(pattern[position:match.start()]))
+            position = match.end()
+            left_aligned, width, conversion = match.group(1, 2, 3)
+            if conversion == '%':
+                regex_parts.append('%')
+                continue
+            if conversion == 'n':
+                continue
+            field = self.FIELD_BY_CONVERSION.get(conversion)
+            field_regex = '({0})'.format(self.FIELD_REGEX.get(field, r'\S*?'))
+            if width:
+                field_regex = field_regex + ' *' if left_aligned else ' *' + field_regex
+            regex_parts.append(field_regex)
+            group_count += 1
+            if field and field not in group_by_field:
+                group_by_field[field] = group_count
+        regex_parts.append(self._literal_regex(pattern[position:]))
+
+        # The first line of an entry still has its line terminator if the file is read line by line.
+        return self._generate_extractor(pattern, re.compile(''.join(regex_parts), re.DOTALL), group_by_field)
+
+    def _literal_regex(self, literal):
+        # logback requires parentheses in literal text to be escaped with backslashes.
+        return re.escape(re.sub(r'\\(.)', r'\1', literal))
+
+    def _generate_extractor(self, pattern, regex, group_by_field):
+        """
+        Generates the source code of an extraction function that reads exactly the groups of the given regular
+        expression that the layout contains, and compiles it.
+        """
+
+        def group(field, default):
+            if field in group_by_field:
+                return 'group({0})'.format(group_by_field[field])
+            else:
+                return default
+
+        def interned_group(field, default):
+            expression = group(field, default)
+            if expression in ('None', "''"):
+                return expression
+            return 'intern_{0}({1})'.format(field.rstrip('_'), expression)
+
+        source = [
+            'def extract(line):',
+            '    match = match_head(line, 23)',
+            '    if match is None:',
+            '        return None',
+            '    group = match.group',
+        ]
+        if 'location' in group_by_field:
+            source.append('    class_, method, source_file, line_number = split_code_position({0})'.format(
+                group('location', None)))
+            location_defaults = 'class_', 'method', 'source_file', 'line_number'
+        else:
+            location_defaults = "''", "''", "''", '-1'
+
+        if 'level' in group_by_field:
+            level = "level_from_first_letter({0}.lstrip('[')[:1], FATAL)".format(group('level', None))
+        else:
+            level = 'INFO'
+        if 'line' in group_by_field:
+            line_number = 'try_parsing_int({0}, -1)'.format(group('line', None))
+        else:
+            line_number = location_defaults[3]
+
+        source.append('    return ({0},)'.format(', '.join([
+            group('flow_id', 'None'),
+            level,
+            interned_group('thread', 'None'),
+            interned_group('class_', location_defaults[0]),
+            interned_group('method', location_defaults[1]),
+            interned_group('source_file', location_defaults[2]),
+            line_number,
+            group('message', "''"),
+        ])))
+
+        namespace = {
+            'match_head': regex.match,
+            'split_code_position': self._split_code_position,
+            'level_from_first_letter': LogLevel.FROM_FIRST_LETTER.get,
+            'try_parsing_int': try_parsing_int,
+            'FATAL': LogLevel.FATAL,
+            'INFO': LogLevel.INFO,
+            'intern_thread': self.thread_symbols.intern,
+            'intern_class': self.class_symbols.intern,
+            'intern_method': self.method_symbols.intern,
+            'intern_source_file': self.source_file_symbols.intern,
+        }
+        exec compile('\n'.join(source), '<pattern {0}>'.format(pattern), 'exec') in namespace
+        return namespace['extract']
+
+
+def estimate_entry_size(entry):
+    """Returns about how many bytes of memory the entry takes up."""
+
+    # The raw text of a LazyLogEntry that has not been decoded yet stands in for its message, so that it stays lazy.
+    raw = getattr(entry, '_raw', None)
+    return ENTRY_SIZE + len(raw if raw is not None else entry.message)
+
 
 def try_parsing_int(string, default=None):
     try:
@@ -217,6 +834,16 @@ def try_parsing_int(string, default=None):
         return default
 
 
+def parse_duration(string):
+    """Parses a duration like "2s", "500ms", "1m" or "1.5" (seconds). Returns the duration in milliseconds."""
+
+    match = re.match(r'^([0-9]+(?:\.[0-9]*)?)(ms|s|m)?$', string.strip())
+    if not match:
+        raise ArgumentTypeError('invalid duration: %r' % string)
+    number, unit = match.groups()
+    return int(float(number) * {'ms': 1, 's': 1000, 'm': 60000}[unit or 's'])
+
+
 class Watcher:
 
     """this class solves two problems with multithreaded
@@ -265,38 +892,382 @@ class Watcher:
 
 class OrderedLogAggregator(object):
 
+    """
+    Passes on the entries of all readers ordered by time. The entries are kept in sorted runs, one per batch a reader
+    has handed over, and the runs are merged through a heap of their first entries, so that taking out an entry only
+    costs a heap operation over the runs instead of over all entries. The rest of each run is found by the ID of its
+    first entry. The heap is shared by the reader threads and the output thread and is therefore only changed while
+    holding the lock of condition.
+
+    Every open file has a watermark: its reader will not hand over entries older than that. An entry is only passed on
+    once it is older than the lowest watermark of the open files, so that a reader that lags behind cannot hand over an
+    entry that should have been passed on before. A file's watermark is minus infinity until its reader has advanced
+    it for the first time. While there is no entry to pass on, get() waits until entries are added, a watermark is
+    advanced or a file is done.
+    """
+
     def __init__(self, file_names):
-        self.entries = []
+        self.entries = []  # heap of the first entries of the runs
+        self.runs = {}  # ID of the first entry of a run -> iterator over the other entries of the run
+        self.entry_count = 0
         self.file_names = file_names
         self.open_files = set(range(len(file_names)))
+        self.watermarks = dict.fromkeys(self.open_files, float('-inf'))
+        self.low_watermark = float('-inf') if self.open_files else float('inf')
+        self.lock = Lock()
+        self.condition = Condition(self.lock)
 
     def add(self, entry):
-        heapq.heappush(self.entries, entry)
+        with self.condition:
+            heapq.heappush(self.entries, entry)
+            self.entry_count += 1
+            self.condition.notify()
+
+    def add_batch(self, entries):
+        """
+        Adds the entries a reader has handed over at once as a run. The entries of a file are (nearly) ordered by time
+        already, so sorting them is cheap.
+        """
+
+        if not entries:
+            return
+        run = iter(sorted(entries))
+        first_entry = next(run)
+        with self.condition:
+            heapq.heappush(self.entries, first_entry)
+            if id(first_entry) in self.runs:
+                # The same object already starts another run, so the entries cannot form a run of their own.
+                for entry in run:
+                    heapq.heappush(self.entries, entry)
+            else:
+                self.runs[id(first_entry)] = run
+            self.entry_count += len(entries)
+            self.condition.notify()
+
+    def register(self, fid, name=None, watermark=float('-inf')):
+        """
+        Adds fid to the open files. If name is given, it becomes the file name of fid. Sources that do not hand over
+        entries themselves pass an infinite watermark, so that they do not hold back the entries of the others.
+        """
+
+        with self.condition:
+            if name is not None:
+                if fid == len(self.file_names):
+                    self.file_names.append(name)
+                else:
+                    self.file_names[fid] = name
+            self.open_files.add(fid)
+            self.watermarks[fid] = watermark
+            self._update_low_watermark()
+
+    def advance(self, fid, watermark):
+        """Sets the watermark of fid: its reader will not hand over entries older than watermark any more."""
+
+        with self.condition:
+            if fid in self.open_files:
+                self.watermarks[fid] = watermark
+                self._update_low_watermark()
 
     def eof(self, fid):
-        self.open_files.remove(fid)
+        with self.condition:
+            self.open_files.remove(fid)
+            del self.watermarks[fid]
+            self._update_low_watermark()
+            # get() also has to be woken up if the low watermark stays the same, as it may be done now.
+            self.condition.notify()
+
+    def can_pass_on(self):
+        """
+        Returns whether get() can pass on queued entries without waiting for the readers. Otherwise, the queue does not
+        shrink until the entries or watermarks it waits for have been handed over, so readers must not pause for it.
+        """
+
+        with self.condition:
+            return self._can_pass_on()
+
+    def _can_pass_on(self):
+        heap = self.entries
+        return bool(heap) and (not self.open_files or heap[0].time < self.low_watermark)
+
+    def _update_low_watermark(self):
+        low_watermark = min(self.watermarks.itervalues()) if self.watermarks else float('inf')
+        if low_watermark != self.low_watermark:
+            self.low_watermark = low_watermark
+            self.condition.notify()
 
     def __len__(self):
-        return len(self.entries)
+        return self.entry_count
 
     def get(self):
-        while self.open_files or self.entries:
-            try:
-                yield heapq.heappop(self.entries)
-            except IndexError:
-                pass
+        heappop = heapq.heappop
+        heapreplace = heapq.heapreplace
+        condition = self.condition
+        heap = self.entries
+        runs = self.runs
+        while True:
+            with condition:
+                # Once all files are done, the remaining entries are passed on regardless of their times.
+                while not self._can_pass_on():
+                    if not heap and not self.open_files:
+                        return
+                    condition.wait()
+                entry = heap[0]
+                run = runs.pop(id(entry), None) if runs else None
+                next_entry = next(run, None) if run is not None else None
+                if next_entry is None:
+                    heappop(heap)
+                else:
+                    heapreplace(heap, next_entry)
+                    runs[id(next_entry)] = run
+                self.entry_count -= 1
+            yield entry
+
+
+class MergingLogAggregator(OrderedLogAggregator):
+
+    """
+    Passes on the entries of all readers ordered by time by merging the files, each of which is ordered by time
+    already. Every file has a queue of its own, and only the first entries of the queues are kept in the heap, so that
+    the heap holds at most one entry per file. The first entry of the heap is passed on once it is older than the
+    watermark of every open file whose queue is empty, as only those files may still hand over an earlier entry.
+
+    A reader that hands over entries while the queue of its file holds buffer_size entries waits until the queue has
+    been drained below that, so that the memory used grows with the number of files rather than with their size. It
+    does not wait while the merge itself is waiting for another file, which might be read by the same thread. The
+    queues are created by make_queue, which can also return spill queues that move entries to disk instead.
+    """
+
+    BUFFER_SIZE = 16 * 1024  # entries per file
+
+    def __init__(self, file_names, buffer_size=None, make_queue=collections.deque):
+        OrderedLogAggregator.__init__(self, file_names)
+        self.queues = {}  # file ID -> queue of the entries of the file
+        self.buffer_size = buffer_size or self.BUFFER_SIZE
+        self.make_queue = make_queue
+        self.not_full = Condition(self.lock)
+
+    def add(self, entry):
+        self.add_batch([entry])
+
+    def add_batch(self, entries):
+        if not entries:
+            return
+        entries = sorted(entries)
+        fid = entries[0].reader_id
+        with self.lock:
+            queue = self.queues.get(fid)
+            if queue is None:
+                queue = self.queues[fid] = self.make_queue()
+            while len(queue) >= self.buffer_size and self._can_pass_on():
+                self.not_full.wait()
+            queue.extend(entries)
+            self.entry_count += len(entries)
+            if len(queue) == len(entries):
+                heapq.heappush(self.entries, queue[0])
+                self._update_low_watermark()
+            self.condition.notify()
+
+    def _update_low_watermark(self):
+        queues = self.queues
+        watermarks = [watermark for fid, watermark in self.watermarks.iteritems() if not queues.get(fid)]
+        low_watermark = min(watermarks) if watermarks else float('inf')
+        if low_watermark != self.low_watermark:
+            self.low_watermark = low_watermark
+            self.condition.notify()
+
+    def get(self):
+        heappop = heapq.heappop
+        heapreplace = heapq.heapreplace
+        condition = self.condition
+        heap = self.entries
+        queues = self.queues
+        full_queue_length = self.buffer_size - 1
+        while True:
+            with condition:
+                while not self._can_pass_on():
+                    if not heap and not self.open_files:
+                        return
+                    # Readers that wait for their queues to be drained would otherwise wait for each other.
+                    self.not_full.notify_all()
+                    condition.wait()
+                entry = heap[0]
+                queue = queues[entry.reader_id]
+                queue.popleft()
+                if queue:
+                    heapreplace(heap, queue[0])
+                else:
+                    heappop(heap)
+                    self._update_low_watermark()
+                self.entry_count -= 1
+                if len(queue) == full_queue_length:
+                    self.not_full.notify_all()
+            yield entry
+
+
+class ReorderingLogAggregator(object):
+
+    """
+    Passes on the entries of all readers ordered by time within a window of max_lateness milliseconds, so that
+    following many files neither stalls on the slowest file nor mixes up the order of entries that arrive close
+    together. The entries are kept in buckets of BUCKET_SIZE milliseconds. A bucket is passed on, sorted, once the
+    newest entry is more than max_lateness newer than the bucket, or once the first entry of the bucket has waited
+    for max_lateness, whichever comes first. The earlier buckets are passed on before it, so that entries wait for at
+    most max_lateness and the buffer only holds as many entries as arrive in that time.
+
+    Entries that arrive after their bucket has been passed on are late. Depending on late_policy, they are passed on
+    right away ("emit"), passed on with LATE_TAG in front of their message ("tag") or dropped ("drop").
+    """
+
+    BUCKET_SIZE = 100  # milliseconds
+    LATE_POLICIES = 'emit', 'tag', 'drop'
+    LATE_TAG = '[late] '
+
+    def __init__(self, file_names, max_lateness, late_policy='emit'):
+        assert late_policy in self.LATE_POLICIES, 'Unknown late policy: %s' % late_policy
+        self.buckets = {}  # time // BUCKET_SIZE -> entries
+        self.bucket_keys = []  # heap of the keys of buckets
+        self.arrival_timestamps = {}  # key of a bucket -> time its first entry arrived, in seconds
+        self.ready_entries = collections.deque()  # entries that are passed on next
+        self.max_lateness = max_lateness
+        self.late_policy = late_policy
+        self.newest_time = float('-inf')
+        self.last_passed_on_key = float('-inf')
+        self.entry_count = 0
+        self.late_entry_count = 0
+        self.file_names = file_names
+        self.open_files = set(range(len(file_names)))
+        self.condition = Condition(Lock())
+
+    def add(self, entry):
+        self.add_batch([entry])
+
+    def add_batch(self, entries):
+        if not entries:
+            return
+        bucket_size = self.BUCKET_SIZE
+        buckets = self.buckets
+        current_timestamp = time.time()
+        with self.condition:
+            for entry in entries:
+                key = entry.time // bucket_size
+                bucket = buckets.get(key)
+                if bucket is None:
+                    if key <= self.last_passed_on_key:
+                        self._add_late_entry(entry)
+                        continue
+                    bucket = buckets[key] = []
+                    heapq.heappush(self.bucket_keys, key)
+                    self.arrival_timestamps[key] = current_timestamp
+                bucket.append(entry)
+                self.entry_count += 1
+            self.newest_time = max(self.newest_time, max(entry.time for entry in entries))
+            self.condition.notify()
+
+    def _add_late_entry(self, entry):
+        self.late_entry_count += 1
+        if self.late_policy == 'drop':
+            return
+        if self.late_policy == 'tag':
+            if isinstance(entry, LazyLogEntry):
+                entry = entry.to_entry()
+            entry = entry._replace(message=self.LATE_TAG + entry.message)
+        self.ready_entries.append(entry)
+        self.entry_count += 1
+
+    def register(self, fid, name=None, watermark=None):
+        """Adds fid to the open files. If name is given, it becomes the file name of fid. The watermark is ignored."""
+
+        with self.condition:
+            if name is not None:
+                if fid == len(self.file_names):
+                    self.file_names.append(name)
+                else:
+                    self.file_names[fid] = name
+            self.open_files.add(fid)
+
+    def advance(self, fid, watermark):
+        """Does nothing, as the entries are only held back for max_lateness."""
+
+    def eof(self, fid):
+        with self.condition:
+            self.open_files.remove(fid)
+            self.condition.notify()
+
+    def __len__(self):
+        return self.entry_count
+
+    def _pass_on_due_buckets(self, current_timestamp):
+        """
+        Moves the buckets that are due to the ready entries. Returns the number of seconds until the next bucket is
+        due, or None if there are no buckets.
+        """
+
+        bucket_keys = self.bucket_keys
+        max_lateness = self.max_lateness
+        # Once all files are done, no entry can arrive late any more.
+        event_time_watermark = self.newest_time - max_lateness if self.open_files else float('inf')
+        due_key = None
+        for key in bucket_keys:
+            if due_key is not None and key <= due_key:
+                continue
+            if (key + 1) * self.BUCKET_SIZE <= event_time_watermark or \
+                    current_timestamp - self.arrival_timestamps[key] >= max_lateness / 1000.0:
+                due_key = key
+        if due_key is not None:
+            while bucket_keys and bucket_keys[0] <= due_key:
+                key = heapq.heappop(bucket_keys)
+                del self.arrival_timestamps[key]
+                self.ready_entries.extend(sorted(self.buckets.pop(key)))
+            self.last_passed_on_key = max(self.last_passed_on_key, due_key)
+        if not bucket_keys:
+            return None
+        return min(self.arrival_timestamps.itervalues()) + max_lateness / 1000.0 - current_timestamp
+
+    def get(self):
+        condition = self.condition
+        ready_entries = self.ready_entries
+        while True:
+            with condition:
+                while not ready_entries:
+                    timeout = self._pass_on_due_buckets(time.time())
+                    if ready_entries:
+                        break
+                    if timeout is None and not self.open_files:
+                        return
+                    condition.wait(timeout)
+                entry = ready_entries.popleft()
+                self.entry_count -= 1
+            yield entry
 
 
 class NonOrderedLogAggregator(object):
 
-    def __init__(self, file_names):
-        self.entries = collections.deque()
+    """Passes on the entries in the order they are added. The entries are kept in queue, a deque by default."""
+
+    def __init__(self, file_names, queue=None):
+        self.entries = queue if queue is not None else collections.deque()
         self.file_names = file_names
         self.open_files = set(range(len(file_names)))
 
     def add(self, entry):
         self.entries.append(entry)
 
+    def add_batch(self, entries):
+        self.entries.extend(entries)
+
+    def register(self, fid, name=None, watermark=None):
+        """Adds fid to the open files. If name is given, it becomes the file name of fid. The watermark is ignored."""
+
+        if name is not None:
+            if fid == len(self.file_names):
+                self.file_names.append(name)
+            else:
+                self.file_names[fid] = name
+        self.open_files.add(fid)
+
+    def advance(self, fid, watermark):
+        """Does nothing, as the entries are passed on in the order they are added."""
+
     def eof(self, fid):
         self.open_files.remove(fid)
 
@@ -311,6 +1282,222 @@ class NonOrderedLogAggregator(object):
                 return
 
 
+class ProcessReceiver(object):
+
+    """
+    The receiver of the readers in a ReaderProcess. The entries the readers hand over are written to ring column by
+    column, as in a LogEntryBatch, so that the main process can create entries from them without unpickling each one.
+    Lazy entries are passed on as their raw text; entries whose fields have been decoded already, for example by the
+    grep filter, are marshalled. The parser of a file is pickled once, along with its first entries, as the main process
+    needs the extractor of the autoconfigured parser to decode lazy entries. Watermarks and the ends of files are passed
+    on as well. The length of the queue of the aggregator and whether it can pass on its entries are read from
+    queue_length and passing_on, which the main process updates.
+    """
+
+    def __init__(self, ring, queue_length, passing_on):
+        self.ring = ring
+        self.queue_length = queue_length
+        self.passing_on = passing_on
+        self.parsers = {}  # reader ID -> parser of the reader
+        self.sent_parsers = set()
+        # Records that are larger than this are split, so that the writer does not wait for the whole ring to drain.
+        self.max_record_size = ring.size // 4
+
+    def add_parser(self, fid, parser):
+        self.parsers[fid] = parser
+
+    def add(self, entry):
+        self.add_batch([entry])
+
+    def add_batch(self, entries):
+        if not entries:
+            return
+        fid = entries[0].reader_id
+        if fid not in self.sent_parsers:
+            self.sent_parsers.add(fid)
+            self._write(PARSER_RECORD, fid, pickle.dumps(self.parsers[fid], pickle.HIGHEST_PROTOCOL))
+        self._write_entries(fid, entries)
+
+    def advance(self, fid, watermark):
+        self._write(WATERMARK_RECORD, fid, WATERMARK.pack(watermark))
+
+    def eof(self, fid):
+        self._write(EOF_RECORD, fid, '')
+
+    def can_pass_on(self):
+        return bool(self.passing_on.value)
+
+    def __len__(self):
+        return self.queue_length.value
+
+    def _write_entries(self, fid, entries):
+        data = self._encode_entries(entries)
+        if len(data) > self.max_record_size and len(entries) > 1:
+            middle = len(entries) // 2
+            self._write_entries(fid, entries[:middle])
+            self._write_entries(fid, entries[middle:])
+        else:
+            self._write(ENTRIES_RECORD, fid, data)
+
+    def _encode_entries(self, entries):
+        """
+        Returns the number of entries, followed by their times, entry numbers, log level priorities, kinds (RAW_ENTRY or
+        DECODED_ENTRY) and text offsets, and finally their texts.
+        """
+
+        times = array.array(TIME_TYPECODE)
+        entry_numbers = array.array('l')
+        levels = bytearray()
+        kinds = bytearray()
+        offsets = array.array('l', [0])
+        texts = []
+        offset = 0
+        for entry in entries:
+            # Plain LogEntry tuples have no raw text, and that of a LazyLogEntry is dropped once it has been decoded.
+            text = getattr(entry, '_raw', None)
+            if text is None:
+                text = marshal.dumps((entry.timestamp, entry.flow_id, entry.thread, entry.class_, entry.method,
+                                      entry.source_file, entry.line, entry.message))
+                kinds.append(DECODED_ENTRY)
+            else:
+                kinds.append(RAW_ENTRY)
+            times.append(entry.time)
+            entry_numbers.append(entry.entry_number)
+            levels.append(entry.level.priority)
+            offset += len(text)
+            offsets.append(offset)
+            texts.append(text)
+        return ''.join([ENTRY_COUNT.pack(len(entries)), times.tostring(), entry_numbers.tostring(), str(levels),
+                        str(kinds), offsets.tostring()] + texts)
+
+    def _write(self, record_type, fid, data):
+        self.ring.write(RING_RECORD_HEADER.pack(record_type, fid) + data)
+
+
+class RingReaderThread(Thread):
+
+    """
+    Passes the entries, watermarks and ends of files that a ReaderProcess writes to its ring on to the aggregator, and
+    keeps the state of the queue that the readers of the process see up to date. Stops once all files of the process
+    are done. If the process dies before, its remaining files are ended, so that the entries of the other files are not
+    held back.
+    """
+
+    POLL_INTERVAL = 1  # seconds
+
+    def __init__(self, process, aggregator):
+        Thread.__init__(self, name='RingReaderThread-%s' % process.name)
+        self.daemon = True
+        self.process = process
+        self.aggregator = aggregator
+        self.open_files = set(process.reader_ids)
+        self.parsers = {}  # reader ID -> parser unpickled from the process
+        self.extractors = {}  # reader ID -> field extractor of that parser
+        can_pass_on = getattr(aggregator, 'can_pass_on', None)
+        self.can_pass_on = can_pass_on or (lambda: True)
+
+    def run(self):
+        ring = self.process.ring
+        while self.open_files:
+            record = ring.read(self.POLL_INTERVAL)
+            if record is not None:
+                self.handle(record)
+            elif not self.process.is_alive() and not len(ring):
+                logging.error('The reader process %s has exited before its files were done.', self.process.name)
+                for fid in self.open_files:
+                    self.aggregator.eof(fid)
+                self.open_files.clear()
+            # The queue also changes while the process does not write to the ring, as its entries are output.
+            self.process.queue_length.value = len(self.aggregator)
+            self.process.passing_on.value = self.can_pass_on()
+
+    def handle(self, record):
+        record_type, fid = RING_RECORD_HEADER.unpack_from(record)
+        if record_type == ENTRIES_RECORD:
+            self.aggregator.add_batch(self._decode_entries(fid, record, RING_RECORD_HEADER.size))
+        elif record_type == WATERMARK_RECORD:
+            self.aggregator.advance(fid, WATERMARK.unpack_from(record, RING_RECORD_HEADER.size)[0])
+        elif record_type == EOF_RECORD:
+            self.aggregator.eof(fid)
+            self.open_files.discard(fid)
+        elif record_type == PARSER_RECORD:
+            parser = self.parsers[fid] = pickle.loads(record[RING_RECORD_HEADER.size:])
+            self.extractors[fid] = parser._compile_extractor()
+        else:
+            raise ValueError('Unknown record type: %r' % record_type)
+
+    def _decode_entries(self, fid, record, position):
+        """Returns the entries encoded by ProcessReceiver._encode_entries() at position in record."""
+
+        entry_count = ENTRY_COUNT.unpack_from(record, position)[0]
+        position += ENTRY_COUNT.size
+        columns = []
+        for typecode, length in ((TIME_TYPECODE, entry_count), ('l', entry_count), ('B', entry_count),
+                                 ('B', entry_count), ('l', entry_count + 1)):
+            column = array.array(typecode)
+            end = position + length * column.itemsize
+            column.fromstring(record[position:end])
+            columns.append(column)
+            position = end
+        times, entry_numbers, levels, kinds, offsets = columns
+        text_start = position
+
+        # Performance!
+        extract, by_priority = self.extractors[fid], LogLevel.BY_PRIORITY
+        intern_entry = self.parsers[fid].intern_entry
+
+        entries = []
+        for index in xrange(entry_count):
+            text = record[text_start + offsets[index]:text_start + offsets[index + 1]]
+            if kinds[index] == RAW_ENTRY:
+                entries.append(LazyLogEntry(times[index], fid, entry_numbers[index], text[:23],
+                                            by_priority[levels[index]], text, extract))
+            else:
+                timestamp, flow_id, thread, class_, method, source_file, line, message = marshal.loads(text)
+                entries.append(intern_entry(LogEntry(times[index], fid, entry_numbers[index], timestamp, flow_id,
+                                                     by_priority[levels[index]], thread, class_, method, source_file,
+                                                     line, message)))
+        return entries
+
+
+class ReaderProcess(multiprocessing.Process):
+
+    """
+    Reads the files with the given reader IDs in a process of its own, so that parsing them does not compete with the
+    other readers and the output for the GIL of the main process. start_readers(receiver) is called in the new process;
+    it has to start the readers of the files with receiver, a ProcessReceiver, and return their threads. The entries
+    are passed to the main process through a SharedRing of ring_size bytes, from which a RingReaderThread takes them.
+
+    The process has to be started before any threads, and it exits when the main process does.
+    """
+
+    RING_SIZE = 16 * 1024 * 1024  # bytes
+    PARENT_CHECK_INTERVAL = 1  # seconds
+
+    def __init__(self, reader_ids, start_readers, ring_size=None):
+        multiprocessing.Process.__init__(self)
+        self.daemon = True
+        self.reader_ids = reader_ids
+        self.start_readers = start_readers
+        self.ring = SharedRing(ring_size or self.RING_SIZE)
+        self.queue_length = multiprocessing.RawValue('l', 0)
+        self.passing_on = multiprocessing.RawValue('b', 1)
+
+    def run(self):
+        parent_watch = Thread(target=self._exit_with_parent, args=(os.getppid(),), name='ParentWatch')
+        parent_watch.daemon = True
+        parent_watch.start()
+        receiver = ProcessReceiver(self.ring, self.queue_length, self.passing_on)
+        for thread in self.start_readers(receiver):
+            thread.join()
+
+    def _exit_with_parent(self, parent_pid):
+        # The main process may be killed (see Watcher), which would leave the readers of this process running.
+        while os.getppid() == parent_pid:
+            time.sleep(self.PARENT_CHECK_INTERVAL)
+        os._exit(1)
+
+
 COLORS = [
     '\033[31m',
     '\033[32m',
@@ -453,6 +1640,43 @@ def main():
     parser.add_argument('-l', '--levels', help='only show log entries with log level(s)')
     parser.add_argument('-g', '--grep', metavar='PATTERN', help='only show log entries matching pattern')
     parser.add_argument('--time-to', metavar='DATETIME', help='only show log entries until DATETIME')
+    parser.add_argument('--timezone', metavar='TZ',
+                        help='timezone of the timestamps in the log files and of --time-from and --time-to, as offset '
+                             'from UTC (e.g. "+02:00") or "local" (default UTC)')
+    parser.add_argument('--pattern', help='log4j conversion pattern of the log files (e.g. "%%d [%%t] %%-5p %%c - %%m%%n")')
+    parser.add_argument('-j', '--jobs', type=int, default=1, metavar='N',
+                        help='parse static files in N processes (not applicable with --follow)')
+    parser.add_argument('--index-prefix', metavar='PATH',
+                        help='store the seek indexes of gzip files and the time indexes of all files at PATH '
+                             '(defaults to the sincedb path)')
+    parser.add_argument('--reader-threads', type=int, default=0, metavar='N',
+                        help='read all files in N threads (default: one thread per file)')
+    parser.add_argument('--reader-processes', type=int, default=0, metavar='N',
+                        help='read the files in N processes besides the one that merges and outputs the entries')
+    parser.add_argument('--idle-timeout', type=int, metavar='SECONDS',
+                        help='stop following files found by a glob or in a directory after SECONDS without new entries')
+    parser.add_argument('--overflow-policy', choices=LogReader.OVERFLOW_POLICIES,
+                        help='when the queue of entries to output is full, suppress TRACE, DEBUG and INFO entries, '
+                             'block the readers until the queue has shrunk, or sample the entries below WARN '
+                             '(default: suppress, or block with --spill-dir)')
+    parser.add_argument('--queue-limit', type=int, default=LogReader.QUEUE_LIMIT, metavar='N',
+                        help='number of queued entries at which the overflow policy applies (default: %(default)s)')
+    parser.add_argument('--merge-buffer', type=int, default=MergingLogAggregator.BUFFER_SIZE, metavar='N',
+                        help='buffer up to N entries per file while merging the files by time, pausing readers that '
+                             'are ahead (0 to buffer all entries; default: %(default)s)')
+    parser.add_argument('--max-lateness', type=parse_duration, metavar='DURATION',
+                        help='when following the files, instead of merging them strictly by time, hold entries back '
+                             'for at most DURATION (e.g. "2s" or "500ms") to put them in order')
+    parser.add_argument('--late-entries', choices=ReorderingLogAggregator.LATE_POLICIES, default='emit',
+                        help='output entries that arrive after --max-lateness anyway, tag them as late, or drop them '
+                             '(default: emit)')
+    parser.add_argument('--spill-dir', metavar='PATH',
+                        help='once the queued entries take up more than --memory-budget, write further entries to '
+                             'files in PATH instead of pausing or dropping them')
+    parser.add_argument('--memory-budget', type=int, default=256, metavar='MB',
+                        help='memory for queued entries before they are written to --spill-dir (default: 256 MB)')
+    parser.add_argument('--batch-size', type=int, default=1024, metavar='N',
+                        help='filter and pass on entries in batches of N entries (0 to pass them on one by one)')
     parser.add_argument('--redis-host', help='redis host')
     parser.add_argument('--redis-port', type=int, default=6379, help='redis port')
     parser.add_argument('--redis-namespace', help='redis namespace')
@@ -490,7 +1714,7 @@ def main():
         if not args.files:
             file_names = merged_config['files']
 
-    filterdef = LogFilter()
+    filterdef = LogFilter(time_converter=TimeConverter(args.timezone))
     filterdef.grep = args.grep
     filterdef.time_from = args.time_from
     filterdef.time_to = args.time_to
@@ -504,41 +1728,174 @@ def main():
     if args.tail:
         tail_lines = int(args.tail_lines)
 
-    used_file_names = set()
-    if args.redis_host:
-        aggregator = NonOrderedLogAggregator(file_names)
-    else:
-        aggregator = OrderedLogAggregator(file_names)
-    readers = []
-    fid = 0
+    # Files that are not followed end, so strict ordering does not wait long for any of them. Reading a backlog takes
+    # longer than the lateness, though, which would pass on entries before slower files have caught up.
+    if args.max_lateness is not None and not args.follow:
+        parser.error('--max-lateness requires --follow')
+
+    if args.reader_processes:
+        # The progress and the pool are shared by all readers, and new files could only be read in the main process.
+        if args.sincedb:
+            parser.error('--reader-processes cannot be combined with --sincedb')
+        if args.jobs > 1:
+            parser.error('--reader-processes cannot be combined with --jobs')
+
+    # The pool has to be created before any threads are started.
+    pool = None
+    if args.jobs > 1 and not args.follow:
+        pool = multiprocessing.Pool(args.jobs)
+
+    def make_watcher():
+        # Followed files are watched with inotify where it is available and polled otherwise.
+        if args.follow and filewatch.is_supported():
+            try:
+                watcher = filewatch.FileWatcher(tick=LogReader.ENSURE_FILE_IS_GOOD_CALL_INTERVAL)
+            except OSError:
+                logging.exception('Failed to set up inotify, falling back to polling.')
+            else:
+                watcher.start()
+                return watcher
+        return None
+
+    # Reader processes watch their files themselves.
+    watcher = None if args.reader_processes else make_watcher()
+
+    # Globs and directories are expanded once, unless the files are followed. Then, files that appear later are picked
+    # up, too.
+    sources = []
+    patterns = []
     for fname_with_name in file_names:
-        if ':' in fname_with_name:
+        settings = {'pattern': args.pattern, 'timezone': args.timezone}
+        if isinstance(fname_with_name, dict):
+            # Files listed in a configuration profile can be objects with their own name, pattern and timezone.
+            fpath = fname_with_name['path']
+            name = fname_with_name.get('name')
+            settings['pattern'] = fname_with_name.get('pattern', args.pattern)
+            settings['timezone'] = fname_with_name.get('timezone', args.timezone)
+        elif ':' in fname_with_name:
             name, unused, fpath = fname_with_name.partition(':')
         else:
             fpath = fname_with_name
-            name, ext = os.path.splitext(os.path.basename(fpath))
-            name = name[-4:].upper()
-        i = 1
-        while name in used_file_names:
-            name = name + str(i)
-            i += 1
-        if not args.redis_host:
-            file_names[fid] = name
+            name = None
+        if not is_file_pattern(fpath):
+            sources.append((fpath, name, settings, fpath if isinstance(fname_with_name, dict) else fname_with_name))
+        elif args.follow:
+            patterns.append((fpath, settings))
+        else:
+            sources.extend((path, None, settings, path) for path in find_log_files(fpath))
+    if args.reader_processes and patterns:
+        parser.error('--reader-processes cannot be combined with following globs or directories')
+
+    used_file_names = set()
+    file_names = []
+    for fpath, name, settings, redis_name in sources:
+        name = make_unique_name(name or get_short_name(fpath), used_file_names)
+        file_names.append(redis_name if args.redis_host else name)
         used_file_names.add(name)
-        parser = Log4jParser()
-        readers.append(LogReader(
+
+    # The progress of all files is kept in one file, which is written at most every few seconds and once more at exit.
+    progress_store = None
+    if args.sincedb:
+        progress_store = ProgressStore(args.sincedb + 'progress')
+        atexit.register(progress_store.flush)
+
+    # With a spill directory, the queues of the aggregator move entries to disk when they grow too large, and the
+    # readers of files that are ahead of the others do not have to pause that soon.
+    spill_store = None
+    if args.spill_dir:
+        spill_store = SpillStore(args.spill_dir, args.memory_budget * 1024 * 1024, estimate_entry_size)
+        atexit.register(spill_store.close)
+    # Entries that can be spilled need not be dropped. Blocking readers do not stall the merge, as they only pause while
+    # it can pass on entries.
+    overflow_policy = args.overflow_policy or ('block' if spill_store else 'suppress')
+
+    if args.redis_host:
+        aggregator = NonOrderedLogAggregator(file_names, spill_store.create_queue() if spill_store else None)
+    elif args.max_lateness is not None:
+        aggregator = ReorderingLogAggregator(file_names, args.max_lateness, args.late_entries)
+    elif spill_store and args.merge_buffer:
+        # The queue limit bounds the queue of every file, so that the spill directory does not fill up. Like the merge
+        # buffer, it only pauses the readers of files that are ahead, never the one that the merge waits for.
+        aggregator = MergingLogAggregator(file_names, max(args.queue_limit, args.merge_buffer),
+                                          spill_store.create_queue)
+    elif args.merge_buffer:
+        aggregator = MergingLogAggregator(file_names, args.merge_buffer)
+    else:
+        aggregator = OrderedLogAggregator(file_names)
+
+    def make_reader(fid, fpath, settings, discovered=False, receiver=aggregator, watcher=watcher, scheduler=None):
+        if settings['pattern']:
+            parser = PatternLayoutParser(settings['pattern'], block_size=Log4jParser.DEFAULT_BLOCK_SIZE, lazy=True,
+                                         timezone=settings['timezone'])
+        else:
+            parser = Log4jParser(block_size=Log4jParser.DEFAULT_BLOCK_SIZE, lazy=True, timezone=settings['timezone'])
+        return LogReader(
             fid,
             fpath,
             parser,
-            aggregator,
+            receiver,
             tail_length=tail_lines,
             follow=args.follow,
             entry_filter=filterdef,
             progress_file_path_prefix=args.sincedb,
-        ))
-        fid += 1
-    for reader in readers:
-        reader.start()
+            progress_store=progress_store,
+            overflow_policy=overflow_policy,
+            queue_limit=args.queue_limit,
+            scheduler=scheduler,
+            use_mmap=True,
+            pool=pool,
+            index_file_path_prefix=args.index_prefix or args.sincedb,
+            batch_size=args.batch_size,
+            watcher=watcher,
+            # Readers of files that are found by patterns come and go with their files.
+            idle_timeout=args.idle_timeout if discovered else None,
+            retire_when_removed=discovered,
+        )
+
+    def start_readers(readers, watcher):
+        if args.reader_threads:
+            # Each thread reads a share of the files instead of starting a thread per file.
+            thread_count = args.reader_threads if patterns else min(args.reader_threads, len(readers))
+            readers = [MultiplexedLogReader(readers[i::args.reader_threads], watcher, keep_running=bool(patterns))
+                       for i in range(thread_count)]
+        for reader in readers:
+            reader.start()
+        return readers
+
+    def start_process_readers(receiver, shares):
+        # Runs in a reader process, which has a watcher and a scheduler of its own.
+        watcher = make_watcher()
+        scheduler = HousekeepingScheduler(receiver)
+        scheduler.start()
+        readers = []
+        for fid, source in shares:
+            reader = make_reader(fid, source[0], source[2], receiver=receiver, watcher=watcher, scheduler=scheduler)
+            receiver.add_parser(fid, reader.parser)
+            readers.append(reader)
+        return start_readers(readers, watcher)
+
+    if args.reader_processes:
+        # The processes are forked before the main process starts any more threads.
+        processes = []
+        for i in range(min(args.reader_processes, len(sources))):
+            shares = list(enumerate(sources))[i::args.reader_processes]
+            processes.append(ReaderProcess([fid for fid, _ in shares],
+                                           lambda receiver, shares=shares: start_process_readers(receiver, shares)))
+        for process in processes:
+            process.start()
+        for process in processes:
+            RingReaderThread(process, aggregator).start()
+    else:
+        # The files, the queue and the progress of all readers are looked after by one thread.
+        scheduler = HousekeepingScheduler(aggregator, progress_store)
+        scheduler.start()
+        readers = start_readers([make_reader(fid, source[0], source[2], scheduler=scheduler)
+                                 for fid, source in enumerate(sources)], watcher)
+        if patterns:
+            LogFileDiscoverer(patterns, aggregator,
+                              lambda fid, fpath, settings: make_reader(fid, fpath, settings, True, scheduler=scheduler),
+                              multiplexed_readers=readers if args.reader_threads else (),
+                              short_names=not args.redis_host, used_names=used_file_names).start()
     if args.redis_host:
         out = RedisOutputThread(aggregator, args.redis_host, args.redis_port, args.redis_namespace)
     else:
@@ -1,21 +1,40 @@
+import collections
+import glob
 import gzip
 import hashlib
 import io
 import logging
+import mmap
 import threading
 import time
 import os
 
-from common import LogFilter, LogLevel, get_device_and_inode_string
+import gzipindex
+import timeindex
+from sincedb import parse_progress, write_atomically
+from common import LogFilter, LogLevel, get_device_and_inode_string, get_short_name, make_unique_name
 
 
 class LogReader(threading.Thread):
 
     NO_ENTRIES_SLEEP_INTERVAL = 0.1  # seconds
     CHUNK_SIZE = 1024  # bytes
+    TAIL_BLOCK_SIZE = 64 * 1024  # bytes
+    MAX_TAIL_BLOCK_SIZE = 8 * 1024 * 1024  # bytes
+    TAIL_OVERLAP_SIZE = 24  # bytes, the length of a timestamp plus the following space
     ENSURE_FILE_IS_GOOD_CALL_INTERVAL = 2  # seconds
     SAVE_PROGRESS_CALL_INTERVAL = 5  # seconds
     ADJUST_LOGLEVEL_SUPPRESSION_CALL_INTERVAL = 1  # seconds
+    PARALLEL_RANGE_SIZE = 64 * 1024 * 1024  # bytes
+    FINGERPRINT_SIZE = 1024  # bytes
+    HAND_OVER_ENTRY_COUNT = 1024  # entries
+
+    # When the queue of the receiver grows too long, the reader either suppresses TRACE, DEBUG and INFO entries one
+    # level after the other ("suppress"), pauses until the queue has shrunk ("block"), or only passes on every
+    # SAMPLE_INTERVAL-th entry below WARN ("sample"). The queue lengths scale with the queue limit.
+    OVERFLOW_POLICIES = 'suppress', 'block', 'sample'
+    QUEUE_LIMIT = 1000000  # entries
+    SAMPLE_INTERVAL = 10  # entries
 
     START_SUPPRESSING_TRACE_ENTRIES_QUEUE_LENGTH = 10000
     STOP_SUPPRESSING_TRACE_ENTRIES_QUEUE_LENGTH = 7500
@@ -23,6 +42,7 @@ class LogReader(threading.Thread):
     STOP_SUPPRESSING_DEBUG_ENTRIES_QUEUE_LENGTH = 75000
     START_SUPPRESSING_INFO_ENTRIES_QUEUE_LENGTH = 1000000
     STOP_SUPPRESSING_INFO_ENTRIES_QUEUE_LENGTH = 750000
+    RESUME_QUEUE_LENGTH = 750000
 
 
     def __init__(
@@ -35,6 +55,18 @@ class LogReader(threading.Thread):
         follow=False,
         entry_filter=None,
         progress_file_path_prefix=None,
+        use_mmap=False,
+        pool=None,
+        index_file_path_prefix=None,
+        batch_size=None,
+        watcher=None,
+        idle_timeout=None,
+        retire_when_removed=False,
+        resume_position=None,
+        progress_store=None,
+        overflow_policy='suppress',
+        queue_limit=None,
+        scheduler=None,
     ):
 
         threading.Thread.__init__(self, name='LogReader-%d' % reader_id)
@@ -46,62 +78,342 @@ class LogReader(threading.Thread):
         self.tail_length = tail_length
         self.follow = follow
         self.entry_filter = entry_filter or LogFilter()
+        self.use_mmap = use_mmap
+        self.pool = pool
+        self.batch_size = batch_size
+        self.watcher = watcher
+        self.idle_timeout = idle_timeout
+        self.retire_when_removed = retire_when_removed
+        self.resume_position = resume_position
+        self.progress_store = progress_store
+        assert overflow_policy in self.OVERFLOW_POLICIES, 'Unknown overflow policy: %s' % overflow_policy
+        self.overflow_policy = overflow_policy
+        if queue_limit:
+            self._set_queue_limit(queue_limit)
+        self.scheduler = scheduler
 
         self.logfile = None
         self.logfile_id = None
+        self.file_watch = None
+        self.watch_event = None
+        self.entry_counts = None
+        self.file_removed = False
+        self.rotation_pending = False
+        self.fingerprint = None
+        self.time_index = None
+        self.next_time_index_span = 0
+        self.retired = False
+        self.final_position = None
+        self.last_entry_timestamp = time.time()
         self.last_ensure_file_is_good_call_timestamp = 0
         self.last_save_progress_call_timestamp = 0
         self.last_adjust_loglevel_suppression_call_timestamp = 0
         self.suppressed_log_level = -1
+        self.sampling = False
+        self.sampled_entry_count = 0
+        # Set by the scheduler, if there is one. housekeeping_due is set whenever any of the others is.
+        self.housekeeping_due = False
+        self.file_check_due = False
+        self.progress_due = False
+        self.queue_wait_due = False
 
         if progress_file_path_prefix:
             self.progress_file_path = '{0}f{1}'.format(progress_file_path_prefix, hashlib.sha1(logfile_name).hexdigest())
         else:
             self.progress_file_path = None
 
+        if index_file_path_prefix:
+            self.index_file_path = '{0}z{1}'.format(index_file_path_prefix, hashlib.sha1(logfile_name).hexdigest())
+            self.time_index_path = '{0}t{1}'.format(index_file_path_prefix, hashlib.sha1(logfile_name).hexdigest())
+        else:
+            self.index_file_path = None
+            self.time_index_path = None
+
     def run(self):
         """Implements the reader's main loop. Called when the thread is started."""
 
+        try:
+            self.prepare()
+        except Exception:
+            # The entries of the other files must not wait for a file that cannot be read.
+            self._advance(float('inf'))
+            raise
+
+        if self.reads_in_parallel():
+            self._read_in_parallel()
+            self._finish()
+            return
+
+        while True:
+            entry_count = self.read_entries()
+
+            if not self.follow:
+                self._save_time_index()
+                self._finish()
+                break
+            if entry_count == 0:
+                if self.should_retire(time.time()):
+                    self.retire()
+                    break
+                if self.file_watch:
+                    # Woken up by a change of the file or by the watcher's tick. A change without new entries may have
+                    # been a truncation, so the file is checked right away.
+                    self.file_watch.wait()
+                    self.last_ensure_file_is_good_call_timestamp = time.time()
+                    self._ensure_file_is_good()
+                else:
+                    time.sleep(self.NO_ENTRIES_SLEEP_INTERVAL)
+                self._housekeep()
+
+    def prepare(self):
+        """Opens the file, seeks to the position where reading starts and registers the reader with the scheduler."""
+
         self._open_file()
         self.parser.autoconfigure(self.logfile)
         self._seek_position()
+        if self.time_index:
+            self.next_time_index_span = -(-self.logfile.tell() // self.time_index.span)
+
+        if self.scheduler:
+            self.scheduler.add(self)
+        else:
+            self._maybe_do_housekeeping(time.time())
+
+    def reads_in_parallel(self):
+        return self.pool and not self.follow and not self.logfile_name.endswith('.gz')
+
+    def read_entries(self, max_entry_count=None):
+        """
+        Reads entries and passes the matching ones to the receiver until the end of the file is reached or, if
+        max_entry_count is given, until at least max_entry_count entries have been read. In the latter case,
+        entry_counts is left set and the next call continues where this one stopped. Returns the number of entries
+        read.
+        """
+
+        if self.entry_counts is None:
+            self.entry_counts = self._read_batches() if self.batch_size else self._read_entries()
+
+        entry_count = 0
+        for count in self.entry_counts:
+            entry_count += count
+            if max_entry_count and entry_count >= max_entry_count:
+                self.last_entry_timestamp = time.time()
+                return entry_count
+        self.entry_counts = None
+        if self.rotation_pending:
+            # The file has been rotated while it was read. Now that its end has been reached, the new file is opened.
+            entry_count += self._ensure_file_is_good()
+        # Entries that are written from now on are newer than those of the other files that have been read already.
+        self._advance(float('inf'))
+        if entry_count:
+            self.last_entry_timestamp = time.time()
+        return entry_count
+
+    def _read_to_end(self, logfile):
+        """
+        Reads the entries from the current position of logfile to its end and passes the matching ones to the receiver.
+        Unlike read_entries(), does no housekeeping. Returns the number of entries read.
+        """
+
+        entries = []
+        entry_count = 0
+        for entry in self.parser.read(self.reader_id, logfile):
+            if self.entry_filter.matches(entry) and entry.level.priority > self.suppressed_log_level:
+                entries.append(entry)
+            entry_count += 1
+        self._hand_over(entries)
+        return entry_count
+
+    def _finish(self):
+        """Tells the scheduler, if there is one, and the receiver that the reader is done."""
+
+        if self.scheduler:
+            self.scheduler.remove(self)
+        self.receiver.eof(self.reader_id)
+
+    def should_retire(self, current_timestamp):
+        """
+        Returns whether the reader, which has read its file to the end, is done: either the file has been removed and
+        retire_when_removed is set, or no entries have been read for idle_timeout seconds.
+        """
 
-        self._maybe_do_housekeeping(time.time())
+        if self.retire_when_removed and self.file_removed:
+            return True
+        return bool(self.idle_timeout) and current_timestamp - self.last_entry_timestamp > self.idle_timeout
+
+    def retire(self):
+        """
+        Stops reading: saves the progress, remembers the final position as (logfile_id, position), closes the file and
+        tells the receiver that there are no more entries.
+        """
+
+        logging.info('Retiring the reader of %s.', self.logfile_name)
+        if self.progress_file_path:
+            self._save_progress()
+        self.final_position = self.logfile_id, self._get_position()
+        self._close_file()
+        self._finish()
+        self.retired = True
+
+    def _get_position(self):
+        """
+        Returns the position in the file up to which all entries have been handed over. While a read is in progress,
+        the parser has read ahead of the entries, so its entry_end_position is returned instead of that of the file.
+        """
+
+        if self.entry_counts is not None:
+            return self.parser.entry_end_position
+        return self.logfile.tell()
+
+    def _read_entries(self):
+        """
+        Reads the entries one by one. The matching entries are handed over to the receiver together, every
+        HAND_OVER_ENTRY_COUNT entries and when the end of the file is reached, so that no entry waits longer than it
+        takes to read that many entries. Yields the number of entries read since the last yield.
+        """
 
         # Performance!
         reader_id = self.reader_id
-        logfile = self.logfile
-        receiver = self.receiver
         entry_filter = self.entry_filter
+        hand_over_entry_count = self.HAND_OVER_ENTRY_COUNT
+        # The entries of a file are ordered by time, so a file that is not followed is done with the first entry that
+        # is not older than time_to.
+        to_time = None if self.follow else entry_filter.to_time
 
-        while True:
-            entry_count = 0
-            for entry in self.parser.read(reader_id, logfile):
-                if entry_filter.matches(entry) and entry.level.priority > self.suppressed_log_level:
-                    receiver.add(entry)
-                entry_count += 1
-                if entry_count & 1023 == 0:
-                    self._maybe_do_housekeeping(time.time())
+        entries = []
+        append = entries.append
+        entry_count = 0
+        for entry in self.parser.read(reader_id, self.logfile):
+            if to_time is not None and entry.time >= to_time:
+                break
+            if entry_filter.matches(entry) and entry.level.priority > self.suppressed_log_level:
+                append(entry)
+            entry_count += 1
+            if entry_count == hand_over_entry_count:
+                self._hand_over(entries)
+                self._advance(entry.time)
+                entries = []
+                append = entries.append
+                self._update_time_index()
+                self._housekeep()
+                yield entry_count
+                entry_count = 0
+        self._hand_over(entries)
+        self._update_time_index()
+        if entry_count:
+            yield entry_count
 
-            if not self.follow:
-                receiver.eof(reader_id)
+    def _read_batches(self):
+        """
+        Reads the entries in batches of batch_size entries, which are filtered as a whole and passed to the receiver's
+        add_batch method. Yields the number of entries of each batch.
+        """
+
+        to_time = None if self.follow else self.entry_filter.to_time
+        for batch in self.parser.read_batches(self.reader_id, self.logfile, self.batch_size):
+            self._hand_over(self.entry_filter.select(batch, self.suppressed_log_level))
+            self._advance(batch.times[-1])
+            self._update_time_index()
+            self._housekeep()
+            yield len(batch)
+            if to_time is not None and batch.times[-1] >= to_time:
                 break
-            if entry_count == 0:
-                time.sleep(self.NO_ENTRIES_SLEEP_INTERVAL)
-                self._maybe_do_housekeeping(time.time())
-                logfile = self.logfile
+
+    def _hand_over(self, entries):
+        """Passes the given entries to the receiver, at once if the receiver has an add_batch method."""
+
+        if self.sampling:
+            entries = self._sample(entries)
+        if not entries:
+            return
+        add_batch = getattr(self.receiver, 'add_batch', None)
+        if add_batch is not None:
+            add_batch(entries)
+        else:
+            add = self.receiver.add
+            for entry in entries:
+                add(entry)
+
+    def _advance(self, watermark):
+        """
+        Tells the receiver, if it keeps watermarks, that the reader will not hand over entries older than watermark
+        any more.
+        """
+
+        advance = getattr(self.receiver, 'advance', None)
+        if advance is not None:
+            advance(self.reader_id, watermark)
+
+    def _read_in_parallel(self):
+        """
+        Splits the rest of the file into ranges of about PARALLEL_RANGE_SIZE bytes that start at entry boundaries and
+        has the worker processes of pool parse and filter them. The matching entries are passed to the receiver in
+        file order, and entry numbers are continued across ranges as if the file had been read in one go.
+        """
+
+        start = self.logfile.tell()
+        if self.entry_filter.time_to:
+            # No entry after the first one that is not older than time_to matches.
+            self._seek_time(self.entry_filter.time_to)
+            end = self.logfile.tell()
+        else:
+            end = self._get_file_size()
+
+        boundaries = [start]
+        for offset in xrange(start + self.PARALLEL_RANGE_SIZE, end, self.PARALLEL_RANGE_SIZE):
+            boundary = self._find_entry_boundary(offset)
+            if boundary > boundaries[-1]:
+                boundaries.append(boundary)
+        if end > boundaries[-1]:
+            boundaries.append(end)
+
+        ranges = zip(boundaries, boundaries[1:])
+        tasks = [(self.logfile_name, self.reader_id, range_start, range_stop, self.parser, self.entry_filter)
+                 for range_start, range_stop in ranges]
+
+        intern_entry = self.parser.intern_entry
+        first_entry_number = 0
+        for (_, range_stop), (entries, entry_count) in zip(ranges, self.pool.imap(read_range, tasks)):
+            self._hand_over([intern_entry(entry)._replace(entry_number=first_entry_number + entry.entry_number)
+                             for entry in entries if entry.level.priority > self.suppressed_log_level])
+            if entries:
+                self._advance(entries[-1].time)
+            first_entry_number += entry_count
+            self.logfile.seek(range_stop)
+            self._housekeep()
+
+    def _find_entry_boundary(self, offset):
+        """
+        Returns the offset of the first line after the given offset that starts an entry, or the offset of the end of
+        the file if there is no such line.
+        """
+
+        self.logfile.seek(offset)
+        # The given offset might lie in the middle of a line.
+        self.logfile.readline()
+        while True:
+            position = self.logfile.tell()
+            line = self.logfile.readline()
+            if not line or not self.parser.is_continuation_line(line):
+                return position
 
     ### FILES ###
 
     def _open_file(self):
         """
         Opens the file the LogReader is responsible for and assigns it to logfile. If that file has the extension ".gz",
-        it is opened as a gzip file. Errors are propagated.
+        it is opened as a gzip file. Unless the reader follows the file, gzip files are opened as IndexedGzipFile, which
+        can seek without decompressing the file from the start; its index is stored at index_file_path. If use_mmap is
+        set and the reader does not follow the file, a regular file is memory-mapped instead. If the reader follows the
+        file and has a watcher, the file is watched for changes. Errors are propagated.
         """
 
         try:
             if self.logfile_name.endswith('.gz'):
-                self.logfile = gzip.open(self.logfile_name, 'rb')
+                if not self.follow and gzipindex.is_supported():
+                    self.logfile = gzipindex.IndexedGzipFile(self.logfile_name, self.index_file_path)
+                else:
+                    self.logfile = gzip.open(self.logfile_name, 'rb')
             else:
                 self.logfile = io.open(self.logfile_name, 'rb')
             logging.info('Opened %s.', self.logfile_name)
@@ -109,11 +421,50 @@ class LogReader(threading.Thread):
             logging.exception('Failed to open %s.', self.logfile_name)
             raise
         else:
-            self.logfile_id = get_device_and_inode_string(os.fstat(self.logfile.fileno()))
+            stat_results = os.fstat(self.logfile.fileno())
+            self.logfile_id = get_device_and_inode_string(stat_results)
+            self.fingerprint = None
+            self._get_fingerprint()
+            self._load_time_index(stat_results.st_size)
+            if self.use_mmap and not self.follow and isinstance(self.logfile, io.BufferedReader):
+                self._map_file(stat_results.st_size)
+            if self.follow and self.watcher:
+                self.file_watch = self.watcher.watch(self.logfile_name, self.watch_event)
+
+    def _map_file(self, file_size):
+        """
+        Replaces logfile with a read-only memory map of the same file. Empty files and files that cannot be mapped
+        (for example, because they are too large for the address space) are left as they are.
+        """
+
+        if file_size == 0:
+            return
+        try:
+            mapped = mmap.mmap(self.logfile.fileno(), 0, access=mmap.ACCESS_READ)
+        except (EnvironmentError, ValueError, OverflowError):
+            logging.warning('Failed to memory-map %s. Reading it regularly instead.', self.logfile_name)
+        else:
+            self.logfile.close()
+            self.logfile = mapped
+
+    def _get_file_size(self):
+        """Returns the size of the file the reader is currently reading."""
+
+        if isinstance(self.logfile, mmap.mmap):
+            return len(self.logfile)
+        elif isinstance(self.logfile, gzipindex.IndexedGzipFile):
+            return self.logfile.size
+        else:
+            return os.fstat(self.logfile.fileno()).st_size
 
     def _close_file(self):
         """Closes the file the LogReader is responsible for and sets logfile to None."""
 
+        if self.file_watch:
+            self.watcher.unwatch(self.file_watch)
+            self.file_watch = None
+        self._save_time_index()
+        self.time_index = None
         if self.logfile:
             self.logfile.close()
             self.logfile = None
@@ -125,10 +476,16 @@ class LogReader(threading.Thread):
     def _seek_position(self):
         """
         Seeks to the start position of the file the reader is responsible for. Depending on the reader's configuration,
-        dispatches to _seek_first_unprocessed_position(), _seek_tail(), or _seek_time().
+        dispatches to _seek_first_unprocessed_position(), _seek_tail(), or _seek_time(). A resume_position (logfile_id,
+        position) takes precedence, unless the file is not the file the position refers to, which is read from the
+        start.
         """
 
-        if self.progress_file_path:
+        if self.resume_position:
+            logfile_id, position = self.resume_position
+            if logfile_id == self.logfile_id:
+                self.logfile.seek(position)
+        elif self.progress_file_path:
             self._seek_first_unprocessed_position()
         elif self.tail_length == 0:
             self.logfile.seek(0, os.SEEK_END)
@@ -138,75 +495,176 @@ class LogReader(threading.Thread):
             self._seek_time(self.entry_filter.time_from)
 
     def _seek_first_unprocessed_position(self):
-        """Loads the last file position from the file given by progress_file_path and seeks to that position."""
+        """
+        Loads the last file position from the file given by progress_file_path and seeks to that position. If the file
+        has been rotated since, its rotated sibling is looked up by its ID or fingerprint and read to its end first,
+        and the current file is read from its start.
+        """
 
         try:
-            _, logfile_id, last_position, _ = self._load_progress()
+            _, logfile_id, last_position, _, fingerprint = self._load_progress()
         except Exception:
             logging.warning('Failed to read the progress file for "%s".', self.logfile_name)
-        else:
+            return
+
+        current_fingerprint = self._get_fingerprint()
+        if logfile_id == self.logfile_id and (not fingerprint or fingerprint == current_fingerprint):
             logging.info('Resumed reading "%s" at offset %d.', self.logfile_name, last_position)
-            self.logfile_id = logfile_id
             self.logfile.seek(last_position)
+            return
 
-    def _seek_tail(self):
-        """Seeks to the beginning of the Nth entry (not line!) from the end, where N is given by tail_length."""
+        logging.info('The file %s has been rotated since the progress was saved.', self.logfile_name)
+        rotated_file_name = self._find_rotated_file(logfile_id, fingerprint)
+        if rotated_file_name:
+            logging.info('Finishing the rotated file %s at offset %d.', rotated_file_name, last_position)
+            try:
+                with self._open_rotated_file(rotated_file_name) as rotated_file:
+                    rotated_file.seek(last_position)
+                    self._read_to_end(rotated_file)
+            except IOError:
+                logging.exception('Failed to read the rotated file %s.', rotated_file_name)
 
-        file_size = os.fstat(self.logfile.fileno()).st_size
-        chunk_count = (file_size // self.CHUNK_SIZE) + bool(file_size % self.CHUNK_SIZE)
+    def _find_rotated_file(self, logfile_id, fingerprint):
+        """
+        Returns the name of the file next to the file the reader is responsible for whose name starts with that file's
+        name (e.g. "app.log.1" or "app.log.1.gz" for "app.log") and which has the given logfile ID or, if it has been
+        compressed, whose contents start with the given fingerprint. Returns None if there is no such file.
+        """
 
-        chunk = ''
-        newline_count = 0
-        previous_newline_position = None
+        directory, name = os.path.split(self.logfile_name)
+        try:
+            candidates = [os.path.join(directory, candidate) for candidate in os.listdir(directory or os.curdir)
+                          if candidate.startswith(name) and candidate != name]
+        except OSError:
+            return None
 
-        for iteration, chunk_index in enumerate(reversed(range(chunk_count))):
-            self.logfile.seek(self.CHUNK_SIZE * chunk_index)
-            line_tail = chunk[:previous_newline_position]
-            chunk = self.logfile.read(self.CHUNK_SIZE) + line_tail
+        # The most recently rotated file comes first.
+        candidates_by_mtime = []
+        for candidate in candidates:
+            try:
+                stat_results = os.stat(candidate)
+            except OSError:
+                continue
+            if get_device_and_inode_string(stat_results) == logfile_id:
+                return candidate
+            candidates_by_mtime.append((-stat_results.st_mtime, candidate))
 
-            if iteration == 0:
-                previous_newline_position = chunk.rfind('\n')
-            else:
-                previous_newline_position = None
+        if fingerprint:
+            for _, candidate in sorted(candidates_by_mtime):
+                try:
+                    with self._open_rotated_file(candidate) as rotated_file:
+                        head = rotated_file.read(self.FINGERPRINT_SIZE)
+                except (IOError, EOFError):
+                    continue
+                if hashlib.sha1(head).hexdigest() == fingerprint:
+                    return candidate
+        return None
 
-            current_newline_position = chunk.rfind('\n', 0, previous_newline_position)
+    def _open_rotated_file(self, file_name):
+        if file_name.endswith('.gz'):
+            return gzip.open(file_name, 'rb')
+        return io.open(file_name, 'rb')
 
-            while current_newline_position != -1:
-                line = chunk[current_newline_position + 1 : previous_newline_position]
+    def _get_fingerprint(self):
+        """
+        Returns the SHA-1 hash of the first FINGERPRINT_SIZE bytes of the file, which identifies the file after it
+        has been rotated and compressed. Returns None as long as the file is shorter. The fingerprint of a gzip file is
+        only taken before its start has been read past, as seeking back would decompress the file again.
+        """
 
-                if not self.parser.is_continuation_line(line):
-                    newline_count += 1
-                    if newline_count >= self.tail_length:
-                        self.logfile.seek(chunk_index * self.CHUNK_SIZE + current_newline_position + 1)
-                        return
+        if self.fingerprint is None and self.logfile is not None:
+            position = self.logfile.tell()
+            if position == 0 or not self.logfile_name.endswith('.gz'):
+                try:
+                    self.logfile.seek(0)
+                    head = self.logfile.read(self.FINGERPRINT_SIZE)
+                except IOError:
+                    head = ''
+                self.logfile.seek(position)
+                if len(head) == self.FINGERPRINT_SIZE:
+                    self.fingerprint = hashlib.sha1(head).hexdigest()
+        return self.fingerprint
 
-                previous_newline_position = current_newline_position
-                current_newline_position = chunk.rfind('\n', 0, previous_newline_position)
-        else:
-            self.logfile.seek(0)
+    def _seek_tail(self):
+        """
+        Seeks to the beginning of the Nth entry (not line!) from the end, where N is given by tail_length. The file is
+        read backwards in blocks that double in size up to MAX_TAIL_BLOCK_SIZE, and entry starts are counted by
+        searching each block for newlines followed by a timestamp.
+        """
+
+        if isinstance(self.logfile, mmap.mmap):
+            self._seek_tail_in_map()
+            return
+
+        is_entry_start = self.parser.is_entry_start
+        block_size = self.TAIL_BLOCK_SIZE
+        block_stop = self._get_file_size()
+        last_newline_position = None
+        # The first bytes of the previously read block, so that entry starts right after a block boundary are checked.
+        overlap = ''
+        entry_count = 0
+
+        while block_stop > 0:
+            block_start = max(0, block_stop - block_size)
+            self.logfile.seek(block_start)
+            block = self.logfile.read(block_stop - block_start) + overlap
+            overlap = block[:self.TAIL_OVERLAP_SIZE]
+
+            if last_newline_position is None:
+                # Anything after the last newline is an incomplete line and does not count.
+                position = block.rfind('\n', 0, block_stop - block_start)
+                if position != -1:
+                    last_newline_position = block_start + position
+            if last_newline_position is not None:
+                # Only newlines within this block are searched; the overlap has been searched with the previous one.
+                search_stop = min(last_newline_position - block_start, block_stop - block_start + 2)
+                position = block.rfind('\n20', 0, search_stop)
+                while position != -1:
+                    if is_entry_start(block, position + 1):
+                        entry_count += 1
+                        if entry_count >= self.tail_length:
+                            self.logfile.seek(block_start + position + 1)
+                            return
+                    position = block.rfind('\n20', 0, position)
+
+            block_stop = block_start
+            block_size = min(block_size * 2, self.MAX_TAIL_BLOCK_SIZE)
+
+        self.logfile.seek(0)
 
     def _seek_time(self, time_string):
-        """Seeks to the beginning of the first entry with a timestamp greater than or equal to the given one."""
+        """
+        Seeks to the beginning of the first entry with a timestamp greater than or equal to the given one. The given
+        timestamp is converted with the time converter of the entry filter, and the timestamps of the file with the
+        time converter of the parser, so they are compared correctly even if they are in different timezones. If the
+        file has a time index, only the region of the file given by the index is searched.
+        """
+
+        target_time = self.entry_filter.time_converter.parse(time_string)
+
+        if isinstance(self.logfile, mmap.mmap):
+            self._seek_time_in_map(target_time)
+            return
 
         def binary_chunk_search(start_index, stop_index):
             if start_index + 1 == stop_index:
                 return start_index
             else:
                 pivot_index = (start_index + stop_index) // 2
-                if get_first_timestamp_in_chunk(pivot_index) > time_string:
+                if get_first_time_in_chunk(pivot_index) > target_time:
                     return binary_chunk_search(start_index, pivot_index)
                 else:
                     return binary_chunk_search(pivot_index, stop_index)
 
-        def get_first_timestamp_in_chunk(chunk_index):
+        def get_first_time_in_chunk(chunk_index):
             self.logfile.seek(self.CHUNK_SIZE * chunk_index)
             line = self.logfile.readline()
             while line and self.parser.is_continuation_line(line):
                 line = self.logfile.readline()
             if line and line[-1] == '\n':
-                return self.parser.get_time_string(line)
+                return self.parser.get_time(line)
             else:
-                return 'greater than any time string'
+                return float('inf')
 
         def seek_time_in_chunk(chunk_index):
             self.logfile.seek(chunk_index * self.CHUNK_SIZE)
@@ -217,26 +675,175 @@ class LogReader(threading.Thread):
                     if self.parser.is_continuation_line(line):
                         continue
                     else:
-                        if self.parser.get_time_string(line) >= time_string:
+                        if self.parser.get_time(line) >= target_time:
                             self.logfile.seek(-len(line), os.SEEK_CUR)
                             return
                 else:
                     self.logfile.seek(0, os.SEEK_END)
                     return
 
-        file_size = os.fstat(self.logfile.fileno()).st_size
+        file_size = self._get_file_size()
         chunk_count = (file_size // self.CHUNK_SIZE) + bool(file_size % self.CHUNK_SIZE)
+        start_index, stop_index = 0, chunk_count + 1
 
-        target_chunk_index = binary_chunk_search(0, chunk_count + 1)
+        if self.time_index:
+            start, stop = self.time_index.find_region(target_time)
+            start_index = start // self.CHUNK_SIZE
+            if stop is not None:
+                # The first entry that is not older than target_time starts at stop at the latest.
+                stop_index = stop // self.CHUNK_SIZE + 1
+
+        target_chunk_index = binary_chunk_search(start_index, stop_index)
         seek_time_in_chunk(target_chunk_index)
 
+    def _seek_tail_in_map(self):
+        """
+        Like _seek_tail(), but for memory-mapped files. Entry starts are counted by searching the map backwards for
+        newlines followed by a timestamp, without copying any lines out of the map.
+        """
+
+        mapped = self.logfile
+        rfind = mapped.rfind
+        entry_count = 0
+
+        # Anything after the last newline is an incomplete line and does not count.
+        position = rfind('\n20', 0, rfind('\n'))
+        while position != -1:
+            if self.parser.is_entry_start(mapped, position + 1):
+                entry_count += 1
+                if entry_count >= self.tail_length:
+                    mapped.seek(position + 1)
+                    return
+            position = rfind('\n20', 0, position)
+
+        mapped.seek(0)
+
+    def _seek_time_in_map(self, target_time):
+        """
+        Like _seek_time(), but for memory-mapped files. Performs a binary search directly over byte offsets of the map.
+        """
+
+        mapped = self.logfile
+        file_size = len(mapped)
+        get_time = self.parser.get_time
+
+        # Finds the smallest offset whose following entry is not older than target_time.
+        low, high = 0, file_size
+        while low < high:
+            middle = (low + high) // 2
+            entry_start = self._find_mapped_entry_start(mapped, middle)
+            if entry_start is None or get_time(mapped[entry_start:entry_start + 24]) >= target_time:
+                high = middle
+            else:
+                low = middle + 1
+
+        entry_start = self._find_mapped_entry_start(mapped, low)
+        mapped.seek(file_size if entry_start is None else entry_start)
+
+    def _find_mapped_entry_start(self, mapped, offset):
+        """
+        Returns the offset of the first complete line at or after the given offset that starts an entry, or None if
+        there is no such line.
+        """
+
+        entry_start = self.parser.find_entry_start(mapped, offset)
+        if entry_start == -1 or mapped.find('\n', entry_start) == -1:
+            return None
+        return entry_start
+
+    ### TIME INDEX ###
+
+    def _load_time_index(self, file_size):
+        """
+        Loads the time index of the file that has just been opened from time_index_path, or starts a new one if there is
+        no valid index. Only regular files and IndexedGzipFiles are indexed, as the other files cannot be seeked
+        cheaply.
+        """
+
+        self.time_index = None
+        if self.time_index_path and isinstance(self.logfile, (io.BufferedReader, gzipindex.IndexedGzipFile)):
+            self.time_index = (timeindex.TimeIndex.load(self.time_index_path, self.logfile_id, file_size)
+                               or timeindex.TimeIndex(self.logfile_id))
+            self.next_time_index_span = 0
+
+    def _update_time_index(self):
+        """
+        Records a checkpoint for every span of the file that lies before the current position and has not been indexed
+        yet. The position of the file is restored afterwards.
+        """
+
+        index = self.time_index
+        if index is None:
+            return
+        position = self.logfile.tell()
+        stop_span = (position - 1) // index.span + 1 if position else 0
+        if self.next_time_index_span >= stop_span:
+            return
+
+        for span_number in xrange(self.next_time_index_span, stop_span):
+            if span_number in index:
+                continue
+            offset = self._find_entry_boundary(span_number * index.span)
+            self.logfile.seek(offset)
+            line = self.logfile.readline()
+            if line.endswith('\n'):
+                entry_time = self.parser.get_time(line)
+                if entry_time is not None:
+                    index.add(span_number, offset, entry_time)
+        self.next_time_index_span = stop_span
+        self.logfile.seek(position)
+
+    def _save_time_index(self):
+        """Stores the time index at time_index_path if checkpoints have been added since it was loaded."""
+
+        if self.time_index and self.time_index.changed:
+            try:
+                if isinstance(self.logfile, mmap.mmap):
+                    # A map has no file descriptor. It covers the whole file, as far as it is read.
+                    file_size = len(self.logfile)
+                else:
+                    # Unlike _get_file_size(), the size on disk for gzip files, as the index is loaded with that.
+                    file_size = os.fstat(self.logfile.fileno()).st_size
+                self.time_index.save(self.time_index_path, file_size)
+            except Exception:
+                logging.exception('Failed to save the time index of %s.', self.logfile_name)
+
     ### HOUSEKEEPING ###
 
+    def _housekeep(self, current_timestamp=None):
+        """
+        Does the housekeeping that is due. Without a scheduler, the reader keeps track of when that is itself; with a
+        scheduler, it only checks whether the scheduler has asked for anything.
+        """
+
+        if self.scheduler is None:
+            self._maybe_do_housekeeping(current_timestamp or time.time())
+        elif self.housekeeping_due:
+            self._do_scheduled_housekeeping()
+
+    def _do_scheduled_housekeeping(self):
+        """
+        Does the housekeeping the scheduler has asked for: checks the file, saves the progress and waits for the queue
+        to shrink. The scheduler only asks, because the file is only used by the reader's own thread.
+        """
+
+        self.housekeeping_due = False
+        if self.file_check_due:
+            self.file_check_due = False
+            self.last_ensure_file_is_good_call_timestamp = time.time()
+            self._ensure_file_is_good()
+        if self.progress_due:
+            self.progress_due = False
+            self._save_progress()
+        if self.queue_wait_due:
+            self.queue_wait_due = False
+            self._wait_for_queue()
+
     def _maybe_do_housekeeping(self, current_timestamp):
         """
         If more than ENSURE_FILE_IS_GOOD_CALL_INTERVAL seconds have passed since _ensure_file_is_good was last called,
         calls that method. Then, if more than SAVE_PROGRESS_CALL_INTERVAL seconds have passed since _save_progress was
-        last called, calls that method.
+        last called, calls that method. Finally, handles an overflowing queue according to the overflow policy.
         """
 
         if current_timestamp - self.last_ensure_file_is_good_call_timestamp > self.ENSURE_FILE_IS_GOOD_CALL_INTERVAL:
@@ -248,85 +855,509 @@ class LogReader(threading.Thread):
                 self.last_save_progress_call_timestamp = current_timestamp
                 self._save_progress()
 
-        if current_timestamp - self.last_adjust_loglevel_suppression_call_timestamp > self.ADJUST_LOGLEVEL_SUPPRESSION_CALL_INTERVAL:
+        if self.overflow_policy == 'block':
+            self._wait_for_queue()
+        elif current_timestamp - self.last_adjust_loglevel_suppression_call_timestamp > self.ADJUST_LOGLEVEL_SUPPRESSION_CALL_INTERVAL:
             self.last_adjust_loglevel_suppression_call_timestamp = current_timestamp
-            self._adjust_loglevel_suppression()
+            if self.overflow_policy == 'sample':
+                self._adjust_sampling()
+            else:
+                self._adjust_loglevel_suppression()
 
     def _ensure_file_is_good(self):
         """
         Ensures that the file the reader is tailing is the file it is supposed to be tailing.
-        If the target file has been removed, does nothing. If there is a new file in its place, stops tailing the
-        current file and tails the new file instead. If the current file position lies past the file's end, resets
-        it to the file's beginning.
+        If the target file has been removed, does nothing. If there is a new file in its place, reads the current file
+        to its end, so that entries written to it after the last read are not lost, and tails the new file instead.
+        While entries are being read, the switch is postponed until the end of the current file is reached. If the
+        current file position lies past the file's end, resets it to the file's beginning. Returns the number of
+        entries read from the current file.
         """
 
         try:
             stat_results = os.stat(self.logfile_name)
         except OSError:
             logging.info('The file %s has been removed.', self.logfile_name)
+            self.file_removed = True
         else:
+            self.file_removed = False
             expected_logfile_id = self.logfile_id
             actual_logfile_id = get_device_and_inode_string(stat_results)
             current_position = self.logfile.tell()
             file_size = stat_results.st_size
 
             if expected_logfile_id != actual_logfile_id:
+                if self.entry_counts is not None:
+                    self.rotation_pending = True
+                    return 0
                 logging.info('The file %s has been rotated.', self.logfile_name)
+                self.rotation_pending = False
+                entry_count = self._read_to_end(self.logfile)
                 self._close_file()
                 self._open_file()
-            elif current_position > file_size:
+                return entry_count
+            # The position in a gzip file is an offset into the uncompressed data and cannot be compared with the size
+            # of the file.
+            elif current_position > file_size and not self.logfile_name.endswith('.gz'):
                 logging.info('The file %s has been truncated.', self.logfile_name)
                 self.logfile.seek(0)
+        return 0
 
-    def _adjust_loglevel_suppression(self):
+    def _adjust_loglevel_suppression(self, queue_length=None):
+        if queue_length is None:
+            queue_length = len(self.receiver)
         levels = LogLevel.TRACE, LogLevel.DEBUG, LogLevel.INFO
         start_thresholds = [getattr(self, 'START_SUPPRESSING_{0}_ENTRIES_QUEUE_LENGTH'.format(l)) for l in levels]
         stop_thresholds = [getattr(self, 'STOP_SUPPRESSING_{0}_ENTRIES_QUEUE_LENGTH'.format(l)) for l in levels]
 
         for level, threshold in zip(levels, start_thresholds):
-            if len(self.receiver) >= threshold and level.priority > self.suppressed_log_level:
+            if queue_length >= threshold and level.priority > self.suppressed_log_level:
                 self.suppressed_log_level = level.priority
                 logging.info('Started suppressing %s entries. The queue has reached the length %d.', level, threshold)
 
         for level, threshold in zip(levels, stop_thresholds):
-            if self.suppressed_log_level >= level.priority and len(self.receiver) <= threshold:
+            if self.suppressed_log_level >= level.priority and queue_length <= threshold:
                 self.suppressed_log_level = level.priority - 1
                 logging.info('Stopped suppressing %s entries. The queue length has fallen below %d.', level, threshold)
 
+    def _wait_for_queue(self):
+        """
+        If the queue of the receiver has reached QUEUE_LIMIT, pauses the reader until the queue length has fallen to
+        RESUME_QUEUE_LENGTH. The entries that have not been read yet stay in the file in the meantime.
+
+        An ordered receiver cannot pass on its entries while it waits for those of a file that is behind the others,
+        which may be this one or one read by the same thread. The reader therefore only pauses while the receiver can
+        pass on entries, as the queue would not shrink otherwise.
+        """
+
+        if len(self.receiver) < self.QUEUE_LIMIT or not self._receiver_can_pass_on():
+            return
+        logging.info('Paused reading %s. The queue has reached the length %d.', self.logfile_name, self.QUEUE_LIMIT)
+        while len(self.receiver) > self.RESUME_QUEUE_LENGTH:
+            if not self._receiver_can_pass_on():
+                logging.info('Resumed reading %s. The queue waits for a file that is behind.', self.logfile_name)
+                return
+            time.sleep(self.NO_ENTRIES_SLEEP_INTERVAL)
+        logging.info('Resumed reading %s. The queue length has fallen below %d.', self.logfile_name,
+                     self.RESUME_QUEUE_LENGTH)
+
+    def _receiver_can_pass_on(self):
+        can_pass_on = getattr(self.receiver, 'can_pass_on', None)
+        return can_pass_on is None or can_pass_on()
+
+    def _adjust_sampling(self, queue_length=None):
+        if queue_length is None:
+            queue_length = len(self.receiver)
+        if not self.sampling and queue_length >= self.QUEUE_LIMIT:
+            self.sampling = True
+            logging.info('Started sampling entries below WARN. The queue has reached the length %d.', self.QUEUE_LIMIT)
+        elif self.sampling and queue_length <= self.RESUME_QUEUE_LENGTH:
+            self.sampling = False
+            logging.info('Stopped sampling entries. The queue length has fallen below %d.', self.RESUME_QUEUE_LENGTH)
+
+    def _sample(self, entries):
+        """Returns the given entries, of which only every SAMPLE_INTERVAL-th entry below WARN is kept."""
+
+        warn_priority = LogLevel.WARN.priority
+        sample_interval = self.SAMPLE_INTERVAL
+        sampled_entry_count = self.sampled_entry_count
+        sampled_entries = []
+        for entry in entries:
+            if entry.level.priority < warn_priority:
+                sampled_entry_count += 1
+                if sampled_entry_count % sample_interval:
+                    continue
+            sampled_entries.append(entry)
+        self.sampled_entry_count = sampled_entry_count
+        return sampled_entries
+
+    def _set_queue_limit(self, queue_limit):
+        """Sets QUEUE_LIMIT and scales the queue lengths at which the overflow policies start and stop with it."""
+
+        cls = type(self)
+        scale = float(queue_limit) / cls.QUEUE_LIMIT
+        for name in dir(cls):
+            if name.endswith('QUEUE_LENGTH') or name == 'QUEUE_LIMIT':
+                setattr(self, name, max(1, int(getattr(cls, name) * scale)))
+
     ### PROGRESS ###
 
     def _save_progress(self):
         """
-        Saves the the reader's progress information to a file, so that the application can resume reading where it
-        left off in case it is terminated.
+        Saves the the reader's progress information, so that the application can resume reading where it left off in
+        case it is terminated. The progress is put into the progress store, if there is one, and otherwise written to
+        the file given by progress_file_path.
         """
 
         progress = self._make_progress_string()
         if progress:
+            if self.progress_store:
+                self.progress_store.put(self.logfile_name, progress)
+                return
             logging.debug('Writing progress file entry "%s".', progress)
             try:
-                with open(self.progress_file_path, 'wb') as progress_file:
-                    progress_file.write(progress)
+                write_atomically(self.progress_file_path, progress)
             except Exception:
                 logging.exception('Failed to save progress for %s.', self.logfile_name)
 
     def _load_progress(self):
         """
-        Loads the reader's progress information. Returns a tuple (filename, logfile_id, position, size).
+        Loads the reader's progress information from the progress store or, if the store has none for the file, from
+        the file given by progress_file_path. Returns a tuple (filename, logfile_id, position, size, fingerprint), where
+        fingerprint is None if it has not been saved.
         """
 
-        with open(self.progress_file_path, 'rb') as progress_file:
-            filename, logfile_id, position, size = progress_file.read().rsplit(None, 3)
-            return filename, logfile_id, int(position), int(size)
+        progress = self.progress_store.get(self.logfile_name) if self.progress_store else None
+        if progress is None:
+            with open(self.progress_file_path, 'rb') as progress_file:
+                progress = progress_file.read()
+        return parse_progress(progress)
 
     def _make_progress_string(self):
         """Constructs a progress string that expresses the progress of the reader."""
 
         try:
-            position = self.logfile.tell()
-            size = os.fstat(self.logfile.fileno()).st_size
-            return '%s %s %d %d' % (self.logfile_name, self.logfile_id, position, size)
+            position = self._get_position()
+            size = self._get_file_size()
+            progress = '%s %s %d %d' % (self.logfile_name, self.logfile_id, position, size)
+            fingerprint = self._get_fingerprint()
+            if fingerprint:
+                progress += ' ' + fingerprint
+            return progress
         except Exception:
             logging.exception('Failed to gather progress information for %s.', self.logfile_name)
             return None
 
+
+class MultiplexedLogReader(threading.Thread):
+
+    """
+    Reads the files of many LogReaders in a single thread, which saves a thread per file when thousands of files are
+    followed. The LogReaders are not started themselves. Each round, at most QUANTUM entries are read from every file
+    that has unread entries or has changed, so that a busy file cannot hold up the others. With a watcher, the thread
+    sleeps until one of the files changes or the watcher's tick has passed; otherwise, it polls all files like a
+    LogReader does. Readers that retire are dropped. If keep_running is set, the thread keeps waiting for readers to be
+    added when it has no readers left.
+    """
+
+    QUANTUM = 1024  # entries per file and round
+
+    def __init__(self, readers, watcher=None, keep_running=False):
+        threading.Thread.__init__(self, name='MultiplexedLogReader')
+        self.readers = []
+        self.watcher = watcher
+        self.keep_running = keep_running
+        self.event = threading.Event()
+        self.lock = threading.Lock()
+        for reader in readers:
+            self.add(reader)
+
+    def add(self, reader):
+        """Adds a reader, which is prepared and read by the thread from its next round on."""
+
+        reader.watcher = self.watcher
+        reader.watch_event = self.event
+        with self.lock:
+            self.readers.append(reader)
+        self.event.set()
+
+    def run(self):
+        readers = []
+        unfinished_readers = set()
+        while readers or self.readers or self.keep_running:
+            self.event.clear()
+            for reader in self._take_new_readers():
+                readers.append(reader)
+                # Every file is read in the first round after it has been added.
+                unfinished_readers.add(reader)
+
+            current_timestamp = time.time()
+            for reader in list(readers):
+                if reader.file_watch:
+                    changed, _ = reader.file_watch.pop_changes()
+                else:
+                    changed = True
+                if changed or reader in unfinished_readers:
+                    entry_count = reader.read_entries(self.QUANTUM)
+                    if reader.entry_counts is not None:
+                        unfinished_readers.add(reader)
+                        continue
+                    unfinished_readers.discard(reader)
+                    if not reader.follow:
+                        reader._save_time_index()
+                        reader._finish()
+                        readers.remove(reader)
+                        continue
+                    if entry_count == 0 and reader.file_watch:
+                        # A change without new entries may have been a truncation or a rotation.
+                        reader.last_ensure_file_is_good_call_timestamp = current_timestamp
+                        reader._ensure_file_is_good()
+                # The file has been read to its end.
+                if reader.should_retire(current_timestamp):
+                    reader.retire()
+                    readers.remove(reader)
+                    continue
+                reader._housekeep(current_timestamp)
+
+            if not unfinished_readers and (readers or self.keep_running):
+                if self.watcher or not readers:
+                    self.event.wait()
+                else:
+                    time.sleep(LogReader.NO_ENTRIES_SLEEP_INTERVAL)
+
+    def _take_new_readers(self):
+        """Prepares the readers that have been added since the last call. Returns those that are to be read."""
+
+        with self.lock:
+            new_readers, self.readers = self.readers, []
+
+        prepared_readers = []
+        for reader in new_readers:
+            try:
+                reader.prepare()
+            except Exception:
+                logging.exception('Failed to start reading %s.', reader.logfile_name)
+                reader._advance(float('inf'))
+                continue
+            if reader.reads_in_parallel():
+                reader._read_in_parallel()
+                reader._finish()
+            else:
+                prepared_readers.append(reader)
+        return prepared_readers
+
+
+class HousekeepingScheduler(threading.Thread):
+
+    """
+    Does the housekeeping of many LogReaders in one thread, so that the readers do not each look at the clock, stat
+    their file and measure the queue. Every TICK_INTERVAL seconds, the queue length is measured once and the log level
+    suppression or sampling of all readers is adjusted to it. Every ENSURE_FILE_IS_GOOD_CALL_INTERVAL seconds, all
+    files are stat'ed in one pass, and the readers of files that have been removed, replaced or truncated are asked to
+    check them. Every SAVE_PROGRESS_CALL_INTERVAL seconds, the progress the readers have put into the progress store
+    since the last time is flushed at once, and the readers are asked for their progress again.
+    """
+
+    TICK_INTERVAL = 1  # seconds
+
+    def __init__(self, receiver, progress_store=None):
+        threading.Thread.__init__(self, name='HousekeepingScheduler')
+        self.daemon = True
+        self.receiver = receiver
+        self.progress_store = progress_store
+        self.readers = set()
+        self.lock = threading.Lock()
+        self.file_states = {}  # reader -> (logfile ID, size) of its file at the last check
+        self.last_file_check_timestamp = 0
+        self.last_progress_timestamp = 0
+
+    def add(self, reader):
+        with self.lock:
+            self.readers.add(reader)
+
+    def remove(self, reader):
+        with self.lock:
+            self.readers.discard(reader)
+            self.file_states.pop(reader, None)
+
+    def run(self):
+        while True:
+            time.sleep(self.TICK_INTERVAL)
+            try:
+                self.tick(time.time())
+            except Exception:
+                logging.exception('Failed to do the housekeeping.')
+
+    def tick(self, current_timestamp):
+        with self.lock:
+            readers = list(self.readers)
+
+        if current_timestamp - self.last_file_check_timestamp > LogReader.ENSURE_FILE_IS_GOOD_CALL_INTERVAL:
+            self.last_file_check_timestamp = current_timestamp
+            for reader in readers:
+                if self._has_file_changed(reader):
+                    reader.file_check_due = True
+                    reader.housekeeping_due = True
+
+        if current_timestamp - self.last_progress_timestamp > LogReader.SAVE_PROGRESS_CALL_INTERVAL:
+            self.last_progress_timestamp = current_timestamp
+            if self.progress_store:
+                self.progress_store.flush(current_timestamp)
+            for reader in readers:
+                if reader.progress_file_path:
+                    reader.progress_due = True
+                    reader.housekeeping_due = True
+
+        queue_length = len(self.receiver)
+        for reader in readers:
+            if reader.overflow_policy == 'block':
+                if queue_length >= reader.QUEUE_LIMIT:
+                    reader.queue_wait_due = True
+                    reader.housekeeping_due = True
+            elif reader.overflow_policy == 'sample':
+                reader._adjust_sampling(queue_length)
+            else:
+                reader._adjust_loglevel_suppression(queue_length)
+
+    def _has_file_changed(self, reader):
+        """
+        Returns whether the file of reader has been removed, has been replaced by another file or has shrunk since the
+        last check.
+        """
+
+        try:
+            stat_results = os.stat(reader.logfile_name)
+        except OSError:
+            return True
+        logfile_id = get_device_and_inode_string(stat_results)
+        last_logfile_id, last_size = self.file_states.get(reader, (reader.logfile_id, 0))
+        with self.lock:
+            if reader in self.readers:
+                self.file_states[reader] = logfile_id, stat_results.st_size
+        # The size of a gzip file says nothing about the uncompressed data that has been read.
+        return (logfile_id != reader.logfile_id or logfile_id != last_logfile_id or
+                (stat_results.st_size < last_size and not reader.logfile_name.endswith('.gz')))
+
+
+class LogFileDiscoverer(threading.Thread):
+
+    """
+    Starts readers for the files that match glob patterns or lie in directories, and keeps doing so as new files
+    appear. patterns is a list of (pattern, settings) tuples, and make_reader(reader_id, path, settings) creates the
+    reader of a file, which is started as a thread or, if MultiplexedLogReaders are given, added to one of them, in turn
+    by reader ID. The files found
+    by the first scan are read like files given by name; files that appear later are read from their start. Readers
+    retire when their file has been removed or has been idle for too long; a file that reappears or grows after its
+    reader has retired gets a new reader, which continues where the retired reader stopped.
+
+    Reader IDs and their slots in the aggregator's file names are reused once QUARANTINE_PERIOD seconds have passed
+    since the reader retired, so that entries of the retired reader still waiting in the aggregator are not shown with
+    the name of the next file.
+    """
+
+    SCAN_INTERVAL = 5  # seconds
+    QUARANTINE_PERIOD = 60  # seconds
+
+    def __init__(self, patterns, aggregator, make_reader, multiplexed_readers=(), short_names=True, used_names=None):
+        threading.Thread.__init__(self, name='LogFileDiscoverer')
+        self.daemon = True
+        self.patterns = patterns
+        self.aggregator = aggregator
+        self.make_reader = make_reader
+        self.multiplexed_readers = multiplexed_readers
+        self.short_names = short_names
+        self.used_names = used_names if used_names is not None else set()
+
+        self.readers = {}  # path -> reader
+        self.retired_files = {}  # path -> (logfile ID, final position) of the retired reader
+        self.free_reader_ids = collections.deque()  # (retirement timestamp, reader ID)
+        self.scanned = False
+
+        # The aggregator must not run dry while there are no readers, as new files may still appear. The discoverer
+        # hands over no entries, so it does not hold back those of the readers.
+        aggregator.register(self, watermark=float('inf'))
+
+    def run(self):
+        while True:
+            try:
+                self.scan(time.time())
+            except Exception:
+                logging.exception('Failed to look for new log files.')
+            time.sleep(self.SCAN_INTERVAL)
+
+    def scan(self, current_timestamp):
+        """Releases the IDs of retired readers and starts readers for new files."""
+
+        for path, reader in self.readers.items():
+            if reader.retired:
+                del self.readers[path]
+                self.retired_files[path] = reader.final_position
+                self.used_names.discard(self.aggregator.file_names[reader.reader_id])
+                self.free_reader_ids.append((current_timestamp, reader.reader_id))
+
+        paths = set()
+        for pattern, settings in self.patterns:
+            for path in find_log_files(pattern):
+                paths.add(path)
+                if path not in self.readers and self._has_changed(path):
+                    self._start_reader(path, settings, current_timestamp)
+
+        # Forget files that have disappeared.
+        for path in list(self.retired_files):
+            if path not in paths:
+                del self.retired_files[path]
+        self.scanned = True
+
+    def _has_changed(self, path):
+        """Returns whether the file at path is new or has been changed since its reader retired."""
+
+        if path not in self.retired_files:
+            return True
+        logfile_id, position = self.retired_files[path]
+        try:
+            stat_results = os.stat(path)
+        except OSError:
+            return False
+        return get_device_and_inode_string(stat_results) != logfile_id or stat_results.st_size != position
+
+    def _start_reader(self, path, settings, current_timestamp):
+        if self.free_reader_ids and current_timestamp - self.free_reader_ids[0][0] >= self.QUARANTINE_PERIOD:
+            _, reader_id = self.free_reader_ids.popleft()
+        else:
+            reader_id = len(self.aggregator.file_names)
+
+        name = path
+        if self.short_names:
+            name = make_unique_name(get_short_name(path), self.used_names)
+        self.used_names.add(name)
+        self.aggregator.register(reader_id, name)
+
+        logging.info('Found the log file %s.', path)
+        reader = self.make_reader(reader_id, path, settings)
+        if path in self.retired_files:
+            reader.resume_position = self.retired_files.pop(path)
+        elif self.scanned:
+            # No file has the ID None, so the new file is read from its start.
+            reader.resume_position = None, 0
+        self.readers[path] = reader
+        if self.multiplexed_readers:
+            self.multiplexed_readers[reader_id % len(self.multiplexed_readers)].add(reader)
+        else:
+            reader.start()
+
+
+def find_log_files(pattern):
+    """Returns the sorted paths of the regular files in the directory pattern, or of those that match the glob."""
+
+    if os.path.isdir(pattern):
+        paths = [os.path.join(pattern, name) for name in os.listdir(pattern)]
+    else:
+        paths = glob.glob(pattern)
+    return sorted(path for path in paths if os.path.isfile(path))
+
+
+def is_file_pattern(pattern):
+    """Returns whether pattern is a glob or a directory rather than the path of a single file."""
+
+    return glob.has_magic(pattern) or os.path.isdir(pattern)
+
+
+def read_range(task):
+    """
+    Parses the byte range [start, stop) of a log file and filters its entries. Runs in a worker process of the pool of
+    a LogReader. Returns the matching entries, numbered from 0 within the range, and the number of entries in the range.
+    """
+
+    logfile_name, reader_id, start, stop, parser, entry_filter = task
+
+    with io.open(logfile_name, 'rb') as logfile:
+        logfile.seek(start)
+        data = logfile.read(stop - start)
+
+    entries = []
+    entry_count = 0
+    for entry in parser.read(reader_id, io.BytesIO(data)):
+        if entry_filter.matches(entry):
+            entries.append(entry)
+        entry_count += 1
+    return entries, entry_count
@@ -0,0 +1,77 @@
+"""
+Ring buffers in shared memory that pass records from one process to another without pickling them.
+
+A ring is created before the process that writes to it is forked, so that both processes share its memory. Records are
+byte strings, which are copied into the ring behind a length header and copied out of it again by the reading process.
+A writer waits while the ring is too full for its record, a reader while the ring is empty.
+"""
+
+import mmap
+import multiprocessing
+import struct
+
+RECORD_HEADER = struct.Struct('<I')
+
+
+class SharedRing(object):
+
+    """
+    A ring buffer of size bytes in anonymous shared memory. The positions are counted in bytes written and read since
+    the ring was created, so they only ever grow and the ring is empty when they are equal. Each record is written by
+    one process and read by one process; within a process, several threads may write or read.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.buffer = mmap.mmap(-1, size)
+        self.positions = multiprocessing.RawArray('l', 2)  # bytes written, bytes read
+        self.condition = multiprocessing.Condition()
+
+    def write(self, record):
+        """Appends the record to the ring, waiting until there is room for it."""
+
+        data = RECORD_HEADER.pack(len(record)) + record
+        if len(data) > self.size:
+            raise ValueError('A record of %d bytes does not fit into a ring of %d bytes.' % (len(record), self.size))
+        positions = self.positions
+        with self.condition:
+            while self.size - (positions[0] - positions[1]) < len(data):
+                self.condition.wait()
+            self._copy_in(positions[0], data)
+            positions[0] += len(data)
+            self.condition.notify_all()
+
+    def read(self, timeout=None):
+        """Takes the oldest record out of the ring. Returns None if there is none after timeout seconds."""
+
+        positions = self.positions
+        with self.condition:
+            if positions[0] == positions[1]:
+                self.condition.wait(timeout)
+                if positions[0] == positions[1]:
+                    return None
+            start = positions[1]
+            length = RECORD_HEADER.unpack(self._copy_out(start, RECORD_HEADER.size))[0]
+            record = self._copy_out(start + RECORD_HEADER.size, length)
+            positions[1] += RECORD_HEADER.size + length
+            self.condition.notify_all()
+        return record
+
+    def __len__(self):
+        """Returns the number of bytes in the ring."""
+
+        return self.positions[0] - self.positions[1]
+
+    def _copy_in(self, position, data):
+        offset = position % self.size
+        head = data[:self.size - offset]
+        self.buffer[offset:offset + len(head)] = head
+        if len(head) < len(data):
+            self.buffer[:len(data) - len(head)] = data[len(head):]
+
+    def _copy_out(self, position, length):
+        offset = position % self.size
+        data = self.buffer[offset:min(offset + length, self.size)]
+        if len(data) < length:
+            data += self.buffer[:length - len(data)]
+        return data
@@ -0,0 +1,104 @@
+"""
+The progress of the readers of many files in a single file.
+
+Readers put their progress into the store whenever they save it, which only updates a dict. About every FLUSH_INTERVAL
+seconds, the progress of all files is written at once to a temporary file, which then replaces the store file, so that
+the store file is always complete, even if logfire is terminated while writing it.
+"""
+
+import logging
+import os
+import threading
+import time
+
+
+def parse_progress(progress):
+    """
+    Parses a progress string of a reader. Returns a tuple (filename, logfile_id, position, size, fingerprint), where
+    fingerprint is None if the progress has been saved without one.
+    """
+
+    # The fingerprint is optional. It is the only field that consists of 40 characters.
+    fingerprint = None
+    rest, last_field = progress.rsplit(None, 1)
+    if len(last_field) == 40:
+        progress, fingerprint = rest, last_field
+    filename, logfile_id, position, size = progress.rsplit(None, 3)
+    return filename, logfile_id, int(position), int(size), fingerprint
+
+
+def write_atomically(path, data):
+    """Replaces the file at path with one that contains data. The file is either replaced completely or not at all."""
+
+    temporary_path = path + '.tmp'
+    with open(temporary_path, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(temporary_path, path)
+
+
+class ProgressStore(object):
+
+    """
+    Stores the progress strings of all readers, keyed by the names of their files, in the file at path, one line per
+    file. The store is shared by the reader threads.
+    """
+
+    FLUSH_INTERVAL = 5  # seconds
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.progress = self._read()
+        self.changed = False
+        self.last_flush_timestamp = time.time()
+
+    def get(self, logfile_name):
+        """Returns the progress string of the given file, or None if there is none."""
+
+        with self.lock:
+            return self.progress.get(logfile_name)
+
+    def put(self, logfile_name, progress, current_timestamp=None):
+        """Sets the progress string of the given file. Flushes the store once FLUSH_INTERVAL has passed."""
+
+        current_timestamp = current_timestamp or time.time()
+        with self.lock:
+            self.progress[logfile_name] = progress
+            self.changed = True
+            flush = current_timestamp - self.last_flush_timestamp >= self.FLUSH_INTERVAL
+        if flush:
+            self.flush(current_timestamp)
+
+    def flush(self, current_timestamp=None):
+        """Writes the progress of all files to the store file, unless nothing has changed since the last flush."""
+
+        with self.flush_lock:
+            with self.lock:
+                if not self.changed:
+                    return
+                self.changed = False
+                self.last_flush_timestamp = current_timestamp or time.time()
+                data = ''.join(progress + '\n' for progress in self.progress.itervalues())
+            try:
+                write_atomically(self.path, data)
+            except EnvironmentError:
+                logging.exception('Failed to write the progress store %s.', self.path)
+                with self.lock:
+                    self.changed = True
+
+    def _read(self):
+        progress_by_name = {}
+        try:
+            with open(self.path, 'rb') as store_file:
+                lines = store_file.read().splitlines()
+        except IOError:
+            return progress_by_name
+        for line in lines:
+            try:
+                progress_by_name[parse_progress(line)[0]] = line
+            except ValueError:
+                logging.warning('Skipped the invalid line "%s" of the progress store %s.', line, self.path)
+        return progress_by_name
@@ -0,0 +1,164 @@
+"""
+Queues of entries that spill to disk once they take up too much memory.
+
+All queues of a store share one memory budget. While the entries kept in memory by the queues of the store take up
+more than the budget, entries added to a queue are appended to segment files in the spill directory instead, in
+compressed batches. The entries of a queue are taken out in the order they were added: the entries in memory first,
+then the spilled ones, one batch at a time, and entries added while a queue has spilled entries are spilled as well.
+Segment files are deleted once all their entries have been taken out. Spilled entries only live as long as the process.
+"""
+
+import collections
+import io
+import logging
+import os
+import shutil
+import struct
+import tempfile
+import threading
+import zlib
+
+try:
+    import cPickle as pickle
+except ImportError:  #pragma: nocover
+    import pickle
+
+SEGMENT_SIZE = 64 * 1024 * 1024  # bytes
+RECORD_HEADER = struct.Struct('<I')
+
+
+class SpillStore(object):
+
+    """
+    Creates queues that share a budget of memory_budget bytes. size_of(entry) estimates the memory an entry takes up.
+    The segment files are written to a directory of their own in spill_directory, which is removed by close().
+    """
+
+    def __init__(self, spill_directory, memory_budget, size_of):
+        self.directory = tempfile.mkdtemp(prefix='logfire-spill-', dir=spill_directory)
+        self.memory_budget = memory_budget
+        self.size_of = size_of
+        self.memory_size = 0
+        self.lock = threading.Lock()
+        self.segment_count = 0
+
+    def create_queue(self):
+        return SpillQueue(self)
+
+    def is_full(self):
+        return self.memory_size > self.memory_budget
+
+    def allocate(self, size):
+        with self.lock:
+            self.memory_size += size
+
+    def new_segment_path(self):
+        with self.lock:
+            self.segment_count += 1
+            return os.path.join(self.directory, 'segment-%08d' % self.segment_count)
+
+    def close(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+class SpillQueue(object):
+
+    """
+    A FIFO queue of entries that are kept in memory or in segment files of its store. Supports the operations of a
+    deque that the aggregators use: append(), extend(), popleft(), [0] and len(). Safe to use from several threads.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self.entries = collections.deque()  # the entries in memory, which come before the spilled ones
+        self.sizes = collections.deque()  # the estimated size of every entry in memory
+        self.segment_paths = collections.deque()  # the segment files with spilled entries, oldest first
+        self.write_file = None
+        self.read_file = None
+        self.spilled_entry_count = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries) + self.spilled_entry_count
+
+    def append(self, entry):
+        self.extend((entry,))
+
+    def extend(self, entries):
+        entries = list(entries)
+        if not entries:
+            return
+        with self.lock:
+            if self.spilled_entry_count or self.store.is_full():
+                self._spill(entries)
+            else:
+                self._keep(entries)
+
+    def popleft(self):
+        with self.lock:
+            if not self.entries:
+                self._load_batch()
+            entry = self.entries.popleft()
+            self.store.allocate(-self.sizes.popleft())
+            return entry
+
+    def __getitem__(self, index):
+        if index != 0:
+            raise IndexError('Only the first entry of a spill queue can be looked at.')
+        with self.lock:
+            if not self.entries:
+                self._load_batch()
+            return self.entries[0]
+
+    def _keep(self, entries):
+        sizes = map(self.store.size_of, entries)
+        self.entries.extend(entries)
+        self.sizes.extend(sizes)
+        self.store.allocate(sum(sizes))
+
+    def _spill(self, entries):
+        if self.write_file is None or self.write_file.tell() >= SEGMENT_SIZE:
+            if self.write_file is not None:
+                self.write_file.close()
+            path = self.store.new_segment_path()
+            self.write_file = open(path, 'wb')
+            self.segment_paths.append(path)
+        data = zlib.compress(pickle.dumps(entries, pickle.HIGHEST_PROTOCOL), 1)
+        self.write_file.write(RECORD_HEADER.pack(len(data)) + data)
+        # The batch has to be readable right away.
+        self.write_file.flush()
+        self.spilled_entry_count += len(entries)
+
+    def _load_batch(self):
+        """Moves the oldest batch of spilled entries into memory. Raises IndexError if there are none."""
+
+        if not self.spilled_entry_count:
+            raise IndexError('The spill queue is empty.')
+        while True:
+            if self.read_file is None:
+                self.read_file = io.open(self.segment_paths[0], 'rb')
+            header = self.read_file.read(RECORD_HEADER.size)
+            if header:
+                break
+            # The oldest segment has been read completely. All batches have been written to it, as there are more.
+            self.read_file.close()
+            self.read_file = None
+            os.remove(self.segment_paths.popleft())
+        data = self.read_file.read(RECORD_HEADER.unpack(header)[0])
+        entries = pickle.loads(zlib.decompress(data))
+        self.spilled_entry_count -= len(entries)
+        self._keep(entries)
+        if not self.spilled_entry_count:
+            # Everything that has been spilled is in memory now, so the segments can go.
+            self._remove_segments()
+
+    def _remove_segments(self):
+        for spill_file in self.read_file, self.write_file:
+            if spill_file is not None:
+                spill_file.close()
+        self.read_file = self.write_file = None
+        while self.segment_paths:
+            try:
+                os.remove(self.segment_paths.popleft())
+            except OSError:
+                logging.exception('Failed to remove a spill segment.')
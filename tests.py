@@ -2,15 +2,33 @@ from StringIO import StringIO
 from unittest import TestCase
 
 import gzip
+import hashlib
 import logging
+import mmap
+import multiprocessing
 import os
+import pickle
 import redis
+import threading
+import time
 
+import common
+import filewatch
 import logfire
 import logreader
-from common import LogLevel, LogFilter, get_device_and_inode_string
-from logfire import Log4jParser, LogEntry, RedisOutputThread, NonOrderedLogAggregator, OrderedLogAggregator
-from logreader import LogReader
+import spillqueue
+import timeindex
+from common import LogLevel, LogFilter, SymbolTable, TimeConverter, get_device_and_inode_string
+from logfire import Log4jParser, PatternLayoutParser, LogEntry, LazyLogEntry, RedisOutputThread, OutputThread
+from logfire import MergingLogAggregator, NonOrderedLogAggregator, OrderedLogAggregator, ReorderingLogAggregator
+from logfire import ProcessReceiver, ReaderProcess, RingReaderThread
+from gzipindex import IndexedGzipFile
+from sharedring import SharedRing
+from sincedb import ProgressStore
+from spillqueue import SpillStore
+from timeindex import TimeIndex
+from logreader import HousekeepingScheduler, LogFileDiscoverer, LogReader, MultiplexedLogReader, find_log_files, \
+    is_file_pattern
 
 
 class Log4jParserTests(TestCase):
@@ -222,6 +240,201 @@ class Log4jParserTests(TestCase):
         self.assertEqual(len(entries), 2)
         self.assertEqual(entries[1].message, 'No error! That\'s weird.')
 
+    def test_read_in_blocks_yields_the_same_entries(self):
+        """Reading in blocks yields the same entries as reading line by line, regardless of the block size."""
+
+        contents = '\n'.join([self.sample_multiline_entry, 'NO_DATE', self.another_sample_line,
+                              self.sample_multiline_entry, '', self.another_sample_line]) + '\n'
+        expected = list(Log4jParser().read(0, StringIO(contents)))
+        self.assertEqual(len(expected), 4)
+        for block_size in (1, 7, 64, 1024):
+            entries = list(Log4jParser(block_size=block_size).read(0, StringIO(contents)))
+            self.assertEqual(entries, expected)
+
+    def test_read_in_blocks_does_not_seek(self):
+        """Reading in blocks consumes the file sequentially."""
+
+        logfile = StringIO(self.sample_multiline_entry + '\n' + self.another_sample_line)
+        logfile.seek = lambda *args: 1/0
+        entries = list(Log4jParser(block_size=16).read(0, logfile))
+        self.assertEqual(len(entries), 2)
+        self.assertEqual(entries[1].entry_number, 1)
+
+    def test_read_memory_mapped_file_yields_the_same_entries(self):
+        """Reading a memory-mapped file yields the same entries as reading it line by line."""
+
+        contents = '\n'.join([self.sample_multiline_entry, self.another_sample_line, self.sample_multiline_entry,
+                              '', self.another_sample_line])
+        expected = list(Log4jParser().read(0, StringIO(contents)))
+        self.assertEqual(len(expected), 4)
+        try:
+            with open('log.log', 'wb') as f:
+                f.write(contents)
+            with open('log.log', 'rb') as f:
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                self.assertEqual(list(Log4jParser().read(0, mapped)), expected)
+                self.assertEqual(mapped.tell(), len(contents))
+                mapped.close()
+        finally:
+            os.remove('log.log')
+
+    def test_find_entry_start(self):
+        """Entry starts are found at line starts with a timestamp only."""
+
+        buffer = 'X' * 24 + '\n' + self.sample_line + '\n2000 is not a timestamp\n' + self.another_sample_line
+        parser = Log4jParser()
+        self.assertEqual(parser.find_entry_start(buffer, 0), 25)
+        self.assertEqual(parser.find_entry_start(buffer, 25), 25)
+        self.assertEqual(parser.find_entry_start(buffer, 26), buffer.rindex('\n') + 1)
+        self.assertEqual(parser.find_entry_start(buffer, len(buffer)), -1)
+        self.assertEqual(parser.find_entry_start(self.sample_line, 0), 0)
+
+
+class LazyLogEntryTests(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.contents = ('2000-01-01 00:00:01,000 FlowID ERROR Thread C.m(C.java:23): Error!\nE: :(\n    at D.n(D.java:42)\n'
+                        '2000-01-01 00:00:00,001 FlowID DEBUG Thread2 D.n(D.java:25): Debug! \n'
+                        '2000-01-01 00:00:02,000 FlowID INFO Thread C.m(C.java:24): Info')
+
+    def read_lazily(self, **kwargs):
+        entries = list(Log4jParser(lazy=True, **kwargs).read(0, StringIO(self.contents)))
+        self.assertTrue(all(isinstance(e, LazyLogEntry) for e in entries))
+        return entries
+
+    def test_lazy_entries_decode_to_the_same_entries(self):
+        expected = list(Log4jParser().read(0, StringIO(self.contents)))
+        self.assertEqual([e.to_entry() for e in self.read_lazily()], expected)
+        self.assertEqual([e.to_entry() for e in self.read_lazily(block_size=16)], expected)
+        entries = list(PatternLayoutParser('%d %x %p %t %l: %m%n', lazy=True).read(0, StringIO(self.contents)))
+        self.assertEqual([e.to_entry() for e in entries], expected)
+
+    def test_fields_are_decoded_on_demand(self):
+        entry = self.read_lazily()[0]
+        self.assertEqual(entry.level, LogLevel.ERROR)
+        self.assertEqual(entry._fields, None)
+        self.assertEqual(entry.message, 'Error!\nE: :(\n    at D.n(D.java:42)')
+        self.assertEqual((entry.flow_id, entry.thread, entry.class_, entry.method, entry.source_file, entry.line),
+                         ('FlowID', 'Thread', 'C', 'm', 'C.java', 23))
+
+    def test_size_is_estimated_without_decoding(self):
+        entry = self.read_lazily()[0]
+        size = logfire.estimate_entry_size(entry)
+        self.assertEqual(entry._fields, None)
+        self.assertEqual(size, logfire.ENTRY_SIZE + len(entry._raw))
+        self.assertEqual(logfire.estimate_entry_size(entry.to_entry()), logfire.ENTRY_SIZE + len(entry.message))
+
+    def test_lines_that_do_not_match_the_layout_are_skipped(self):
+        logfire.logging = FakeLogging()
+        try:
+            entries = list(Log4jParser(lazy=True).read(0, StringIO('2000-01-01 00:00:00,000 GARBAGE\n' + self.contents)))
+        finally:
+            logfire.logging = logging
+        self.assertEqual(len(entries), 3)
+        self.assertEqual(entries[0].entry_number, 0)
+
+    def test_ordering(self):
+        aggregator = OrderedLogAggregator([])
+        for entry in self.read_lazily():
+            aggregator.add(entry)
+        self.assertEqual([e.level for e in aggregator.get()], [LogLevel.DEBUG, LogLevel.ERROR, LogLevel.INFO])
+
+    def test_batches(self):
+        batches = list(Log4jParser().read_batches(0, StringIO(self.contents), 2))
+        self.assertEqual([len(batch) for batch in batches], [2, 1])
+        entries = [entry for batch in batches for entry in batch.get_entries()]
+        self.assertTrue(all(isinstance(e, LazyLogEntry) for e in entries))
+        self.assertEqual([e.to_entry() for e in entries], [e.to_entry() for e in self.read_lazily()])
+        self.assertEqual(batches[0].find_entry(len(batches[0].text) - 1), 1)
+        self.assertEqual(batches[1].get_entry(0).message, 'Info')
+
+    def test_as_logstash(self):
+        entry = self.read_lazily()[1]
+        self.assertEqual(entry.as_logstash('log.log'), entry.to_entry().as_logstash('log.log'))
+
+    def test_pickling(self):
+        entry = self.read_lazily()[0]
+        unpickled = pickle.loads(pickle.dumps(entry, pickle.HIGHEST_PROTOCOL))
+        self.assertTrue(isinstance(unpickled, LogEntry))
+        self.assertEqual(unpickled, entry.to_entry())
+
+    def test_output(self):
+        aggregator = NonOrderedLogAggregator(['LOG'])
+        aggregator.open_files.clear()
+        for entry in self.read_lazily():
+            aggregator.add(entry)
+        output = StringIO()
+        OutputThread(aggregator, fd=output).run()
+        self.assertEqual(output.getvalue().count('\n'), 5)
+        self.assertTrue('C.m C.java:23' in output.getvalue())
+
+
+class PatternLayoutParserTests(TestCase):
+
+    def setUp(self):
+        self.fake_logging = FakeLogging()
+        logfire.logging = self.fake_logging
+
+    def tearDown(self):
+        logfire.logging = logging
+
+    def test_default_layout(self):
+        """The default layout yields the same entries as the autoconfigured parser."""
+
+        contents = ('2000-01-01 00:00:00,000 FlowID ERROR Thread C.m(C.java:23): Error!\nE: :(\n    at D.n(D.java:42)\n'
+                    '2000-01-01 00:00:00,001 FlowID INFO Thread C.m(C.java:25): No error!\n')
+        expected = list(Log4jParser().read(0, StringIO(contents)))
+        parser = PatternLayoutParser('%d %x %p %t %l: %m%n')
+        self.assertEqual(list(parser.read(0, StringIO(contents))), expected)
+        parser = PatternLayoutParser('%d %x %p %t %l: %m%n', block_size=7)
+        self.assertEqual(list(parser.read(0, StringIO(contents))), expected)
+
+    def test_bracketed_thread_and_padded_level(self):
+        parser = PatternLayoutParser('%d [%t] %-5p %c - %m%n')
+        entries = list(parser.read(0, StringIO('2000-01-01 00:00:00,000 [main thread] INFO  com.example.Foo - A - B\n')))
+        self.assertEqual(len(entries), 1)
+        self.assertEqual(entries[0].thread, 'main thread')
+        self.assertEqual(entries[0].level, LogLevel.INFO)
+        self.assertEqual(entries[0].class_, 'com.example.Foo')
+        self.assertEqual(entries[0].flow_id, None)
+        self.assertEqual(entries[0].line, -1)
+        self.assertEqual(entries[0].message, 'A - B')
+
+    def test_logback_conversion_words(self):
+        parser = PatternLayoutParser(r'%d{ISO8601} %-5level [%thread] %logger{36}.%M\(%F:%L\) - %msg%n')
+        entries = list(parser.read(0, StringIO('2000-01-01 00:00:00,000 WARN  [pool-1] c.e.Foo.bar(Foo.java:12) - Hi')))
+        self.assertEqual(len(entries), 1)
+        self.assertEqual((entries[0].class_, entries[0].method, entries[0].source_file, entries[0].line),
+                         ('c.e.Foo', 'bar', 'Foo.java', 12))
+        self.assertEqual(entries[0].level, LogLevel.WARN)
+        self.assertEqual(entries[0].message, 'Hi')
+
+    def test_lines_not_matching_the_layout_are_skipped(self):
+        parser = PatternLayoutParser('%d [%t] %-5p %c - %m%n')
+        entries = list(parser.read(0, StringIO('2000-01-01 00:00:00,000 INFO Foo: unbracketed\n')))
+        self.assertEqual(entries, [])
+        self.assertEqual(len(self.fake_logging.log), 1)
+        self.assertTrue(self.fake_logging.log[0].startswith('[WARN]'))
+
+    def test_unsupported_patterns(self):
+        self.assertRaises(ValueError, PatternLayoutParser, '%p %d %m%n')
+        self.assertRaises(ValueError, PatternLayoutParser, '%d{HH:mm:ss} %p %m%n')
+        self.assertRaises(ValueError, PatternLayoutParser, '%d|%p|%m%n')
+
+    def test_autoconfigure_does_not_read(self):
+        parser = PatternLayoutParser('%d %p %m%n')
+        parser.autoconfigure(None)
+        entries = list(parser.read(0, StringIO('2000-01-01 00:00:00,000 DEBUG 100%\n')))
+        self.assertEqual(entries[0].level, LogLevel.DEBUG)
+        self.assertEqual(entries[0].message, '100%')
+
+    def test_pickling(self):
+        parser = pickle.loads(pickle.dumps(PatternLayoutParser('%d [%t] %-5p %c - %m%n')))
+        entries = list(parser.read(0, StringIO('2000-01-01 00:00:00,000 [main] INFO  com.example.App - Started\n')))
+        self.assertEqual(entries[0].thread, 'main')
+        self.assertEqual(entries[0].message, 'Started')
+
 
 class LogReaderTests(TestCase):
 
@@ -283,6 +496,78 @@ class LogReaderTests(TestCase):
             self.assertEqual(reader.receiver.entries[0].timestamp, '2000-01-01 00:00:00,000')
             self.assertEqual(reader.receiver.entries[59].timestamp, '2000-01-01 00:00:59,000')
 
+    def test_run_follow_with_watcher(self):
+        self.files_to_delete.append('log.log.1')
+        with open('log.log', 'wb') as f:
+            f.write('2000-01-01 00:00:00,000 FlowID ERROR Thread C.m(C.java:23): Error!\n')
+        watcher = filewatch.FileWatcher(tick=60)
+        watcher.start()
+        reader = LogReader(0, 'log.log', Log4jParser(), FakeReceiver(), follow=True, watcher=watcher)
+        reader.daemon = True
+        reader.start()
+
+        def wait_for_entries(count):
+            deadline = time.time() + 5
+            while len(reader.receiver.entries) < count and time.time() < deadline:
+                time.sleep(0.01)
+            self.assertEqual(len(reader.receiver.entries), count)
+
+        wait_for_entries(1)
+        with open('log.log', 'ab') as f:
+            f.write('2000-01-01 00:00:01,000 FlowID ERROR Thread C.m(C.java:23): Error!\n')
+        wait_for_entries(2)
+        os.rename('log.log', 'log.log.1')
+        with open('log.log', 'wb') as f:
+            f.write('2000-01-01 00:00:02,000 FlowID ERROR Thread C.m(C.java:23): Error!\n')
+        wait_for_entries(3)
+        with open('log.log', 'wb') as f:
+            f.write('2000-01-01 00:00:03,000 FlowID ERROR Thread C.m(C.java:23): Err\n')
+        wait_for_entries(4)
+        self.assertEqual([e.timestamp[-12:-4] for e in reader.receiver.entries],
+                         ['00:00:00', '00:00:01', '00:00:02', '00:00:03'])
+
+        def stop(current_timestamp):
+            raise SystemExit()
+        reader._maybe_do_housekeeping = stop
+        reader.file_watch.notify()
+        reader.join(5)
+        self.assertFalse(reader.is_alive())
+        watcher.close()
+
+    def test_run_follow_until_idle(self):
+        with prepared_reader(seconds=range(60)) as reader:
+            reader.follow = True
+            reader.idle_timeout = 0.01
+            reader.NO_ENTRIES_SLEEP_INTERVAL = 0.02
+            reader.run()
+            self.assertEqual(len(reader.receiver.entries), 61)
+            self.assertEqual(reader.receiver.entries[60], 'EOF 0')
+            self.assertTrue(reader.retired)
+            self.assertEqual(reader.final_position[1], os.path.getsize('log.log'))
+            self.assertEqual(reader.logfile, None)
+
+    def test_should_retire(self):
+        reader = LogReader(0, 'log.log', Log4jParser(), FakeReceiver(), follow=True)
+        reader.file_removed = True
+        self.assertFalse(reader.should_retire(reader.last_entry_timestamp + 3600))
+        reader.idle_timeout = 60
+        self.assertFalse(reader.should_retire(reader.last_entry_timestamp + 60))
+        self.assertTrue(reader.should_retire(reader.last_entry_timestamp + 61))
+        reader.retire_when_removed = True
+        self.assertTrue(reader.should_retire(reader.last_entry_timestamp))
+
+    def test_run_seek_resume_position(self):
+        with prepared_reader(seconds=range(60)) as reader:
+            reader.tail_length = 10
+            reader.resume_position = get_device_and_inode_string(os.stat('log.log')), 75
+            reader.run()
+            self.assertEqual(reader.receiver.entries[0].timestamp, '2000-01-01 00:00:01,000')
+        with prepared_reader(seconds=range(60)) as reader:
+            reader.tail_length = 10
+            reader.resume_position = None, 75
+            reader.run()
+            self.assertEqual(reader.receiver.entries[0].timestamp, '2000-01-01 00:00:00,000')
+
     def test_run_seek_tail(self):
         with prepared_reader(seconds=range(60)) as reader:
             reader.tail_length = 30
@@ -323,6 +608,17 @@ class LogReaderTests(TestCase):
             self.assertEqual(reader.receiver.entries[0].timestamp, '2000-01-01 00:00:30,000')
             self.assertEqual(reader.receiver.entries[30], 'EOF 0')
 
+    def test_run_with_batches(self):
+        with prepared_reader(seconds=range(60)) as reader:
+            reader.batch_size = 7
+            reader.entry_filter.time_from = '2000-01-01 00:00:30,000'
+            reader.entry_filter.time_to = '2000-01-01 00:00:50,000'
+            reader.run()
+            self.assertEqual(len(reader.receiver.entries), 21)
+            self.assertEqual(reader.receiver.entries[0].timestamp, '2000-01-01 00:00:30,000')
+            self.assertEqual(reader.receiver.entries[19].timestamp, '2000-01-01 00:00:49,000')
+            self.assertEqual(reader.receiver.entries[20], 'EOF 0')
+
     def test_run_with_loglevel_suppression(self):
         with open('log.log', 'wb') as f:
             f.write('2000-01-01 00:00:00,000 FlowID INFO Thread C.m(C.java:23) Info!\n')
@@ -371,6 +667,50 @@ class LogReaderTests(TestCase):
         finally:
             reader.logfile.close()
 
+    def test_open_file_with_gzip_file_follow(self):
+        self.files_to_delete.append('log.gz')
+        with gzip.open('log.gz', 'wb') as f:
+            f.write('Some file contents!')
+        reader = LogReader(0, 'log.gz', Log4jParser(), FakeReceiver(), follow=True)
+        reader._open_file()
+        try:
+            self.assertTrue(isinstance(reader.logfile, gzip.GzipFile))
+        finally:
+            reader.logfile.close()
+
+    def test_open_file_with_mmap(self):
+        with open('log.log', 'wb') as f:
+            f.write('Some file contents!')
+        reader = LogReader(0, 'log.log', Log4jParser(), FakeReceiver(), use_mmap=True)
+        reader._open_file()
+        try:
+            self.assertTrue(isinstance(reader.logfile, mmap.mmap))
+            self.assertNotEqual(reader.logfile_id, None)
+            self.assertEqual(reader._get_file_size(), 19)
+            self.assertEqual(reader.logfile.read(19), 'Some file contents!')
+        finally:
+            reader._close_file()
+
+    def test_open_file_with_mmap_follow(self):
+        with open('log.log', 'wb') as f:
+            f.write('Some file contents!')
+        reader = LogReader(0, 'log.log', Log4jParser(), FakeReceiver(), follow=True, use_mmap=True)
+        reader._open_file()
+        try:
+            self.assertFalse(isinstance(reader.logfile, mmap.mmap))
+        finally:
+            reader._close_file()
+
+    def test_open_file_with_mmap_empty_file(self):
+        with open('log.log', 'wb') as f:
+            pass
+        reader = LogReader(0, 'log.log', Log4jParser(), FakeReceiver(), use_mmap=True)
+        reader._open_file()
+        try:
+            self.assertFalse(isinstance(reader.logfile, mmap.mmap))
+        finally:
+            reader._close_file()
+
     def test_open_file_with_nonexistent_file(self):
         reader = LogReader(0, 'no.such.file', Log4jParser(), FakeReceiver())
         self.assertRaises(IOError, reader._open_file)
@@ -391,13 +731,54 @@ class LogReaderTests(TestCase):
 
     def test_seek_first_unprocessed_position(self):
         self.write_log_file('XXXX\n' * 100)
-        self.write_progress_file('log.log 123g456 50 75')
+        self.write_progress_file('log.log {0} 50 75'.format(get_device_and_inode_string(os.stat('log.log'))))
         with open('log.log', 'rb') as f:
             reader = LogReader(0, 'log.log', Log4jParser(), FakeReceiver(), progress_file_path_prefix='progress')
             reader.logfile = f
+            reader.logfile_id = get_device_and_inode_string(os.stat('log.log'))
             reader._seek_first_unprocessed_position()
             self.assertEqual(f.tell(), 50)
-            self.assertEqual(reader.logfile_id, '123g456')
+
+    def test_seek_first_unprocessed_position_of_another_file(self):
+        self.write_log_file('XXXX\n' * 100)
+        self.write_progress_file('log.log 123g456 50 75')
+        with open('log.log', 'rb') as f:
+            reader = LogReader(0, 'log.log', Log4jParser(), FakeReceiver(), progress_file_path_prefix='progress')
+            reader.logfile = f
+            reader.logfile_id = get_device_and_inode_string(os.stat('log.log'))
+            reader._seek_first_unprocessed_position()
+            self.assertEqual(f.tell(), 0)
+            self.assertEqual(self.fake_logging.log,
+                             ['[INFO] The file log.log has been rotated since the progress was saved.'])
+
+    def test_seek_first_unprocessed_position_finishes_rotated_file(self):
+        self.files_to_delete.append('log.log.1')
+        with prepared_reader(seconds=range(60)) as reader:
+            self.write_progress_file('log.log {0} 2250 4500'.format(get_device_and_inode_string(os.stat('log.log'))))
+        os.rename('log.log', 'log.log.1')
+        with prepared_reader(seconds=range(60, 70)) as reader:
+            reader.progress_file_path = 'progressf16c93d1167446f99a26837c0fdeac6fb73869794'
+            reader.run()
+            self.assertEqual(len(reader.receiver.entries), 41)
+            self.assertEqual(reader.receiver.entries[0].timestamp, '2000-01-01 00:00:30,000')
+            self.assertEqual(reader.receiver.entries[30].timestamp, '2000-01-01 00:01:00,000')
+            self.assertTrue('[INFO] Finishing the rotated file log.log.1 at offset 2250.' in self.fake_logging.log)
+
+    def test_seek_first_unprocessed_position_finishes_compressed_rotated_file(self):
+        self.files_to_delete.append('log.log.1.gz')
+        with prepared_reader(seconds=range(60)) as reader:
+            with open('log.log', 'rb') as f:
+                contents = f.read()
+            fingerprint = hashlib.sha1(contents[:LogReader.FINGERPRINT_SIZE]).hexdigest()
+            self.write_progress_file('log.log 123g456 2250 4500 ' + fingerprint)
+        with gzip.open('log.log.1.gz', 'wb') as f:
+            f.write(contents)
+        with prepared_reader(seconds=range(60, 70)) as reader:
+            reader.progress_file_path = 'progressf16c93d1167446f99a26837c0fdeac6fb73869794'
+            reader.run()
+            self.assertEqual(len(reader.receiver.entries), 41)
+            self.assertEqual(reader.receiver.entries[0].timestamp, '2000-01-01 00:00:30,000')
+            self.assertTrue('[INFO] Finishing the rotated file log.log.1.gz at offset 2250.' in self.fake_logging.log)
 
     def test_seek_first_unprocessed_position_no_progress_file(self):
         self.write_log_file('2000-01-01 00:00:00,000 FlowID ERROR Thread C.m(C.java:23): Error! Nooooo!\n' * 20)
@@ -422,7 +803,6 @@ class LogReaderTests(TestCase):
         self.write_log_file('2000-01-01 00:00:00,000 FlowID ERROR Thread C.m(C.java:23): Error! Nooooo!\n' * 20)
         with open('log.log', 'rb') as f:
             reader = LogReader(0, 'log.log', Log4jParser(), FakeReceiver(), tail_length=10)
-            reader.CHUNK_SIZE = 1024
             reader.logfile = f
             reader._seek_tail()
             self.assertEqual(f.tell(), 10 * 75)
@@ -431,7 +811,8 @@ class LogReaderTests(TestCase):
         self.write_log_file('2000-01-01 00:00:00,000 FlowID ERROR Thread C.m(C.java:23): Error! Nooooo!\n' * 1000)
         with open('log.log', 'rb') as f:
             reader = LogReader(0, 'log.log', Log4jParser(), FakeReceiver(), tail_length=900)
-            reader.CHUNK_SIZE = 1024
+            reader.TAIL_BLOCK_SIZE = 1000
+            reader.MAX_TAIL_BLOCK_SIZE = 4000
             reader.logfile = f
             reader._seek_tail()
             self.assertEqual(f.tell(), 100 * 75)
@@ -441,13 +822,167 @@ class LogReaderTests(TestCase):
         self.write_log_file(message * 10)
         with open('log.log', 'rb') as f:
             reader = LogReader(0, 'log.log', Log4jParser(), FakeReceiver(), tail_length=5)
-            reader.CHUNK_SIZE = 1024
             reader.logfile = f
             reader._seek_tail()
             self.assertEqual(f.tell(), 5 * 100)
 
+    def test_seek_tail_with_entry_starts_at_block_boundaries(self):
+        message = '2000-01-01 00:00:00,000 FlowID ERROR Thread C.m(C.java:23): Error!\n' + '\tat C.m(C.java:23)\n' * 3
+        self.write_log_file(message * 50 + '2000-01-01 00:00:00,000 Incomplete')
+        with open('log.log', 'rb') as f:
+            reader = LogReader(0, 'log.log', Log4jParser(), FakeReceiver())
+            reader.logfile = f
+            for block_size in range(1, 130, 7):
+                reader.TAIL_BLOCK_SIZE = reader.MAX_TAIL_BLOCK_SIZE = block_size
+                for tail_length in (1, 2, 49, 50, 51):
+                    reader.tail_length = tail_length
+                    reader._seek_tail()
+                    self.assertEqual(f.tell(), max(0, 50 - tail_length) * len(message))
+
+    def test_seek_tail_in_map(self):
+        with prepared_reader(seconds=range(60), continuation_line_count=2) as reader:
+            reader._open_file()
+            mapped_reader = LogReader(0, 'log.log', Log4jParser(), FakeReceiver(), use_mmap=True)
+            mapped_reader._open_file()
+            try:
+                for tail_length in (1, 2, 30, 59, 60, 61, 1000):
+                    reader.tail_length = mapped_reader.tail_length = tail_length
+                    reader._seek_tail()
+                    mapped_reader._seek_tail()
+                    self.assertEqual(mapped_reader.logfile.tell(), reader.logfile.tell())
+            finally:
+                reader._close_file()
+                mapped_reader._close_file()
+
     ### tests for _seek_time() ###
 
+    def test_seek_time_with_time_index(self):
+        self.files_to_delete.append('sincedb-t' + hashlib.sha1('log.log').hexdigest())
+        span = timeindex.SPAN
+        timeindex.SPAN = 4096
+        try:
+            with prepared_reader(seconds=range(0, 3000, 2), continuation_line_count=2) as reader:
+                indexing_reader = LogReader(0, 'log.log', Log4jParser(), FakeReceiver(),
+                                            index_file_path_prefix='sincedb-')
+                indexing_reader.run()
+                self.assertEqual(len(indexing_reader.receiver.entries), 1501)
+
+                seeking_reader = LogReader(0, 'log.log', Log4jParser(), FakeReceiver(),
+                                           index_file_path_prefix='sincedb-')
+                seeking_reader._open_file()
+                try:
+                    self.assertEqual(len(seeking_reader.time_index.checkpoints),
+                                     (os.path.getsize('log.log') - 1) // 4096 + 1)
+                    for second in range(-1, 3001, 7):
+                        time_string = '2000-01-01 00:%02d:%02d,000' % divmod(second, 60) if second >= 0 else '1999'
+                        reader._seek_time(time_string)
+                        seeking_reader._seek_time(time_string)
+                        self.assertEqual(seeking_reader.logfile.tell(), reader.logfile.tell())
+                finally:
+                    seeking_reader._close_file()
+        finally:
+            timeindex.SPAN = span
+
+    def test_seek_time_in_map(self):
+        with prepared_reader(seconds=range(0, 60, 2), continuation_line_count=5) as reader:
+            mapped_reader = LogReader(0, 'log.log', Log4jParser(), FakeReceiver(), use_mmap=True)
+            mapped_reader._open_file()
+            try:
+                for second in range(-1, 62):
+                    time_string = '2000-01-01 00:00:%02d,000' % second if second >= 0 else '1999'
+                    reader._seek_time(time_string)
+                    mapped_reader._seek_time(time_string)
+                    self.assertEqual(mapped_reader.logfile.tell(), reader.logfile.tell())
+            finally:
+                mapped_reader._close_file()
+
+    def test_seek_tail_and_time_in_gzip_file(self):
+        self.files_to_delete += ['log.gz', 'sincedb-z' + hashlib.sha1('log.gz').hexdigest()]
+        with prepared_reader(seconds=range(0, 3000, 2), continuation_line_count=2) as reader:
+            with open('log.log', 'rb') as f:
+                contents = f.read()
+            with gzip.open('log.gz', 'wb') as f:
+                f.write(contents)
+            reader._open_file()
+            gzip_reader = LogReader(0, 'log.gz', Log4jParser(), FakeReceiver(), index_file_path_prefix='sincedb-')
+            gzip_reader._open_file()
+            try:
+                for tail_length in (1, 30, 1500, 1501):
+                    reader.tail_length = gzip_reader.tail_length = tail_length
+                    reader._seek_tail()
+                    gzip_reader._seek_tail()
+                    self.assertEqual(gzip_reader.logfile.tell(), reader.logfile.tell())
+                for second in range(-1, 3001, 7):
+                    time_string = '2000-01-01 00:%02d:%02d,000' % divmod(second, 60) if second >= 0 else '1999'
+                    reader._seek_time(time_string)
+                    gzip_reader._seek_time(time_string)
+                    self.assertEqual(gzip_reader.logfile.tell(), reader.logfile.tell())
+            finally:
+                reader._close_file()
+                gzip_reader._close_file()
+
+            # The index has been saved and is used when the file is opened again.
+            gzip_reader._open_file()
+            try:
+                self.assertEqual(gzip_reader.logfile.index.size, len(contents))
+            finally:
+                gzip_reader._close_file()
+
+    def test_run_with_mmap(self):
+        with prepared_reader(seconds=range(60), continuation_line_count=2) as reader:
+            reader.use_mmap = True
+            reader.entry_filter.time_from = '2000-01-01 00:00:30,000'
+            reader.run()
+            self.assertEqual(len(reader.receiver.entries), 31)
+            self.assertEqual(reader.receiver.entries[0].timestamp, '2000-01-01 00:00:30,000')
+            self.assertEqual(reader.receiver.entries[0].message, 'Error! Nooooo!\n' + 'X' * 24 + '\n' + 'X' * 24)
+            self.assertEqual(reader.receiver.entries[30], 'EOF 0')
+
+    def test_run_in_parallel(self):
+        with prepared_reader(seconds=range(3000), continuation_line_count=2) as reader:
+            reader.entry_filter.time_to = '2000-01-01 00:45:00,000'
+            reader.run()
+            expected_entries = reader.receiver.entries
+
+        pool = multiprocessing.Pool(2)
+        try:
+            with prepared_reader(seconds=range(3000), continuation_line_count=2) as reader:
+                reader.PARALLEL_RANGE_SIZE = 10000
+                reader.pool = pool
+                reader.entry_filter.time_to = '2000-01-01 00:45:00,000'
+                reader.run()
+                self.assertEqual(reader.receiver.entries, expected_entries)
+                # Reading stops at the first entry that is not older than time_to.
+                self.assertEqual(reader.logfile.tell(), os.path.getsize('log.log') * 2700 // 3000)
+        finally:
+            pool.terminate()
+
+    def test_run_hands_over_entries_in_batches(self):
+        with prepared_reader(seconds=range(2500)) as reader:
+            reader.receiver = FakeBatchReceiver()
+            reader.entry_filter.levels = set([LogLevel.ERROR])
+            reader.run()
+            self.assertEqual(reader.receiver.batch_sizes, [1024, 1024, 452])
+            self.assertEqual([entry.timestamp for entry in reader.receiver.entries[:2]],
+                             ['2000-01-01 00:00:00,000', '2000-01-01 00:00:01,000'])
+
+    def test_run_stops_at_time_to(self):
+        for batch_size in None, 3:
+            with prepared_reader(seconds=range(10) + [1]) as reader:
+                reader.batch_size = batch_size
+                reader.entry_filter.time_to = '2000-01-01 00:00:05'
+                reader.run()
+                self.assertEqual([entry.timestamp[-6:-4] for entry in reader.receiver.entries[:-1]],
+                                 ['00', '01', '02', '03', '04'])
+
+    def test_find_entry_boundary(self):
+        with prepared_reader(seconds=range(3), continuation_line_count=1) as reader:
+            entry_size = len(prepared_reader.DEFAULT_MESSAGE % (0, 0)) + len(prepared_reader.DEFAULT_CONTINUATION_LINE)
+            self.assertEqual(reader._find_entry_boundary(0), entry_size)
+            self.assertEqual(reader._find_entry_boundary(1), entry_size)
+            self.assertEqual(reader._find_entry_boundary(entry_size), 2 * entry_size)
+            self.assertEqual(reader._find_entry_boundary(2 * entry_size + 1), 3 * entry_size)
+
     def test_seek_time_in_empty_file(self):
         with prepared_reader(seconds=()) as reader:
             reader._seek_time('2000-01-01 00:00:00,000')
@@ -563,9 +1098,10 @@ class LogReaderTests(TestCase):
         reader = LogReader(0, 'no.such.file', Log4jParser(), FakeReceiver())
         reader._ensure_file_is_good()
         self.assertEqual(self.fake_logging.log, ['[INFO] The file no.such.file has been removed.'])
+        self.assertTrue(reader.file_removed)
 
     def test_ensure_file_is_good_file_has_been_rotated(self):
-        with open('log.log', 'wb') as f:
+        with open('log.log', 'w+b') as f:
             f.write('Some file contents!')
             reader = LogReader(0, 'log.log', Log4jParser(), FakeReceiver())
             reader.logfile = f
@@ -578,6 +1114,37 @@ class LogReaderTests(TestCase):
             self.assertEqual(self.fake_logging.log, ['[INFO] The file log.log has been rotated.',
                                                      '[INFO] Closed log.log.', '[INFO] Opened log.log.'])
 
+    def test_ensure_file_is_good_reads_rotated_file_to_end(self):
+        self.files_to_delete.append('log.log.1')
+        message = '2000-01-01 00:00:%02d,000 FlowID ERROR Thread C.m(C.java:23): Error!\n'
+        self.write_log_file(message % 0)
+        reader = LogReader(0, 'log.log', Log4jParser(), FakeReceiver(), follow=True)
+        reader.prepare()
+        self.assertEqual(reader.read_entries(), 1)
+        with open('log.log', 'ab') as f:
+            f.write(message % 1)
+        os.rename('log.log', 'log.log.1')
+        self.write_log_file(message % 2)
+        self.assertEqual(reader._ensure_file_is_good(), 1)
+        self.assertEqual(reader.read_entries(), 1)
+        self.assertEqual([e.timestamp[-6:-4] for e in reader.receiver.entries], ['00', '01', '02'])
+        reader._close_file()
+
+    def test_ensure_file_is_good_postpones_rotation_while_reading(self):
+        self.write_log_file('2000-01-01 00:00:00,000 FlowID ERROR Thread C.m(C.java:23): Error!\n')
+        reader = LogReader(0, 'log.log', Log4jParser(), FakeReceiver(), follow=True)
+        reader.prepare()
+        logfile = reader.logfile
+        reader.logfile_id = 'not matching'
+        reader.entry_counts = iter([1])
+        self.assertEqual(reader._ensure_file_is_good(), 0)
+        self.assertTrue(reader.rotation_pending)
+        self.assertTrue(reader.logfile is logfile)
+        self.assertEqual(reader.read_entries(), 2)
+        self.assertFalse(reader.rotation_pending)
+        self.assertFalse(reader.logfile is logfile)
+        reader._close_file()
+
     def test_ensure_file_is_good_file_has_been_truncated(self):
         with open('log.log', 'wb') as f:
             f.write('Some file contents!')
@@ -635,6 +1202,137 @@ class LogReaderTests(TestCase):
         reader._adjust_loglevel_suppression()
         self.assertEqual(reader.suppressed_log_level, 2)
 
+    def test_reader_advances_watermark(self):
+        aggregator = OrderedLogAggregator(['log.log'])
+        with prepared_reader(seconds=range(3)) as reader:
+            reader.receiver = aggregator
+            reader.HAND_OVER_ENTRY_COUNT = 2
+            reader.entry_counts = reader._read_entries()
+            next(reader.entry_counts)
+            self.assertEqual(aggregator.watermarks[0] - aggregator.entries[0].time, 1000)
+            self.assertEqual(len(aggregator), 2)
+            reader.read_entries()
+            self.assertEqual(aggregator.watermarks[0], float('inf'))
+            self.assertEqual(len(aggregator), 3)
+
+
+    ### tests for the overflow policies ###
+
+    def test_maybe_do_housekeeping_blocks_instead_of_suppressing(self):
+        called = []
+        reader = LogReader(0, 'log.log', Log4jParser(), FakeReceiver(), overflow_policy='block')
+        reader._ensure_file_is_good = lambda: called.append('_ensure_file_is_good')
+        reader._adjust_loglevel_suppression = lambda: called.append('_adjust_loglevel_suppression')
+        reader._wait_for_queue = lambda: called.append('_wait_for_queue')
+        reader._maybe_do_housekeeping(23)
+        reader._maybe_do_housekeeping(23.5)
+        self.assertEqual(called, ['_ensure_file_is_good', '_wait_for_queue', '_wait_for_queue'])
+
+    def test_wait_for_queue(self):
+        lengths = iter([4, 4, 3, 2])
+        fake_receiver = type('ShrinkingQueue', (object,), {'__len__': lambda self: next(lengths)})()
+        reader = LogReader(0, 'log.log', Log4jParser(), fake_receiver, overflow_policy='block')
+        reader.NO_ENTRIES_SLEEP_INTERVAL = 0
+        reader.QUEUE_LIMIT = 4
+        reader.RESUME_QUEUE_LENGTH = 2
+        reader._wait_for_queue()
+        self.assertEqual(list(lengths), [])
+        self.assertEqual(self.fake_logging.log, [
+            '[INFO] Paused reading log.log. The queue has reached the length 4.',
+            '[INFO] Resumed reading log.log. The queue length has fallen below 2.'])
+
+    def test_wait_for_queue_resumes_once_the_receiver_waits_for_a_file(self):
+        passing_on = iter([True, True, False])
+        fake_receiver = type('StalledQueue', (object,), {'__len__': lambda self: 4,
+                                                         'can_pass_on': lambda self: next(passing_on)})()
+        reader = LogReader(0, 'log.log', Log4jParser(), fake_receiver, overflow_policy='block')
+        reader.NO_ENTRIES_SLEEP_INTERVAL = 0
+        reader.QUEUE_LIMIT = 4
+        reader.RESUME_QUEUE_LENGTH = 2
+        reader._wait_for_queue()
+        self.assertEqual(list(passing_on), [])
+        self.assertEqual(self.fake_logging.log, [
+            '[INFO] Paused reading log.log. The queue has reached the length 4.',
+            '[INFO] Resumed reading log.log. The queue waits for a file that is behind.'])
+
+        # A reader does not pause at all while the receiver waits for a file, which may be its own.
+        self.fake_logging.reset()
+        passing_on = iter([False])
+        reader._wait_for_queue()
+        self.assertEqual(self.fake_logging.log, [])
+
+    def test_block_policy_does_not_stall_ordered_merge(self):
+        # The dense file falls behind the sparse one, whose entries then fill the queue until the dense file catches up.
+        self.files_to_delete.extend(['dense.log', 'sparse.log'])
+        for file_name, entry_count, interval in [('dense.log', 2000, 10), ('sparse.log', 100, 1000)]:
+            with open(file_name, 'wb') as f:
+                for i in range(entry_count):
+                    f.write('2000-01-01 00:%02d:%02d,%03d FlowID INFO Thread C.m(C.java:23): Info!\n'
+                            % (i * interval // 60000, i * interval // 1000 % 60, i * interval % 1000))
+        for aggregator in [OrderedLogAggregator(['dense.log', 'sparse.log']),
+                           MergingLogAggregator(['dense.log', 'sparse.log'], 1000)]:
+            readers = [LogReader(fid, file_name, Log4jParser(), aggregator, overflow_policy='block', queue_limit=50)
+                       for fid, file_name in enumerate(['dense.log', 'sparse.log'])]
+            entries = []
+            output = threading.Thread(target=lambda: entries.extend(aggregator.get()))
+            for reader in readers:
+                reader.HAND_OVER_ENTRY_COUNT = 10
+                reader.NO_ENTRIES_SLEEP_INTERVAL = 0.001
+            for thread in readers + [output]:
+                thread.daemon = True
+                thread.start()
+            output.join(10)
+            self.assertFalse(output.is_alive())
+            self.assertEqual(len(entries), 2100)
+            self.assertEqual([entry.time for entry in entries], sorted(entry.time for entry in entries))
+
+    def test_wait_for_queue_below_limit(self):
+        reader = LogReader(0, 'log.log', Log4jParser(), [1, 2, 3], overflow_policy='block')
+        reader.QUEUE_LIMIT = 4
+        reader._wait_for_queue()
+        self.assertEqual(self.fake_logging.log, [])
+
+    def test_adjust_sampling(self):
+        fake_receiver = [1, 2]
+        reader = LogReader(0, 'log.log', Log4jParser(), fake_receiver, overflow_policy='sample')
+        reader.QUEUE_LIMIT = 3
+        reader.RESUME_QUEUE_LENGTH = 1
+
+        reader._adjust_sampling()
+        self.assertFalse(reader.sampling)
+
+        fake_receiver.append(3)
+        reader._adjust_sampling()
+        self.assertTrue(reader.sampling)
+
+        fake_receiver.pop()
+        reader._adjust_sampling()
+        self.assertTrue(reader.sampling)
+
+        fake_receiver.pop()
+        reader._adjust_sampling()
+        self.assertFalse(reader.sampling)
+
+    def test_hand_over_sampled_entries(self):
+        receiver = FakeBatchReceiver()
+        reader = LogReader(0, 'log.log', Log4jParser(), receiver, overflow_policy='sample')
+        reader.SAMPLE_INTERVAL = 3
+        reader.sampling = True
+        levels = [LogLevel.DEBUG, LogLevel.INFO, LogLevel.ERROR, LogLevel.INFO, LogLevel.WARN, LogLevel.TRACE,
+                  LogLevel.INFO]
+        entries = [LogEntry(i, 0, i, '', None, level, None, '', '', '', 0, '') for i, level in enumerate(levels)]
+        reader._hand_over(entries[:4])
+        reader._hand_over(entries[4:])
+        self.assertEqual([entry.entry_number for entry in receiver.entries], [2, 3, 4])
+
+    def test_set_queue_limit(self):
+        reader = LogReader(0, 'log.log', Log4jParser(), FakeReceiver(), queue_limit=1000)
+        self.assertEqual(reader.QUEUE_LIMIT, 1000)
+        self.assertEqual(reader.RESUME_QUEUE_LENGTH, 750)
+        self.assertEqual(reader.START_SUPPRESSING_TRACE_ENTRIES_QUEUE_LENGTH, 10)
+        self.assertEqual(reader.STOP_SUPPRESSING_INFO_ENTRIES_QUEUE_LENGTH, 750)
+        self.assertEqual(LogReader.QUEUE_LIMIT, 1000000)
+
 
     ### tests for _save_progress() ###
 
@@ -659,19 +1357,44 @@ class LogReaderTests(TestCase):
         self.assertFalse(os.path.exists('progressf16c93d1167446f99a26837c0fdeac6fb73869794'))
         self.assertEqual(self.fake_logging.log[-1], '[ERROR] Failed to save progress for log.log.')
 
+    def test_save_progress_to_store(self):
+        self.files_to_delete.append('progress')
+        store = ProgressStore('progress')
+        reader = LogReader(0, 'log.log', Log4jParser(), FakeReceiver(), progress_file_path_prefix='progress',
+                           progress_store=store)
+        reader._make_progress_string = lambda: 'log.log 123g456 10 19'
+        reader._save_progress()
+        self.assertEqual(store.get('log.log'), 'log.log 123g456 10 19')
+        self.assertFalse(os.path.exists('progressf16c93d1167446f99a26837c0fdeac6fb73869794'))
+
     ### tests for _load_progress() ###
 
+    def test_load_progress_from_store(self):
+        self.write_progress_file('log.log 123g456 50 75')
+        store = ProgressStore('progress')
+        reader = LogReader(0, 'log.log', Log4jParser(), FakeReceiver(), progress_file_path_prefix='progress',
+                           progress_store=store)
+        # Progress files written before the store existed are still read.
+        self.assertEqual(reader._load_progress(), ('log.log', '123g456', 50, 75, None))
+        store.put('log.log', 'log.log 123g456 60 75')
+        self.assertEqual(reader._load_progress(), ('log.log', '123g456', 60, 75, None))
+
     def test_load_progress_basic(self):
         self.write_progress_file('log.log 123g456 50 75')
         reader = LogReader(0, 'log.log', Log4jParser(), FakeReceiver(), progress_file_path_prefix='progress')
-        self.assertEqual(reader._load_progress(), ('log.log', '123g456', 50, 75))
+        self.assertEqual(reader._load_progress(), ('log.log', '123g456', 50, 75, None))
+
+    def test_load_progress_with_fingerprint(self):
+        self.write_progress_file('log.log 123g456 50 75 ' + 'f' * 40)
+        reader = LogReader(0, 'log.log', Log4jParser(), FakeReceiver(), progress_file_path_prefix='progress')
+        self.assertEqual(reader._load_progress(), ('log.log', '123g456', 50, 75, 'f' * 40))
 
     def test_load_progress_with_spaces_in_filename(self):
         self.files_to_delete.append('progressf4a53d67a02158bcc92d7d702a8f438ad18309488')
         with open('progressf4a53d67a02158bcc92d7d702a8f438ad18309488', 'wb') as f:
             f.write('log with spaces in name.log 123g456 50 75')
         reader = LogReader(0, 'log with spaces in name.log', Log4jParser(), FakeReceiver(), progress_file_path_prefix='progress')
-        self.assertEqual(reader._load_progress(), ('log with spaces in name.log', '123g456', 50, 75))
+        self.assertEqual(reader._load_progress(), ('log with spaces in name.log', '123g456', 50, 75, None))
 
     ### tests for _make_progress_string() ###
 
@@ -684,6 +1407,49 @@ class LogReaderTests(TestCase):
             reader.logfile_id = '123g456'
             self.assertEqual(reader._make_progress_string(), 'log.log 123g456 10 19')
 
+    def test_make_progress_string_with_fingerprint(self):
+        with open('log.log', 'w+b') as f:
+            f.write('X' * 2000)
+            f.seek(10)
+            reader = LogReader(0, 'log.log', Log4jParser(), FakeReceiver(), progress_file_path_prefix='progress')
+            reader.logfile = f
+            reader.logfile_id = '123g456'
+            self.assertEqual(reader._make_progress_string(),
+                             'log.log 123g456 10 2000 ' + hashlib.sha1('X' * 1024).hexdigest())
+            self.assertEqual(f.tell(), 10)
+
+    def test_run_saves_time_index_of_mapped_file(self):
+        with prepared_reader(seconds=range(60)):
+            pass
+        reader = LogReader(0, 'log.log', Log4jParser(), FakeReceiver(), use_mmap=True, index_file_path_prefix='index-')
+        self.files_to_delete.append(reader.time_index_path)
+        reader.run()
+        self.assertIsInstance(reader.logfile, mmap.mmap)
+        self.assertEqual(len(reader.receiver.entries), 61)
+        self.assertEqual(self.fake_logging.log, ['[INFO] Opened log.log.'])
+        index = TimeIndex.load(reader.time_index_path, reader.logfile_id, os.path.getsize('log.log'))
+        self.assertEqual(index.checkpoints, reader.time_index.checkpoints)
+        self.assertIn(0, index.checkpoints)
+
+    def test_progress_position_is_the_end_of_the_last_entry_handed_over(self):
+        # Reading lines, reading blocks, reading batches and reading a map.
+        for block_size, batch_size, use_mmap in (None, 0, False), (1000, 0, False), (4096, 1000, False), (None, 0, True):
+            with prepared_reader(seconds=range(3000), continuation_line_count=1) as reader:
+                entry_size = os.path.getsize('log.log') // 3000
+                reader.parser = Log4jParser(block_size=block_size)
+                reader.batch_size = batch_size
+                reader.receiver = FakeBatchReceiver()
+                reader.follow = True
+                reader.logfile_id = get_device_and_inode_string(os.fstat(reader.logfile.fileno()))
+                if use_mmap:
+                    reader.logfile = mmap.mmap(reader.logfile.fileno(), 0, access=mmap.ACCESS_READ)
+                handed_over_count = batch_size or reader.HAND_OVER_ENTRY_COUNT
+                reader.read_entries(max_entry_count=handed_over_count)
+                self.assertEqual(len(reader.receiver.entries), handed_over_count)
+                self.assertEqual(reader._get_position(), handed_over_count * entry_size)
+                reader.read_entries()
+                self.assertEqual(reader._get_position(), 3000 * entry_size)
+
     def test_make_progress_string_failure(self):
         reader = LogReader(0, 'log.log', Log4jParser(), FakeReceiver(), progress_file_path_prefix='progress')
         reader.logfile_id = '123g456'
@@ -703,31 +1469,738 @@ class LogReaderTests(TestCase):
             f.write(contents)
 
 
+class MultiplexedLogReaderTests(TestCase):
+
+    MESSAGE = '2000-01-01 00:%02d:%02d,000 FlowID ERROR Thread C.m(C.java:23): Error!\n'
+
+    def setUp(self):
+        self.fake_logging = FakeLogging()
+        logreader.logging = self.fake_logging
+        self.file_names = ['log0.log', 'log1.log', 'log2.log']
+        for file_name, entry_count in zip(self.file_names, [300, 20, 1]):
+            with open(file_name, 'wb') as f:
+                f.write(''.join(self.MESSAGE % divmod(i, 60) for i in range(entry_count)))
+
+    def tearDown(self):
+        logreader.logging = logging
+        for file_name in self.file_names:
+            os.remove(file_name)
+
+    def make_readers(self, file_names, **kwargs):
+        receiver = FakeReceiver()
+        return [LogReader(i, file_name, Log4jParser(), receiver, batch_size=10, **kwargs)
+                for i, file_name in enumerate(file_names)]
+
+    def test_read_files(self):
+        readers = self.make_readers(self.file_names + ['no.such.file'])
+        multiplexed_reader = MultiplexedLogReader(readers)
+        multiplexed_reader.QUANTUM = 50
+        multiplexed_reader.run()
+        entries = readers[0].receiver.entries
+        self.assertEqual(len(entries), 324)
+        self.assertEqual([e for e in entries if isinstance(e, str)], ['EOF 1', 'EOF 2', 'EOF 0'])
+        self.assertEqual([getattr(e, 'reader_id', e) for e in entries[:72]], [0] * 50 + [1] * 20 + ['EOF 1', 2])
+        self.assertEqual([e.entry_number for e in entries if not isinstance(e, str) and e.reader_id == 0], range(300))
+        self.assertEqual(self.fake_logging.log[-1], '[ERROR] Failed to start reading no.such.file.')
+
+    def test_read_files_saves_time_indexes(self):
+        readers = self.make_readers(self.file_names, use_mmap=True, index_file_path_prefix='index-')
+        multiplexed_reader = MultiplexedLogReader(readers)
+        multiplexed_reader.run()
+        try:
+            # The file with a single entry has no checkpoint.
+            self.assertEqual([os.path.isfile(reader.time_index_path) for reader in readers], [True, True, False])
+        finally:
+            for reader in readers:
+                if os.path.exists(reader.time_index_path):
+                    os.remove(reader.time_index_path)
+        self.assertEqual([message for message in self.fake_logging.log if message.startswith('[ERROR]')], [])
+
+    def test_follow_files(self):
+        watcher = filewatch.FileWatcher(tick=60)
+        watcher.start()
+        readers = self.make_readers(self.file_names, follow=True, tail_length=1)
+        multiplexed_reader = MultiplexedLogReader(readers, watcher)
+        multiplexed_reader.daemon = True
+        multiplexed_reader.start()
+        entries = readers[0].receiver.entries
+
+        def wait_for_entries(count):
+            deadline = time.time() + 5
+            while len(entries) < count and time.time() < deadline:
+                time.sleep(0.01)
+            self.assertEqual(len(entries), count)
+
+        wait_for_entries(3)
+        with open('log2.log', 'ab') as f:
+            f.write(self.MESSAGE % (1, 0))
+        wait_for_entries(4)
+        self.assertEqual((entries[3].reader_id, entries[3].timestamp), (2, '2000-01-01 00:01:00,000'))
+
+        def stop(current_timestamp):
+            raise SystemExit()
+        for reader in readers:
+            reader._maybe_do_housekeeping = stop
+        multiplexed_reader.event.set()
+        multiplexed_reader.join(5)
+        self.assertFalse(multiplexed_reader.is_alive())
+        watcher.close()
+
+
+class HousekeepingSchedulerTests(TestCase):
+
+    MESSAGE = '2000-01-01 00:00:%02d,000 FlowID DEBUG Thread C.m(C.java:23): Debug!\n'
+
+    def setUp(self):
+        logreader.logging = FakeLogging()
+        with open('log.log', 'wb') as f:
+            f.write(''.join(self.MESSAGE % i for i in range(10)))
+
+    def tearDown(self):
+        logreader.logging = logging
+        for file_name in 'log.log', 'progress':
+            try:
+                os.remove(file_name)
+            except OSError:
+                pass
+
+    def make_reader(self, scheduler, **kwargs):
+        reader = LogReader(0, 'log.log', Log4jParser(), scheduler.receiver, scheduler=scheduler, **kwargs)
+        reader.prepare()
+        self.addCleanup(reader._close_file)
+        return reader
+
+    def test_prepare_and_finish(self):
+        scheduler = HousekeepingScheduler(FakeReceiver())
+        reader = self.make_reader(scheduler)
+        self.assertEqual(scheduler.readers, set([reader]))
+        reader.read_entries()
+        reader._finish()
+        self.assertEqual(scheduler.readers, set())
+        self.assertEqual(len(scheduler.receiver), 11)
+
+    def test_tick_adjusts_loglevel_suppression(self):
+        scheduler = HousekeepingScheduler([1, 2, 3])
+        reader = self.make_reader(scheduler)
+        reader.START_SUPPRESSING_TRACE_ENTRIES_QUEUE_LENGTH = 2
+        reader.STOP_SUPPRESSING_TRACE_ENTRIES_QUEUE_LENGTH = 1
+        reader.START_SUPPRESSING_DEBUG_ENTRIES_QUEUE_LENGTH = 3
+        reader.STOP_SUPPRESSING_DEBUG_ENTRIES_QUEUE_LENGTH = 2
+        scheduler.tick(23)
+        self.assertEqual(reader.suppressed_log_level, LogLevel.DEBUG.priority)
+        self.assertFalse(reader.housekeeping_due)
+        reader.read_entries()
+        self.assertEqual(scheduler.receiver, [1, 2, 3])
+
+    def test_tick_asks_blocking_readers_to_wait(self):
+        scheduler = HousekeepingScheduler([1, 2, 3])
+        reader = self.make_reader(scheduler, overflow_policy='block', queue_limit=3)
+        scheduler.tick(23)
+        self.assertTrue(reader.housekeeping_due)
+        self.assertTrue(reader.queue_wait_due)
+        waited = []
+        reader._wait_for_queue = lambda: waited.append(True)
+        reader._housekeep()
+        self.assertEqual(waited, [True])
+        self.assertFalse(reader.housekeeping_due)
+        self.assertFalse(reader.queue_wait_due)
+
+    def test_tick_checks_changed_files(self):
+        scheduler = HousekeepingScheduler(FakeReceiver())
+        reader = self.make_reader(scheduler)
+        scheduler.tick(23)
+        self.assertFalse(reader.file_check_due)
+        scheduler.tick(24)
+        self.assertFalse(reader.file_check_due)
+
+        with open('log.log', 'wb') as f:
+            f.write(self.MESSAGE % 0)
+        scheduler.tick(42)
+        self.assertTrue(reader.file_check_due)
+        reader.logfile.seek(670)
+        reader._housekeep()
+        self.assertEqual(reader.logfile.tell(), 0)
+        self.assertFalse(reader.file_check_due)
+
+        os.remove('log.log')
+        scheduler.tick(64)
+        self.assertTrue(reader.file_check_due)
+        reader._housekeep()
+        self.assertTrue(reader.file_removed)
+
+    def test_tick_flushes_progress(self):
+        store = ProgressStore('progress')
+        scheduler = HousekeepingScheduler(FakeReceiver(), store)
+        reader = self.make_reader(scheduler, progress_file_path_prefix='progress', progress_store=store)
+        reader.read_entries()
+        scheduler.tick(23)
+        self.assertTrue(reader.progress_due)
+        self.assertFalse(os.path.exists('progress'))
+        reader._housekeep()
+        self.assertEqual(store.get('log.log').split()[2:4], ['670', '670'])
+        scheduler.tick(42)
+        with open('progress', 'rb') as f:
+            self.assertEqual(f.read(), store.get('log.log') + '\n')
+
+
+class LogFileDiscovererTests(TestCase):
+
+    def setUp(self):
+        logreader.logging = FakeLogging()
+        os.mkdir('logs')
+        for name in 'a.log', 'b.log':
+            with open(os.path.join('logs', name), 'wb') as f:
+                f.write('2000-01-01 00:00:00,000 FlowID ERROR Thread C.m(C.java:23): Error!\n')
+        self.aggregator = NonOrderedLogAggregator(['MAIN'])
+        self.multiplexed_reader = MultiplexedLogReader([])
+        self.discoverer = LogFileDiscoverer([('logs/*.log', 'settings')], self.aggregator, self.make_reader,
+                                            multiplexed_readers=[self.multiplexed_reader], used_names=set(['MAIN']))
+
+    def tearDown(self):
+        logreader.logging = logging
+        for name in os.listdir('logs'):
+            os.remove(os.path.join('logs', name))
+        os.rmdir('logs')
+
+    def make_reader(self, reader_id, path, settings):
+        self.assertEqual(settings, 'settings')
+        return LogReader(reader_id, path, Log4jParser(), self.aggregator, follow=True, retire_when_removed=True)
+
+    def retire(self, path):
+        reader = self.discoverer.readers[path]
+        reader.prepare()
+        reader.read_entries()
+        reader.retire()
+
+    def test_scan(self):
+        self.discoverer.scan(0)
+        self.assertEqual(self.aggregator.file_names, ['MAIN', 'A', 'B'])
+        self.assertEqual(self.aggregator.open_files, set([0, 1, 2, self.discoverer]))
+        self.assertEqual([r.logfile_name for r in self.multiplexed_reader.readers], ['logs/a.log', 'logs/b.log'])
+        self.assertEqual(self.discoverer.readers['logs/a.log'].resume_position, None)
+
+        # A new file is read from the start, but does not get the ID of the retired reader yet.
+        self.retire('logs/a.log')
+        with open('logs/c.log', 'wb') as f:
+            f.write('2000-01-01 00:00:00,000 FlowID ERROR Thread C.m(C.java:23): Error!\n')
+        self.discoverer.scan(10)
+        self.assertEqual(sorted(self.discoverer.readers), ['logs/b.log', 'logs/c.log'])
+        self.assertEqual(self.aggregator.file_names, ['MAIN', 'A', 'B', 'C'])
+        self.assertEqual(self.discoverer.readers['logs/c.log'].resume_position, (None, 0))
+
+        # The retired reader's file has grown. Its new reader continues where the retired reader stopped.
+        with open('logs/a.log', 'ab') as f:
+            f.write('2000-01-01 00:00:01,000 FlowID ERROR Thread C.m(C.java:23): Error!\n')
+        self.discoverer.scan(100)
+        reader = self.discoverer.readers['logs/a.log']
+        self.assertEqual(reader.reader_id, 1)
+        self.assertEqual(reader.resume_position[1], 67)
+        self.assertEqual(self.aggregator.file_names, ['MAIN', 'A', 'B', 'C'])
+
+    def test_retired_files_are_forgotten(self):
+        self.discoverer.scan(0)
+        self.retire('logs/a.log')
+        self.discoverer.scan(0)
+        self.assertEqual(list(self.discoverer.retired_files), ['logs/a.log'])
+        os.remove('logs/a.log')
+        self.discoverer.scan(0)
+        self.assertEqual(self.discoverer.retired_files, {})
+        self.assertEqual(list(self.discoverer.readers), ['logs/b.log'])
+
+    def test_find_log_files(self):
+        os.mkdir('logs/directory')
+        try:
+            self.assertEqual(find_log_files('logs'), ['logs/a.log', 'logs/b.log'])
+            self.assertEqual(find_log_files('logs/[a]*'), ['logs/a.log'])
+            self.assertEqual(find_log_files('logs/a.log'), ['logs/a.log'])
+        finally:
+            os.rmdir('logs/directory')
+        self.assertTrue(is_file_pattern('logs'))
+        self.assertTrue(is_file_pattern('logs/*.log'))
+        self.assertFalse(is_file_pattern('logs/a.log'))
+
+
+class FileWatcherTests(TestCase):
+
+    def setUp(self):
+        with open('log.log', 'wb') as f:
+            f.write('Some file contents!\n')
+        self.watcher = filewatch.FileWatcher(tick=60)
+        self.watcher.start()
+
+    def tearDown(self):
+        self.watcher.close()
+        for file_name in 'log.log', 'log.log.1':
+            try:
+                os.remove(file_name)
+            except OSError:
+                pass
+
+    def test_modification(self):
+        file_watch = self.watcher.watch('log.log')
+        with open('log.log', 'ab') as f:
+            f.write('More contents!\n')
+        self.assertTrue(file_watch.event.wait(5))
+        self.assertFalse(file_watch.wait())
+
+    def test_rotation(self):
+        file_watch = self.watcher.watch('log.log')
+        os.rename('log.log', 'log.log.1')
+        self.assertTrue(file_watch.event.wait(5))
+        self.assertTrue(file_watch.wait())
+        with open('log.log', 'wb') as f:
+            f.write('New file!\n')
+        self.assertTrue(file_watch.event.wait(5))
+        self.assertTrue(file_watch.wait())
+
+    def test_tick(self):
+        watcher = filewatch.FileWatcher(tick=0.01)
+        watcher.start()
+        self.assertTrue(watcher.watch('log.log').event.wait(5))
+        watcher.close()
+
+    def test_unwatch(self):
+        file_watches = [self.watcher.watch('log.log') for _ in range(2)]
+        self.assertEqual(len(self.watcher.file_watches), 1)
+        self.assertEqual(len(self.watcher.directory_watches), 1)
+        for file_watch in file_watches:
+            self.watcher.unwatch(file_watch)
+        self.assertEqual(self.watcher.file_watches, {})
+        self.assertEqual(self.watcher.directory_watches, {})
+        self.assertEqual(self.watcher.watch_descriptors, {})
+
+
+class IndexedGzipFileTests(TestCase):
+
+    def setUp(self):
+        self.contents = ''.join('Line {0} of member {1}: {2}\n'.format(i, m, hashlib.sha1(str(i)).hexdigest() * (i % 3))
+                                for m in range(3) for i in range(3000))
+        member_size = len(self.contents) // 3
+        with open('log.gz', 'wb') as f:
+            for start in range(0, len(self.contents), member_size):
+                member = gzip.GzipFile(fileobj=f, mode='wb')
+                member.write(self.contents[start:start + member_size])
+                member.close()
+
+    def tearDown(self):
+        for f in 'log.gz', 'log.gz.idx':
+            if os.path.exists(f):
+                os.remove(f)
+
+    def test_read_multiple_members(self):
+        with IndexedGzipFile('log.gz') as f:
+            self.assertEqual(f.read(), self.contents)
+            self.assertEqual(f.size, len(self.contents))
+        with IndexedGzipFile('log.gz') as f:
+            self.assertEqual(''.join(iter(f.readline, '')), self.contents)
+
+    def test_random_access(self):
+        with IndexedGzipFile('log.gz', 'log.gz.idx') as f:
+            f.index.span = 5000
+            for offset in range(0, len(self.contents), 7919) + range(len(self.contents), 0, -6007):
+                f.seek(offset)
+                self.assertEqual(f.read(3000), self.contents[offset:offset + 3000])
+                self.assertEqual(f.tell(), min(offset + 3000, len(self.contents)))
+            f.seek(-10, os.SEEK_END)
+            self.assertEqual(f.readline(), self.contents[-10:])
+            self.assertEqual(len(f.index.checkpoints), 6)
+
+        # Restarting at a checkpoint of a loaded index yields the same data.
+        with IndexedGzipFile('log.gz', 'log.gz.idx') as f:
+            self.assertEqual(f.index.size, len(self.contents))
+            for offset in range(len(self.contents), 0, -5003):
+                f.seek(offset)
+                self.assertEqual(f.read(100), self.contents[offset:offset + 100])
+
+    def test_index_of_another_file_is_not_used(self):
+        with IndexedGzipFile('log.gz', 'log.gz.idx') as f:
+            f.read()
+        with open('log.gz', 'ab') as f:
+            member = gzip.GzipFile(fileobj=f, mode='wb')
+            member.write('More!\n')
+            member.close()
+        with IndexedGzipFile('log.gz', 'log.gz.idx') as f:
+            self.assertEqual(f.index.size, None)
+            self.assertEqual(f.size, len(self.contents) + 6)
+
+
+class ProgressStoreTests(TestCase):
+
+    def tearDown(self):
+        for path in 'progress', 'progress.tmp':
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def test_put_and_flush(self):
+        store = ProgressStore('progress')
+        self.assertEqual(store.get('log.log'), None)
+        store.put('log.log', 'log.log 123g456 10 19', store.last_flush_timestamp)
+        store.put('log with spaces.log', 'log with spaces.log 123g789 5 5', store.last_flush_timestamp)
+        self.assertFalse(os.path.exists('progress'))
+        store.put('log.log', 'log.log 123g456 19 19', store.last_flush_timestamp + store.FLUSH_INTERVAL)
+        self.assertFalse(store.changed)
+        self.assertFalse(os.path.exists('progress.tmp'))
+
+        loaded_store = ProgressStore('progress')
+        self.assertEqual(loaded_store.get('log.log'), 'log.log 123g456 19 19')
+        self.assertEqual(loaded_store.get('log with spaces.log'), 'log with spaces.log 123g789 5 5')
+
+    def test_invalid_lines_are_skipped(self):
+        with open('progress', 'wb') as f:
+            f.write('log.log 123g456 10 19\ntorn\n')
+        store = ProgressStore('progress')
+        self.assertEqual(store.progress, {'log.log': 'log.log 123g456 10 19'})
+
+
+class SpillQueueTests(TestCase):
+
+    def setUp(self):
+        os.mkdir('spill')
+        self.store = SpillStore('spill', 10, lambda entry: 4)
+
+    def tearDown(self):
+        self.store.close()
+        os.rmdir('spill')
+
+    def get_segment_names(self):
+        return sorted(os.listdir(self.store.directory))
+
+    def test_spill_and_replay_in_order(self):
+        queue = self.store.create_queue()
+        other_queue = self.store.create_queue()
+        queue.extend([0, 1, 2])
+        self.assertEqual(self.store.memory_size, 12)
+        # The budget is shared, so the other queue spills as well.
+        other_queue.append('a')
+        queue.extend([3, 4])
+        queue.append(5)
+        self.assertEqual(len(queue), 6)
+        self.assertEqual(len(self.get_segment_names()), 2)
+        self.assertEqual(list(queue.entries), [0, 1, 2])
+
+        self.assertEqual([queue.popleft() for _ in range(3)], [0, 1, 2])
+        self.assertEqual(self.store.memory_size, 0)
+        self.assertEqual(queue[0], 3)
+        self.assertEqual(self.store.memory_size, 8)
+        # Entries added while there are spilled entries are spilled, too.
+        queue.append(6)
+        self.assertEqual([queue.popleft() for _ in range(4)], [3, 4, 5, 6])
+        self.assertEqual(len(self.get_segment_names()), 1)
+        self.assertRaises(IndexError, queue.popleft)
+        self.assertEqual(other_queue.popleft(), 'a')
+        self.assertEqual(self.get_segment_names(), [])
+        self.assertEqual(self.store.memory_size, 0)
+
+    def test_segments_are_rotated(self):
+        spillqueue.SEGMENT_SIZE = 1
+        try:
+            queue = self.store.create_queue()
+            queue.extend([0, 1, 2])
+            for i in range(3, 6):
+                queue.append(i)
+            self.assertEqual(len(self.get_segment_names()), 3)
+            self.assertEqual(queue.popleft(), 0)
+            self.assertEqual([queue.popleft() for _ in range(4)], [1, 2, 3, 4])
+            # The first segment has been read completely, the second one is being read.
+            self.assertEqual(len(self.get_segment_names()), 2)
+            queue.append(6)
+            self.assertEqual([queue.popleft() for _ in range(2)], [5, 6])
+            self.assertEqual(self.get_segment_names(), [])
+        finally:
+            spillqueue.SEGMENT_SIZE = 64 * 1024 * 1024
+
+    def test_entries_are_spilled_as_log_entries(self):
+        queue = self.store.create_queue()
+        queue.extend(range(3))
+        lazy_entry = LazyLogEntry(0, 0, 0, '', LogLevel.INFO, 'Message', lambda line: (None,) * 7 + (line,))
+        queue.append(lazy_entry)
+        queue.extend(range(3))
+        for _ in range(3):
+            queue.popleft()
+        spilled_entry = queue.popleft()
+        self.assertEqual(spilled_entry, lazy_entry.to_entry())
+        self.assertTrue(spilled_entry.level is LogLevel.INFO)
+
+
+class SharedRingTests(TestCase):
+
+    def test_records_wrap_around(self):
+        ring = SharedRing(32)
+        self.assertIsNone(ring.read(0))
+        for i in range(20):
+            ring.write('record %02d' % i)
+            ring.write('')
+            self.assertEqual(len(ring), 13 + 4)
+            self.assertEqual(ring.read(), 'record %02d' % i)
+            self.assertEqual(ring.read(), '')
+        self.assertEqual(len(ring), 0)
+        self.assertIsNone(ring.read(0))
+        self.assertRaises(ValueError, ring.write, 'x' * 29)
+
+    def test_records_pass_between_processes(self):
+        ring = SharedRing(256)
+
+        def write_records():
+            for i in range(1000):
+                ring.write(str(i) * (i % 50))
+
+        process = multiprocessing.Process(target=write_records)
+        process.start()
+        try:
+            for i in range(1000):
+                self.assertEqual(ring.read(5), str(i) * (i % 50))
+        finally:
+            process.join()
+        self.assertEqual(len(ring), 0)
+
+
+class ReaderProcessTests(TestCase):
+
+    def tearDown(self):
+        logfire.logging = logging
+        try:
+            os.remove('log.log')
+        except OSError:
+            pass
+
+    def test_entries_pass_through_the_ring(self):
+        process = ReaderProcess([3], None, ring_size=4096)
+        receiver = ProcessReceiver(process.ring, process.queue_length, process.passing_on)
+        parser = Log4jParser(lazy=True)
+        receiver.add_parser(3, parser)
+        lines = ['2000-01-01 00:00:0%d,000 FlowID INFO Thread C.m(C.java:23): Message %d' % (i, i) for i in range(3)]
+        lazy_entries = list(parser.read(3, StringIO('\n'.join(lines[:2]) + '\n  more')))
+        # The fields of an entry that has been decoded are passed on instead of its raw text.
+        self.assertEqual(lazy_entries[1].message, 'Message 1\n  more')
+        plain_entry = next(Log4jParser().read(3, StringIO(lines[2])))._replace(entry_number=2)
+        receiver.add_batch(lazy_entries + [plain_entry])
+        receiver.max_record_size = 1
+        receiver.add(plain_entry)
+        receiver.add_batch([plain_entry, plain_entry])
+        receiver.advance(3, float('inf'))
+        receiver.eof(3)
+
+        aggregator = FakeBatchReceiver()
+        aggregator.advance = lambda fid, watermark: aggregator.entries.append('ADVANCE {0} {1}'.format(fid, watermark))
+        RingReaderThread(process, aggregator).run()
+        self.assertEqual(aggregator.batch_sizes, [3, 1, 1, 1])
+        self.assertEqual(aggregator.entries[6:], ['ADVANCE 3 inf', 'EOF 3'])
+        self.assertEqual(process.queue_length.value, 8)
+        entries = aggregator.entries[:6]
+        self.assertIsInstance(entries[0], LazyLogEntry)
+        self.assertIsInstance(entries[1], LogEntry)
+        self.assertEqual([tuple(entry.to_entry()) if isinstance(entry, LazyLogEntry) else entry for entry in entries],
+                         [tuple(lazy_entries[0].to_entry()), lazy_entries[1].to_entry(), plain_entry] + [plain_entry] * 3)
+        self.assertEqual(entries[0].level, LogLevel.INFO)
+
+    def test_reader_process_reads_the_files(self):
+        with prepared_reader(seconds=range(3000), continuation_line_count=1) as reader:
+            reader.run()
+            expected_entries = reader.receiver.entries[:-1]
+
+        def start_readers(receiver):
+            reader = LogReader(0, 'log.log', Log4jParser(lazy=True), receiver, batch_size=1000)
+            receiver.add_parser(0, reader.parser)
+            reader.start()
+            return [reader]
+
+        process = ReaderProcess([0], start_readers, ring_size=64 * 1024)
+        aggregator = OrderedLogAggregator(['log.log'])
+        process.start()
+        try:
+            RingReaderThread(process, aggregator).run()
+        finally:
+            process.join()
+        self.assertEqual([entry.to_entry() for entry in aggregator.get()], expected_entries)
+
+    def test_files_of_a_dead_process_are_ended(self):
+        logfire.logging = FakeLogging()
+        process = ReaderProcess([0, 1], lambda receiver: os._exit(1))
+        aggregator = FakeBatchReceiver()
+        process.start()
+        process.join()
+        ring_reader = RingReaderThread(process, aggregator)
+        ring_reader.POLL_INTERVAL = 0.01
+        ring_reader.run()
+        self.assertEqual(sorted(aggregator.entries), ['EOF 0', 'EOF 1'])
+        self.assertEqual(len(logfire.logging.log), 1)
+
+
+class TimeIndexTests(TestCase):
+
+    def tearDown(self):
+        try:
+            os.remove('log.idx')
+        except OSError:
+            pass
+
+    def test_find_region(self):
+        index = TimeIndex('123g456', 100)
+        self.assertEqual(index.find_region(10), (0, None))
+        index.add(0, 20, 1000)
+        index.add(2, 230, 3000)
+        index.add(1, 110, 2000)
+        self.assertEqual(index.find_region(500), (0, 20))
+        self.assertEqual(index.find_region(1000), (0, 20))
+        self.assertEqual(index.find_region(1500), (20, 110))
+        self.assertEqual(index.find_region(3000), (110, 230))
+        self.assertEqual(index.find_region(3500), (230, None))
+
+    def test_save_and_load(self):
+        index = TimeIndex('123g456', 100)
+        index.add(0, 20, 1000)
+        index.save('log.idx', 150)
+        self.assertFalse(index.changed)
+        loaded_index = TimeIndex.load('log.idx', '123g456', 200)
+        self.assertEqual((loaded_index.span, loaded_index.size, loaded_index.checkpoints), (100, 150, {0: (20, 1000)}))
+        # The index belongs to another file, or the file has been truncated.
+        self.assertEqual(TimeIndex.load('log.idx', '123g789', 200), None)
+        self.assertEqual(TimeIndex.load('log.idx', '123g456', 100), None)
+        self.assertEqual(TimeIndex.load('missing.idx', '123g456', 200), None)
+
+
 class LogFilterTests(TestCase):
 
     def test_filter_by_level(self):
         log_filter = LogFilter(levels=(LogLevel.DEBUG, LogLevel.FATAL))
-        self.assertTrue(log_filter.matches(LogEntry(0, 0, 0, 0, LogLevel.DEBUG, 0, 0, 0, 0, 0, 0)))
-        self.assertTrue(log_filter.matches(LogEntry(0, 0, 0, 0, LogLevel.FATAL, 0, 0, 0, 0, 0, 0)))
-        self.assertFalse(log_filter.matches(LogEntry(0, 0, 0, 0, LogLevel.INFO, 0, 0, 0, 0, 0, 0)))
+        self.assertTrue(log_filter.matches(LogEntry(0, 0, 0, 0, 0, LogLevel.DEBUG, 0, 0, 0, 0, 0, 0)))
+        self.assertTrue(log_filter.matches(LogEntry(0, 0, 0, 0, 0, LogLevel.FATAL, 0, 0, 0, 0, 0, 0)))
+        self.assertFalse(log_filter.matches(LogEntry(0, 0, 0, 0, 0, LogLevel.INFO, 0, 0, 0, 0, 0, 0)))
 
     def test_filter_by_grep(self):
         log_filter = LogFilter(grep='broken')
-        self.assertTrue(log_filter.matches(LogEntry(0, 0, 0, 0, 0, 0, 'UnbrokenThingDoer', 0, 0, 0, 'Error!')))
-        self.assertTrue(log_filter.matches(LogEntry(0, 0, 0, 0, 0, 0, 'SomeClass', 0, 0, 0, 'Stuff is broken!')))
-        self.assertFalse(log_filter.matches(LogEntry(0, 0, 0, 0, 0, 0, 'BrokenThingDoer', 0, 0, 0, 'Error!')))
+        self.assertTrue(log_filter.matches(LogEntry(0, 0, 0, 0, 0, 0, 0, 'UnbrokenThingDoer', 0, 0, 0, 'Error!')))
+        self.assertTrue(log_filter.matches(LogEntry(0, 0, 0, 0, 0, 0, 0, 'SomeClass', 0, 0, 0, 'Stuff is broken!')))
+        self.assertFalse(log_filter.matches(LogEntry(0, 0, 0, 0, 0, 0, 0, 'BrokenThingDoer', 0, 0, 0, 'Error!')))
 
     def test_filter_by_time_from(self):
         log_filter = LogFilter(time_from='2000-01-01 00:30:00,000')
-        self.assertTrue(log_filter.matches(LogEntry('2000-01-01 00:30:00,000', 0, 0, 0, 0, 0, 0, 0, 0, 0, 0)))
-        self.assertTrue(log_filter.matches(LogEntry('2000-01-01 01:00:00,000', 0, 0, 0, 0, 0, 0, 0, 0, 0, 0)))
-        self.assertFalse(log_filter.matches(LogEntry('2000-01-01 00:15:00,000', 0, 0, 0, 0, 0, 0, 0, 0, 0, 0)))
+        self.assertTrue(log_filter.matches(self.entry_at('2000-01-01 00:30:00,000')))
+        self.assertTrue(log_filter.matches(self.entry_at('2000-01-01 01:00:00,000')))
+        self.assertFalse(log_filter.matches(self.entry_at('2000-01-01 00:15:00,000')))
 
     def test_filter_by_time_to(self):
         log_filter = LogFilter(time_to='2000-01-01 00:30:00,000')
-        self.assertTrue(log_filter.matches(LogEntry('2000-01-01 00:15:00,000', 0, 0, 0, 0, 0, 0, 0, 0, 0, 0)))
-        self.assertFalse(log_filter.matches(LogEntry('2000-01-01 00:30:00,000', 0, 0, 0, 0, 0, 0, 0, 0, 0, 0)))
-        self.assertFalse(log_filter.matches(LogEntry('2000-01-01 00:45:00,000', 0, 0, 0, 0, 0, 0, 0, 0, 0, 0)))
+        self.assertTrue(log_filter.matches(self.entry_at('2000-01-01 00:15:00,000')))
+        self.assertFalse(log_filter.matches(self.entry_at('2000-01-01 00:30:00,000')))
+        self.assertFalse(log_filter.matches(self.entry_at('2000-01-01 00:45:00,000')))
+
+    def test_filter_by_time_in_another_timezone(self):
+        log_filter = LogFilter(time_from='2000-01-01 02:30', time_converter=TimeConverter('+02:00'))
+        self.assertTrue(log_filter.matches(self.entry_at('2000-01-01 00:30:00,000')))
+        self.assertFalse(log_filter.matches(self.entry_at('2000-01-01 00:29:59,999')))
+
+    def test_select_from_batch(self):
+        contents = ''.join('2000-01-01 00:00:%02d,000 FlowID %s Thread C.m(C.java:23): %s\n' % (second, level, message)
+                           for second, (level, message) in enumerate([('INFO', 'Info'), ('ERROR', 'Error!\nbroken'),
+                                                                      ('DEBUG', 'broken'), ('WARN', 'Unbroken'),
+                                                                      ('FATAL', 'Fatal')]))
+        batch, = Log4jParser().read_batches(0, StringIO(contents), 10)
+        entries = batch.get_entries()
+        filters = [LogFilter(), LogFilter(levels=(LogLevel.DEBUG, LogLevel.ERROR)), LogFilter(grep='broken'),
+                   LogFilter(time_from='2000-01-01 00:00:01', time_to='2000-01-01 00:00:04'),
+                   LogFilter(levels=(LogLevel.ERROR, LogLevel.WARN), grep='broken')]
+        numpy = common.numpy
+        try:
+            for common.numpy in set([numpy, None]):
+                for log_filter in filters:
+                    for min_priority in (-1, 2):
+                        expected = [e.to_entry() for e in entries
+                                    if log_filter.matches(e) and e.level.priority > min_priority]
+                        self.assertEqual([e.to_entry() for e in log_filter.select(batch, min_priority)], expected)
+        finally:
+            common.numpy = numpy
+
+    def entry_at(self, timestamp):
+        return LogEntry(TimeConverter().to_millis(timestamp), 0, 0, timestamp, 0, 0, 0, 0, 0, 0, 0, 0)
+
+
+class TimeConverterTests(TestCase):
+
+    def test_utc(self):
+        self.assertEqual(TimeConverter().to_millis('1970-01-01 00:00:01,234 INFO'), 1234)
+        self.assertEqual(TimeConverter('UTC').to_millis('2000-01-01 00:00:00,000'), 946684800000)
+
+    def test_utc_offsets(self):
+        for timezone in '+02:00', '+0200', 'UTC+2':
+            self.assertEqual(TimeConverter(timezone).to_millis('1970-01-01 02:00:00,001'), 1)
+        self.assertEqual(TimeConverter('-05:30').to_millis('1969-12-31 18:30:00,000'), 0)
+        self.assertRaises(ValueError, TimeConverter, 'Europe/Berlin')
+
+    def test_local(self):
+        converter = TimeConverter('local')
+        self.assertEqual(converter.to_millis('2000-06-01 12:00:00,500'),
+                         int(time.mktime((2000, 6, 1, 12, 0, 0, 0, 0, -1))) * 1000 + 500)
+
+    def test_seconds_are_cached(self):
+        converter = TimeConverter()
+        converter.to_millis('2000-01-01 00:00:00,000')
+        converter.cache['2000-01-01 00:00:00'] = 42000
+        self.assertEqual(converter.to_millis('2000-01-01 00:00:00,123'), 42123)
+
+    def test_parse_incomplete_timestamps(self):
+        converter = TimeConverter()
+        self.assertEqual(converter.parse('2000-01-01 00:01'), 946684860000)
+        self.assertEqual(converter.parse('2000'), 946684800000)
+        self.assertRaises(ValueError, converter.parse, 'yesterday')
+
+    def test_entries_from_different_timezones_are_merged_by_time(self):
+        aggregator = OrderedLogAggregator(['A', 'B'])
+        for reader_id, timezone, hour in (0, '+01:00', 11), (1, '-05:00', 5):
+            parser = Log4jParser(timezone=timezone)
+            contents = ''.join('2000-01-01 %02d:%02d:00,000 FlowID INFO Thread C.m(C.java:1): %s\n' % (hour, m, m)
+                               for m in range(0, 60, 10 + reader_id))
+            for entry in parser.read(reader_id, StringIO(contents)):
+                aggregator.add(entry)
+            aggregator.eof(reader_id)
+        entries = list(aggregator.get())
+        self.assertEqual([e.time for e in entries], sorted(e.time for e in entries))
+        self.assertEqual([e.reader_id for e in entries[:4]], [0, 1, 0, 1])
+        self.assertEqual(entries[1].timestamp, '2000-01-01 05:00:00,000')
+
+    def test_lines_with_invalid_timestamps_are_skipped(self):
+        fake_logging = FakeLogging()
+        logfire.logging = fake_logging
+        try:
+            contents = '2000-01-01 00:00:xx,000 FlowID INFO Thread C.m(C.java:1): Bad\n'
+            self.assertEqual(list(Log4jParser().read(0, StringIO(contents))), [])
+            self.assertTrue(fake_logging.log[0].startswith('[WARN]'))
+        finally:
+            logfire.logging = logging
+
+
+class SymbolTableTests(TestCase):
+
+    def test_intern_returns_the_first_instance(self):
+        symbols = SymbolTable()
+        first = ''.join(['Thread', '-1'])
+        second = ''.join(['Thread', '-1'])
+        self.assertIs(symbols.intern(first), first)
+        self.assertIs(symbols.intern(second), first)
+        self.assertEqual(len(symbols), 1)
+
+    def test_table_is_bounded(self):
+        symbols = SymbolTable(capacity=10)
+        for i in range(1000):
+            symbols.intern('Thread-{0}'.format(i))
+        self.assertLessEqual(len(symbols), 20)
+
+    def test_symbols_that_are_used_again_are_kept(self):
+        symbols = SymbolTable(capacity=10)
+        main = symbols.intern('main')
+        for i in range(1000):
+            symbols.intern('Thread-{0}'.format(i))
+            self.assertIs(symbols.intern(''.join(['ma', 'in'])), main)
+
+    def test_parsers_intern_fields(self):
+        lines = '2000-01-01 00:00:0%d,000 FlowID ERROR Thread-1 pkg.C.m(C.java:23): Error!\n'
+        for parser in Log4jParser(), Log4jParser(lazy=True), PatternLayoutParser('%d %x %p %t %l: %m%n'):
+            first, second = parser.read(0, StringIO(''.join(lines % i for i in range(2))))
+            for field in 'thread', 'class_', 'method', 'source_file':
+                self.assertIs(getattr(first, field), getattr(second, field))
+            self.assertEqual(second.class_, 'pkg.C')
 
 
 class RedisOutputThreadTests(TestCase):
@@ -818,6 +2291,42 @@ class LogAggregatorTests(TestCase):
         self.assertEqual(list(aggregator.get()), [1, 2, 3])
         self.assertEqual(len(aggregator), 0)
 
+    def test_add_batch(self):
+        aggregator = NonOrderedLogAggregator([])
+        aggregator.add(2)
+        aggregator.add_batch([3, 1])
+        self.assertEqual(list(aggregator.get()), [2, 3, 1])
+        aggregator = OrderedLogAggregator([])
+        aggregator.add(2)
+        aggregator.add_batch([3, 1])
+        self.assertEqual(list(aggregator.get()), [1, 2, 3])
+
+    def test_ordered_log_aggregator_merges_batches(self):
+        aggregator = OrderedLogAggregator(['A', 'B'])
+        aggregator.add_batch([1, 4, 7, 10])
+        aggregator.add_batch([2, 3, 9])
+        aggregator.add(5)
+        # Runs that start with the same object and single entries equal to the start of a run.
+        aggregator.add_batch([1, 6, 8])
+        aggregator.add(1)
+        aggregator.add_batch([])
+        self.assertEqual(len(aggregator), 12)
+        aggregator.eof(0)
+        aggregator.eof(1)
+        self.assertEqual(list(aggregator.get()), [1, 1, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10])
+        self.assertEqual(len(aggregator), 0)
+        self.assertEqual(aggregator.runs, {})
+
+    def test_register(self):
+        for aggregator_class in NonOrderedLogAggregator, OrderedLogAggregator:
+            aggregator = aggregator_class(['log.log'])
+            aggregator.eof(0)
+            aggregator.register(1, 'another.log')
+            aggregator.register(0, 'third.log')
+            aggregator.register('source')
+            self.assertEqual(aggregator.file_names, ['third.log', 'another.log'])
+            self.assertEqual(aggregator.open_files, set([0, 1, 'source']))
+
     def test_non_ordered_log_aggregator_eof(self):
         aggregator = NonOrderedLogAggregator(['log.log', 'another.log'])
         self.assertEqual(aggregator.open_files, set([0, 1]))
@@ -830,10 +2339,184 @@ class LogAggregatorTests(TestCase):
         aggregator.eof(0)
         self.assertEqual(aggregator.open_files, set([1]))
 
+    def test_ordered_log_aggregator_holds_back_entries_above_low_watermark(self):
+        def entry(time, reader_id):
+            return LogEntry(time, reader_id, 0, '', None, LogLevel.INFO, None, '', '', '', 0, '')
+
+        aggregator = OrderedLogAggregator(['A', 'B'])
+        aggregator.add_batch([entry(1, 0), entry(4, 0), entry(6, 0)])
+        aggregator.advance(0, 6)
+        entries = aggregator.get()
+        aggregator.add_batch([entry(2, 1), entry(5, 1)])
+        aggregator.advance(1, 5)
+        self.assertEqual([next(entries).time for _ in range(3)], [1, 2, 4])
+        self.assertEqual(aggregator.low_watermark, 5)
+
+        received = []
+        thread = threading.Thread(target=lambda: received.extend(e.time for e in entries))
+        thread.daemon = True
+        thread.start()
+        aggregator.add(entry(3, 1))
+        time.sleep(0.05)
+        self.assertEqual(received, [3])
+        aggregator.advance(1, float('inf'))
+        aggregator.eof(0)
+        aggregator.eof(1)
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(received, [3, 5, 6])
+
+    def test_ordered_log_aggregator_get_returns_after_last_eof(self):
+        for aggregator_class in OrderedLogAggregator, MergingLogAggregator:
+            aggregator = aggregator_class(['A', 'B'])
+            aggregator.advance(0, float('inf'))
+            aggregator.advance(1, float('inf'))
+            thread = threading.Thread(target=lambda: list(aggregator.get()))
+            thread.daemon = True
+            thread.start()
+            thread.join(0.05)
+            aggregator.eof(0)
+            aggregator.eof(1)
+            thread.join(5)
+            self.assertFalse(thread.is_alive())
+
+    def test_merging_log_aggregator(self):
+        def entry(time, reader_id):
+            return LogEntry(time, reader_id, 0, '', None, LogLevel.INFO, None, '', '', '', 0, '')
+
+        aggregator = MergingLogAggregator(['A', 'B', 'C'])
+        aggregator.add_batch([entry(1, 0), entry(4, 0), entry(7, 0)])
+        aggregator.add_batch([entry(5, 1), entry(2, 1)])
+        aggregator.add(entry(8, 0))
+        aggregator.advance(0, 8)
+        aggregator.advance(1, 5)
+        entries = aggregator.get()
+        # Nothing is passed on before the file without queued entries has a watermark.
+        self.assertEqual(aggregator.low_watermark, float('-inf'))
+        aggregator.advance(2, 3)
+        self.assertEqual(next(entries).time, 1)
+        self.assertEqual(next(entries).time, 2)
+        self.assertEqual(len(aggregator.entries), 2)
+        aggregator.eof(2)
+        aggregator.eof(1)
+        self.assertEqual(aggregator.low_watermark, float('inf'))
+        aggregator.eof(0)
+        self.assertEqual([e.time for e in entries], [4, 5, 7, 8])
+        self.assertEqual(len(aggregator), 0)
+
+    def test_merging_log_aggregator_pauses_readers_that_are_ahead(self):
+        def entry(time, reader_id):
+            return LogEntry(time, reader_id, 0, '', None, LogLevel.INFO, None, '', '', '', 0, '')
+
+        aggregator = MergingLogAggregator(['A', 'B'], buffer_size=2)
+        aggregator.add_batch([entry(1, 0), entry(2, 0)])
+        aggregator.add_batch([entry(1, 1)])
+        added = []
+        thread = threading.Thread(target=lambda: added.append(aggregator.add_batch([entry(3, 0)])))
+        thread.daemon = True
+        thread.start()
+        thread.join(0.05)
+        self.assertTrue(thread.is_alive())
+        entries = aggregator.get()
+        self.assertEqual(next(entries).time, 1)
+        thread.join(5)
+        self.assertEqual(added, [None])
+        self.assertEqual(len(aggregator), 3)
+
+        # Readers do not wait while the merge waits for the entries of another file.
+        self.assertEqual(next(entries).reader_id, 1)
+        aggregator.add_batch([entry(4, 0)])
+        self.assertEqual(len(aggregator.queues[0]), 3)
+
+    def test_reordering_log_aggregator(self):
+        def entry(time, reader_id):
+            return LogEntry(time, reader_id, 0, '', None, LogLevel.INFO, None, '', '', '', 0, 'Message')
+
+        aggregator = ReorderingLogAggregator(['A', 'B'], max_lateness=1000)
+        aggregator.add_batch([entry(0, 0), entry(150, 0), entry(2500, 0)])
+        aggregator.add(entry(120, 1))
+        current_timestamp = aggregator.arrival_timestamps[0]
+        # The newest entry is more than a second newer than the first two buckets.
+        self.assertAlmostEqual(aggregator._pass_on_due_buckets(current_timestamp), 1.0)
+        self.assertEqual([e.time for e in aggregator.ready_entries], [0, 120, 150])
+        self.assertEqual(aggregator.bucket_keys, [25])
+
+        aggregator.add(entry(50, 1))
+        self.assertEqual(aggregator.late_entry_count, 1)
+        self.assertEqual(len(aggregator), 5)
+        aggregator.eof(0)
+        aggregator.eof(1)
+        self.assertEqual([e.time for e in aggregator.get()], [0, 120, 150, 50, 2500])
+        self.assertEqual(len(aggregator), 0)
+
+    def test_reordering_log_aggregator_passes_on_entries_that_have_waited(self):
+        def entry(time):
+            return LogEntry(time, 0, 0, '', None, LogLevel.INFO, None, '', '', '', 0, 'Message')
+
+        aggregator = ReorderingLogAggregator(['A'], max_lateness=1000)
+        aggregator.add_batch([entry(230), entry(10)])
+        arrival_timestamp = aggregator.arrival_timestamps[0]
+        self.assertAlmostEqual(aggregator._pass_on_due_buckets(arrival_timestamp + 0.25), 0.75)
+        self.assertEqual(list(aggregator.ready_entries), [])
+        aggregator.arrival_timestamps[2] += 0.5
+        aggregator._pass_on_due_buckets(arrival_timestamp + 1)
+        self.assertEqual([e.time for e in aggregator.ready_entries], [10])
+        self.assertEqual(aggregator.bucket_keys, [2])
+
+    def test_reordering_log_aggregator_late_policies(self):
+        lazy_entry = LazyLogEntry(0, 0, 0, '', LogLevel.INFO, 'Message', lambda line: (None,) * 7 + (line,))
+        for late_policy, expected_messages in ('emit', ['Message']), ('tag', ['[late] Message']), ('drop', []):
+            aggregator = ReorderingLogAggregator(['A'], max_lateness=0, late_policy=late_policy)
+            aggregator.last_passed_on_key = 0
+            aggregator.add(lazy_entry)
+            aggregator.eof(0)
+            self.assertEqual([e.message for e in aggregator.get()], expected_messages)
+            self.assertEqual(aggregator.late_entry_count, 1)
+
+    def test_aggregators_with_spill_queues(self):
+        def entry(time, reader_id):
+            return LogEntry(time, reader_id, 0, '', None, LogLevel.INFO, None, '', '', '', 0, 'Message')
+
+        os.mkdir('spill')
+        store = SpillStore('spill', 2000, logfire.estimate_entry_size)
+        try:
+            aggregator = NonOrderedLogAggregator(['A'], store.create_queue())
+            aggregator.add_batch([entry(i, 0) for i in range(5)])
+            aggregator.add(entry(5, 0))
+            self.assertEqual(len(aggregator), 6)
+            self.assertEqual(len(os.listdir(store.directory)), 1)
+            self.assertEqual([e.time for e in aggregator.get()], range(6))
+
+            aggregator = MergingLogAggregator(['A', 'B'], float('inf'), store.create_queue)
+            aggregator.add_batch([entry(i, 0) for i in range(0, 10, 2)])
+            aggregator.add_batch([entry(i, 1) for i in range(1, 10, 2)])
+            aggregator.eof(0)
+            aggregator.eof(1)
+            self.assertEqual([e.time for e in aggregator.get()], range(10))
+            self.assertEqual(os.listdir(store.directory), [])
+        finally:
+            store.close()
+            os.rmdir('spill')
+
+    def test_ordered_log_aggregator_ignores_sources_with_infinite_watermark(self):
+        aggregator = OrderedLogAggregator(['A'])
+        aggregator.register('source', watermark=float('inf'))
+        aggregator.advance(0, 2)
+        self.assertEqual(aggregator.low_watermark, 2)
+        aggregator.eof(0)
+        self.assertEqual(aggregator.low_watermark, float('inf'))
+
 
 
 class MiscellaneousTests(TestCase):
 
+    def test_parse_duration(self):
+        self.assertEqual(logfire.parse_duration('2s'), 2000)
+        self.assertEqual(logfire.parse_duration('500ms'), 500)
+        self.assertEqual(logfire.parse_duration('1m'), 60000)
+        self.assertEqual(logfire.parse_duration('1.5'), 1500)
+        self.assertRaises(logfire.ArgumentTypeError, logfire.parse_duration, '2 hours')
+
     def test_loglevel_from_first_letter(self):
         self.assertEqual(LogLevel.FROM_FIRST_LETTER['T'], LogLevel.TRACE)
         self.assertEqual(LogLevel.FROM_FIRST_LETTER['D'], LogLevel.DEBUG)
@@ -847,8 +2530,8 @@ class MiscellaneousTests(TestCase):
         self.assertEqual(repr(LogLevel.ERROR), 'ERROR')
 
     def test_log_entry_as_logstash(self):
-        entry = LogEntry('2000-01-01 00:00:00,000', 0, 1000, 'FlowID', LogLevel.WARN, 'Thread', 'ThingDoer', 'doThing',
-                         'ThingDoer.java', 2, 'Problem!')
+        entry = LogEntry(946684800000, 0, 1000, '2000-01-01 00:00:00,000', 'FlowID', LogLevel.WARN, 'Thread', 'ThingDoer',
+                         'doThing', 'ThingDoer.java', 2, 'Problem!')
         expected = {'@timestamp': '2000-01-01 00:00:00,000', 'flowid': 'FlowID', 'level': 'WARN', 'thread': 'Thread',
                     'class': 'ThingDoer', 'method': 'doThing', 'file': 'ThingDoer.java', 'line': 2,
                     'message': 'Problem!', 'logfile': 'log.log'}
@@ -870,6 +2553,17 @@ class FakeReceiver(object):
         self.entries.append('EOF {0}'.format(fid))
 
 
+class FakeBatchReceiver(FakeReceiver):
+
+    def __init__(self):
+        FakeReceiver.__init__(self)
+        self.batch_sizes = []
+
+    def add_batch(self, entries):
+        self.batch_sizes.append(len(entries))
+        self.entries.extend(entries)
+
+
 class FakeLogAggregator(object):
 
     def __init__(self):
@@ -882,7 +2576,7 @@ class FakeLogAggregator(object):
     def get(self):
         while True:
             self.entry_count += 1
-            yield LogEntry(str(self.entry_count), '123g456', 0, 0, 0, 0, 0, 0, 0, 0, '\xbf')
+            yield LogEntry(self.entry_count, '123g456', 0, str(self.entry_count), 0, 0, 0, 0, 0, 0, 0, '\xbf')
 
 
 class FakeRedis(object):
@@ -955,6 +2649,9 @@ class FakeLogging(object):
     def warning(self, msg, *args, **kwargs):
         self.add('WARN', msg, *args)
 
+    def error(self, msg, *args, **kwargs):
+        self.add('ERROR', msg, *args)
+
     def exception(self, msg, *args, **kwargs):
         self.add('ERROR', msg, *args)
 
@@ -0,0 +1,85 @@
+"""
+Sparse indexes of the times of log files.
+
+While a file is read, a checkpoint is recorded for about every SPAN bytes: the offset of the first entry after the
+start of the span and the time of that entry. As the entries of a log file are ordered by time, the checkpoints narrow
+down the region of the file in which an entry with a given time starts, so that seeking a time only has to search that
+region instead of the whole file. The index is stored next to the sincedb and is reused as long as the file has not
+been replaced or truncated.
+"""
+
+import bisect
+import logging
+import pickle
+import zlib
+
+SPAN = 4 * 1024 * 1024  # bytes between checkpoints
+
+INDEX_VERSION = 1
+
+
+class TimeIndex(object):
+
+    """
+    The checkpoints of a log file. checkpoints maps the number of each indexed span to the (offset, time) of the first
+    entry after the start of the span. size is the size of the file when the index was stored.
+    """
+
+    def __init__(self, file_id=None, span=None):
+        self.file_id = file_id
+        self.span = span or SPAN
+        self.checkpoints = {}
+        self.size = 0
+        self.changed = False
+
+    def __contains__(self, span_number):
+        return span_number in self.checkpoints
+
+    def add(self, span_number, offset, time):
+        self.checkpoints[span_number] = offset, time
+        self.changed = True
+
+    def find_region(self, target_time):
+        """
+        Returns the offsets (start, stop) of the region in which the first entry with a time not older than target_time
+        starts. stop is None if the region extends to the end of the file.
+        """
+
+        checkpoints = sorted(self.checkpoints.itervalues())
+        times = [time for _, time in checkpoints]
+        index = bisect.bisect_left(times, target_time)
+        start = checkpoints[index - 1][0] if index else 0
+        stop = checkpoints[index][0] if index < len(checkpoints) else None
+        return start, stop
+
+    def save(self, path, size):
+        """Stores the index for a file of the given size in the given file."""
+
+        self.size = size
+        data = pickle.dumps((INDEX_VERSION, self.file_id, self.span, self.size, self.checkpoints), 2)
+        with open(path, 'wb') as index_file:
+            index_file.write(zlib.compress(data))
+        self.changed = False
+
+    @classmethod
+    def load(cls, path, file_id, size):
+        """
+        Loads the index stored in the given file. Returns None if it does not exist, belongs to another file, or was
+        recorded for a file larger than size, which means that the file has been truncated since.
+        """
+
+        try:
+            with open(path, 'rb') as index_file:
+                version, stored_file_id, span, stored_size, checkpoints = pickle.loads(
+                    zlib.decompress(index_file.read()))
+        except IOError:
+            return None
+        except Exception:
+            logging.warning('Failed to read the time index "%s".', path)
+            return None
+        if version != INDEX_VERSION or stored_file_id != file_id or stored_size > size:
+            return None
+        index = cls(file_id, span)
+        index.checkpoints = checkpoints
+        index.size = stored_size
+        return index